@@ -0,0 +1,361 @@
+"""
+实时销售分析
+在内存中按分钟和按天分桶累计各产品的销量和销售额，由 POSDatabase 的销售监听（新增、删除销售）增量更新，
+滑动窗口（最近一小时、今天、最近7天）的合计随之增减，过期的桶整体扣除；
+各窗口的排行按需重新排序并缓存，请求只取前 K 项。
+多个工作进程中，每个进程定期读取其他进程写入的新销售（按销售id递增）和作废记录（按作废id递增），计数器最终一致；
+计数器定期保存到数据库，重启后从保存的状态恢复并补上之后的销售。
+最近24小时每分钟的销售额、销量和交易数保存在固定大小的环形缓冲区中，用于实时销售曲线
+"""
+
+import heapq
+import os
+import threading
+import time
+from array import array
+from datetime import datetime, date
+
+# 排行缓存的最长有效期（秒）：有新销售时最多每隔这么久重新排序一次
+ANALYTICS_TOP_REFRESH = float(os.environ.get('ANALYTICS_TOP_REFRESH', 1))
+# 每个窗口缓存的排行长度（请求的 K 不超过该值）
+ANALYTICS_TOP_CAPACITY = 100
+
+# 窗口：(分桶粒度, 桶数)
+ANALYTICS_WINDOWS = {
+    'hour': ('minute', 60),
+    'today': ('day', 1),
+    'week': ('day', 7),
+}
+ANALYTICS_RANKINGS = ('quantity', 'revenue')
+
+# 实时销售曲线保留的分钟数（环形缓冲区的槽数）
+TIMELINE_MINUTES = 24 * 60
+# 推送连接在没有新销售时发送心跳的间隔（秒），同时打开的推送连接数上限
+TIMELINE_STREAM_HEARTBEAT = 15
+TIMELINE_STREAM_CLIENTS = int(os.environ.get('TIMELINE_STREAM_CLIENTS', 8))
+
+
+def sale_buckets(sale_date):
+    """销售时间（'YYYY-MM-DD HH:MM:SS'）所在的分钟桶和日桶"""
+    moment = datetime.strptime(sale_date[:19], '%Y-%m-%d %H:%M:%S')
+    return int(moment.timestamp() // 60), moment.date().toordinal()
+
+
+def window_start_date(now=None):
+    """最长窗口覆盖的最早日期（'YYYY-MM-DD'），补读销售时只需读取此后的销售"""
+    days = max(count for granularity, count in ANALYTICS_WINDOWS.values() if granularity == 'day')
+    return date.fromordinal(current_buckets(now)[1] - days + 1).isoformat()
+
+
+def timeline_start_date(now=None):
+    """环形缓冲区覆盖的最早时间（'YYYY-MM-DD HH:MM:SS'）"""
+    first = current_buckets(now)[0] - TIMELINE_MINUTES + 1
+    return datetime.fromtimestamp(first * 60).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def current_buckets(now=None):
+    now = now or time.time()
+    return int(now // 60), date.fromtimestamp(now).toordinal()
+
+
+def format_minute(minute):
+    """分钟序号（Unix 时间 // 60）对应的本地时间 'YYYY-MM-DD HH:MM'"""
+    return datetime.fromtimestamp(minute * 60).strftime('%Y-%m-%d %H:%M')
+
+
+class MinuteRing:
+    """每分钟销售额、销量和交易数的环形缓冲区：分钟 m 存放在槽 m % size，槽中记录所属分钟，过期的槽在写入时清零"""
+
+    def __init__(self, size=TIMELINE_MINUTES):
+        self.size = size
+        self._minutes = array('q', [-1]) * size
+        self._revenue = array('d', [0.0]) * size
+        self._units = array('q', [0]) * size
+        self._transactions = array('q', [0]) * size
+
+    def add(self, minute, revenue, units, transactions, current):
+        """计入 minute 分钟的销售；早于缓冲区范围或晚于当前分钟的忽略"""
+        if not current - self.size < minute <= current:
+            return
+        slot = minute % self.size
+        if self._minutes[slot] != minute:
+            self._minutes[slot] = minute
+            self._revenue[slot] = 0.0
+            self._units[slot] = 0
+            self._transactions[slot] = 0
+        self._revenue[slot] += revenue
+        self._units[slot] += units
+        self._transactions[slot] += transactions
+
+    def series(self, start, end):
+        """分钟 start 到 end（含）的 (分钟, 销售额, 销量, 交易数)，没有销售的分钟为 0"""
+        for minute in range(max(start, end - self.size + 1), end + 1):
+            slot = minute % self.size
+            if self._minutes[slot] == minute:
+                yield minute, self._revenue[slot], self._units[slot], self._transactions[slot]
+            else:
+                yield minute, 0.0, 0, 0
+
+    def clear(self):
+        for slot in range(self.size):
+            self._minutes[slot] = -1
+
+
+class SalesAnalytics:
+    """按分桶累计的销售计数器及各窗口的排行"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._timeline = MinuteRing()
+        self._buckets = {'minute': {}, 'day': {}}  # 粒度 -> {桶: {条码: [销量, 销售额]}}
+        self._totals = {window: {} for window in ANALYTICS_WINDOWS}  # 窗口 -> {条码: [销量, 销售额]}
+        self._names = {}
+        self._current = {'minute': None, 'day': None}
+        self._rankings = {}  # (窗口, 排序字段) -> (生成时间, 排行)
+        self._version = 0
+        self._ranked_version = {}
+        self._applied = set()  # 已计入、id 大于 last_sale_id 的销售
+        self.last_sale_id = 0
+        self._applied_voids = set()  # 已扣除、id 大于 last_void_id 的作废记录
+        self.last_void_id = None  # 首次补读前为 None：此前的作废已体现在销售表中，不再扣除
+
+    # 计数器更新
+    def apply(self, event, sales):
+        """销售监听：event 为 'add' 或 'delete'，sales 为销售记录（含 id, barcode, name, quantity, total_price, date，
+        可选 transaction_id；删除时 transaction_deleted 表示所属交易随之删除，void_id 为作废记录id）"""
+        with self._lock:
+            self._advance()
+            transactions = set()
+            for sale in sales:
+                if event == 'add':
+                    if sale['id'] <= self.last_sale_id or sale['id'] in self._applied:
+                        continue
+                    self._applied.add(sale['id'])
+                    self._add(sale, 1, self._first_line(sale, transactions))
+                else:
+                    void_id = sale.get('void_id')
+                    if void_id is not None and self.last_void_id is not None:
+                        if void_id <= self.last_void_id or void_id in self._applied_voids:
+                            continue
+                        self._applied_voids.add(void_id)
+                    if sale['id'] <= self.last_sale_id or sale['id'] in self._applied:
+                        self._add(sale, -1, sale.get('transaction_deleted', False))
+
+    def catch_up(self, sales, max_sale_id, voids=(), max_void_id=None):
+        """计入 last_sale_id 之后、不超过 max_sale_id 的销售（含其他进程写入的），之后 last_sale_id 前进到 max_sale_id；
+        再扣除 last_void_id 之后、不超过 max_void_id 的作废记录（id 为作废记录id，sale_id 为被作废的销售），
+        只扣除已计入的销售，之后 last_void_id 前进到 max_void_id
+
+        sales 和 voids 只需包含仍在窗口内的记录；voids 应在 sales 之后读取
+        """
+        with self._lock:
+            self._advance()
+            transactions = set()
+            added = set()
+            for sale in sales:
+                if self.last_sale_id < sale['id'] <= max_sale_id and sale['id'] not in self._applied:
+                    self._add(sale, 1, self._first_line(sale, transactions))
+                    added.add(sale['id'])
+            if max_void_id is not None:
+                if self.last_void_id is not None:
+                    for void in voids:
+                        if (void['id'] <= self.last_void_id or void['id'] > max_void_id
+                                or void['id'] in self._applied_voids):
+                            continue
+                        sale_id = void['sale_id']
+                        if sale_id <= self.last_sale_id or sale_id in self._applied or sale_id in added:
+                            self._add(void, -1, void.get('transaction_deleted', False))
+                self.last_void_id = max(self.last_void_id or 0, max_void_id)
+                self._applied_voids = set(void_id for void_id in self._applied_voids if void_id > self.last_void_id)
+            self.last_sale_id = max(self.last_sale_id, max_sale_id)
+            self._applied = set(sale_id for sale_id in self._applied if sale_id > self.last_sale_id)
+
+    @staticmethod
+    def _first_line(sale, transactions):
+        # 同一笔交易的多行只计一次交易数；没有交易id的销售各算一笔
+        transaction_id = sale.get('transaction_id')
+        if transaction_id is None:
+            return True
+        if transaction_id in transactions:
+            return False
+        transactions.add(transaction_id)
+        return True
+
+    def _add(self, sale, sign, new_transaction=False):
+        minute, day = sale_buckets(sale['date'])
+        quantity = sign * sale['quantity']
+        revenue = sign * sale['total_price']
+        barcode = sale['barcode']
+        self._names[barcode] = sale.get('name') or self._names.get(barcode)
+        for window, (granularity, count) in ANALYTICS_WINDOWS.items():
+            bucket = minute if granularity == 'minute' else day
+            if bucket <= self._current[granularity] - count:
+                continue  # 已超出窗口
+            self._increment(self._totals[window], barcode, quantity, revenue)
+        for granularity, bucket in (('minute', minute), ('day', day)):
+            oldest = self._current[granularity] - max(
+                count for g, count in ANALYTICS_WINDOWS.values() if g == granularity)
+            if bucket > oldest:
+                self._increment(self._buckets[granularity].setdefault(bucket, {}), barcode, quantity, revenue)
+        self._timeline.add(minute, revenue, quantity, sign * int(new_transaction), self._current['minute'])
+        self._version += 1
+        self._changed.notify_all()
+
+    @staticmethod
+    def _increment(counters, barcode, quantity, revenue):
+        entry = counters.get(barcode)
+        if entry is None:
+            entry = counters[barcode] = [0, 0.0]
+        entry[0] += quantity
+        entry[1] += revenue
+        if entry[0] <= 0 and abs(entry[1]) < 0.005:
+            del counters[barcode]
+
+    def _advance(self, now=None):
+        """时间前进后从各窗口的合计中扣除滑出窗口的桶"""
+        minute, day = current_buckets(now)
+        for granularity, current in (('minute', minute), ('day', day)):
+            previous = self._current[granularity]
+            self._current[granularity] = current
+            if previous is None or current == previous:
+                continue
+            buckets = self._buckets[granularity]
+            for window, (window_granularity, count) in ANALYTICS_WINDOWS.items():
+                if window_granularity != granularity:
+                    continue
+                # 在旧时间仍属于窗口、在新时间已滑出的桶
+                for bucket in [b for b in buckets if previous - count < b <= current - count]:
+                    for barcode, (quantity, revenue) in buckets[bucket].items():
+                        self._increment(self._totals[window], barcode, -quantity, -revenue)
+            keep = max(count for g, count in ANALYTICS_WINDOWS.values() if g == granularity)
+            for bucket in [b for b in buckets if b <= current - keep]:
+                del buckets[bucket]
+            self._version += 1
+            self._changed.notify_all()
+
+    # 查询
+    def top(self, window, k=10, by='quantity'):
+        """窗口内销量或销售额最高的 K 个产品"""
+        if window not in ANALYTICS_WINDOWS:
+            raise ValueError(f'Invalid window: {window}')
+        if by not in ANALYTICS_RANKINGS:
+            raise ValueError(f'Invalid ranking: {by}')
+        key = (window, by)
+        with self._lock:
+            self._advance()
+            cached = self._rankings.get(key)
+            stale = self._ranked_version.get(key) != self._version
+            if cached is None or (stale and time.time() - cached[0] >= ANALYTICS_TOP_REFRESH):
+                index = ANALYTICS_RANKINGS.index(by)
+                ranking = heapq.nlargest(ANALYTICS_TOP_CAPACITY, self._totals[window].items(),
+                                         key=lambda item: (item[1][index], item[0]))
+                cached = self._rankings[key] = (time.time(), [
+                    (barcode, self._names.get(barcode), quantity, revenue)
+                    for barcode, (quantity, revenue) in ranking
+                ])
+                self._ranked_version[key] = self._version
+            hours = self._window_hours(window)
+        return [self._entry(barcode, name, quantity, revenue, hours)
+                for barcode, name, quantity, revenue in cached[1][:k]]
+
+    def velocity(self, barcode):
+        """产品在各窗口内的销量、销售额和每小时销量"""
+        with self._lock:
+            self._advance()
+            result = {}
+            for window in ANALYTICS_WINDOWS:
+                quantity, revenue = self._totals[window].get(barcode, (0, 0.0))
+                result[window] = self._entry(barcode, self._names.get(barcode), quantity, revenue,
+                                             self._window_hours(window))
+            return result
+
+    def timeline(self, minutes=60):
+        """最近 minutes 分钟（含当前分钟，最多24小时）每分钟的销售额、销量和交易数，按时间升序"""
+        with self._lock:
+            self._advance()
+            current = self._current['minute']
+            return [{
+                'minute': format_minute(minute),
+                'revenue': round(revenue, 2),
+                'units': units,
+                'transactions': transactions
+            } for minute, revenue, units, transactions in self._timeline.series(current - minutes + 1, current)]
+
+    def load_timeline(self, rows):
+        """恢复后以已计入的销售的每分钟合计替换销售曲线，rows 为 (分钟 'YYYY-MM-DD HH:MM', 销售额, 销量, 交易数)"""
+        with self._lock:
+            self._advance()
+            self._timeline.clear()
+            for minute, revenue, units, transactions in rows:
+                self._timeline.add(sale_buckets(minute + ':00')[0], revenue, units, transactions,
+                                   self._current['minute'])
+            self._version += 1
+
+    @property
+    def version(self):
+        """计数器的版本号，每次变化时递增"""
+        return self._version
+
+    def wait_for_change(self, version, timeout):
+        """等待计数器在 version 之后发生变化，返回最新的版本号（超时未变化时返回原值）"""
+        with self._changed:
+            self._changed.wait_for(lambda: self._version != version, timeout)
+            return self._version
+
+    def _window_hours(self, window):
+        # 今天按已过去的时间计算，滑动窗口按窗口长度计算
+        if window == 'today':
+            now = datetime.now()
+            return max((now - now.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds() / 3600,
+                       1 / 60)
+        granularity, count = ANALYTICS_WINDOWS[window]
+        return count / 60 if granularity == 'minute' else count * 24
+
+    @staticmethod
+    def _entry(barcode, name, quantity, revenue, hours):
+        return {
+            'barcode': barcode,
+            'name': name,
+            'quantity': quantity,
+            'revenue': round(revenue, 2),
+            'per_hour': round(quantity / hours, 3)
+        }
+
+    # 保存与恢复
+    def snapshot(self):
+        """返回 (last_sale_id, 已计入的更大的销售id列表, 行列表, last_void_id, 已扣除的更大的作废id列表)，
+        行为 (粒度, 桶, 条码, 名称, 销量, 销售额)"""
+        with self._lock:
+            self._advance()
+            rows = [(granularity, bucket, barcode, self._names.get(barcode), quantity, revenue)
+                    for granularity, buckets in self._buckets.items()
+                    for bucket, counters in buckets.items()
+                    for barcode, (quantity, revenue) in counters.items()]
+            return self.last_sale_id, sorted(self._applied), rows, self.last_void_id, sorted(self._applied_voids)
+
+    def restore(self, last_sale_id, applied_ids, rows, last_void_id=None, applied_void_ids=()):
+        """从保存的状态恢复计数器（之后应调用 catch_up 补上保存之后的销售和作废）"""
+        with self._lock:
+            self._buckets = {'minute': {}, 'day': {}}
+            self._totals = {window: {} for window in ANALYTICS_WINDOWS}
+            self._timeline.clear()
+            self._applied = set(applied_ids)
+            self._rankings = {}
+            self.last_sale_id = last_sale_id
+            self._applied_voids = set(applied_void_ids)
+            self.last_void_id = last_void_id
+            self._current = {'minute': None, 'day': None}
+            self._advance()
+            for granularity, bucket, barcode, name, quantity, revenue in rows:
+                if name:
+                    self._names[barcode] = name
+                oldest = self._current[granularity] - max(
+                    count for g, count in ANALYTICS_WINDOWS.values() if g == granularity)
+                if bucket <= oldest:
+                    continue
+                self._increment(self._buckets[granularity].setdefault(bucket, {}), barcode, quantity, revenue)
+                for window, (window_granularity, count) in ANALYTICS_WINDOWS.items():
+                    if window_granularity == granularity and bucket > self._current[granularity] - count:
+                        self._increment(self._totals[window], barcode, quantity, revenue)
+            self._version += 1
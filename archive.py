@@ -0,0 +1,167 @@
+"""
+按月分区的销售归档文件
+已结束的月份的销售、交易及交易明细从主数据库移入 archive/sales-YYYY-MM.db，
+归档文件只读打开，可选用 gzip 压缩（读取时解压到缓存目录）；
+主数据库只保留近期数据，查询接口按分区依次读取主库和归档文件
+"""
+
+import gzip
+import os
+import shutil
+import sqlite3
+import threading
+from datetime import datetime
+
+# 归档表结构（不含外键：归档文件中不保存产品表）
+ARCHIVE_SCHEMA = {
+    'sales': (
+        ('id', 'barcode', 'name', 'quantity', 'price', 'total_price', 'cost_price', 'date', 'client_ref'),
+        '''
+        CREATE TABLE IF NOT EXISTS sales (
+            id INTEGER PRIMARY KEY,
+            barcode TEXT NOT NULL,
+            name TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            price REAL NOT NULL,
+            total_price REAL NOT NULL,
+            cost_price REAL NOT NULL,
+            date TIMESTAMP,
+            client_ref TEXT
+        )
+        ''',
+    ),
+    'transactions': (
+        ('id', 'cashier', 'terminal_id', 'line_count', 'item_count', 'total_price', 'total_cost',
+         'received_amount', 'date', 'client_ref'),
+        '''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY,
+            cashier TEXT,
+            terminal_id TEXT,
+            line_count INTEGER NOT NULL,
+            item_count INTEGER NOT NULL,
+            total_price REAL NOT NULL,
+            total_cost REAL NOT NULL,
+            received_amount REAL,
+            date TIMESTAMP,
+            client_ref TEXT
+        )
+        ''',
+    ),
+    'transaction_items': (
+        ('id', 'transaction_id', 'sale_id', 'line_no', 'product_id'),
+        '''
+        CREATE TABLE IF NOT EXISTS transaction_items (
+            id INTEGER PRIMARY KEY,
+            transaction_id INTEGER NOT NULL,
+            sale_id INTEGER NOT NULL,
+            line_no INTEGER NOT NULL,
+            product_id INTEGER
+        )
+        ''',
+    ),
+}
+
+ARCHIVE_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_sales_date ON sales(date)',
+    'CREATE INDEX IF NOT EXISTS idx_sales_client_ref ON sales(client_ref)',
+    'CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions(date)',
+    'CREATE INDEX IF NOT EXISTS idx_transaction_items_transaction ON transaction_items(transaction_id, line_no)',
+)
+
+
+def month_bounds(period):
+    """返回月份 YYYY-MM 的时间范围 [开始, 结束)，格式与数据库中的日期一致"""
+    start = datetime.strptime(period, '%Y-%m')
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def archive_cutoff(hot_months, now=None):
+    """返回需要归档的截止时间：早于该时间的月份（保留最近 hot_months 个月，含当月）可归档"""
+    now = now or datetime.now()
+    month_index = now.year * 12 + now.month - 1 - (hot_months - 1)
+    return datetime(month_index // 12, month_index % 12 + 1, 1).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class SalesArchive:
+    """归档文件目录：负责写入、压缩和以只读方式打开各月份的归档文件"""
+
+    def __init__(self, archive_dir, compress=False):
+        self.archive_dir = archive_dir
+        self.cache_dir = os.path.join(archive_dir, '.cache')
+        self.compress = compress
+        self._lock = threading.Lock()
+
+    def filename_for(self, period):
+        return 'sales-{}.db{}'.format(period, '.gz' if self.compress else '')
+
+    def path_for(self, filename):
+        return os.path.join(self.archive_dir, filename)
+
+    def write(self, period, tables):
+        """写入月份的归档文件，tables 为 {表名: 行列表}（字段顺序同 ARCHIVE_SCHEMA），返回文件名
+
+        先写入临时文件再改名，已存在的同名归档被整体替换
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        filename = self.filename_for(period)
+        db_path = self.path_for('sales-{}.db.tmp'.format(period))
+        if os.path.exists(db_path):
+            os.remove(db_path)
+
+        conn = sqlite3.connect(db_path)
+        try:
+            cursor = conn.cursor()
+            for table, (columns, ddl) in ARCHIVE_SCHEMA.items():
+                cursor.execute(ddl)
+                cursor.executemany('INSERT INTO {} ({}) VALUES ({})'.format(
+                    table, ', '.join(columns), ', '.join('?' * len(columns))), tables.get(table, []))
+            for ddl in ARCHIVE_INDEXES:
+                cursor.execute(ddl)
+            conn.commit()
+            cursor.execute('ANALYZE')
+            conn.commit()
+        finally:
+            conn.close()
+
+        target = self.path_for(filename)
+        if self.compress:
+            with open(db_path, 'rb') as source, gzip.open(target + '.tmp', 'wb') as compressed:
+                shutil.copyfileobj(source, compressed)
+            os.remove(db_path)
+            os.replace(target + '.tmp', target)
+        else:
+            os.replace(db_path, target)
+        return filename
+
+    def read_rows(self, filename, table):
+        """读取归档文件中某个表的全部行（合并重复归档时使用）"""
+        columns = ARCHIVE_SCHEMA[table][0]
+        conn = self.connect(filename)
+        try:
+            return conn.execute('SELECT {} FROM {} ORDER BY id'.format(', '.join(columns), table)).fetchall()
+        finally:
+            conn.close()
+
+    def connect(self, filename):
+        """以只读方式打开归档文件；压缩的归档先解压到缓存目录"""
+        path = self.path_for(filename)
+        if filename.endswith('.gz'):
+            path = self._decompressed(path)
+        return sqlite3.connect('file:{}?mode=ro'.format(os.path.abspath(path)), uri=True)
+
+    def remove(self, filename):
+        for path in (self.path_for(filename), os.path.join(self.cache_dir, filename[:-3])):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _decompressed(self, path):
+        cached = os.path.join(self.cache_dir, os.path.basename(path)[:-3])
+        with self._lock:
+            if not os.path.exists(cached) or os.path.getmtime(cached) < os.path.getmtime(path):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with gzip.open(path, 'rb') as source, open(cached + '.tmp', 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                os.replace(cached + '.tmp', cached)
+        return cached
@@ -0,0 +1,217 @@
+"""
+ASGI 入口
+在事件循环中接收连接和请求体，Flask 应用在线程池中执行，流式响应逐块在线程池中生成后再发送。
+等待请求体和发送响应时不占用线程；流式响应生成下一块时占用一个线程，因此长时间推送的连接（SSE）
+在整个连接期间各占用一个线程。耗时的请求（整表导出、报表、管理接口）和推送连接分别使用单独的线程池，
+不会占满收银扫码等即时请求所用的线程；客户端断开后停止生成并关闭响应
+
+运行方式：pip install uvicorn 后执行 uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import contextvars
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from analytics import TIMELINE_STREAM_CLIENTS
+from app import app
+
+# 即时请求和耗时请求的线程数
+ASGI_WORKERS = int(os.environ.get('ASGI_WORKERS', 32))
+ASGI_BULK_WORKERS = int(os.environ.get('ASGI_BULK_WORKERS', 4))
+# 推送连接的线程数，不少于同时打开的推送连接数上限
+ASGI_STREAM_WORKERS = int(os.environ.get('ASGI_STREAM_WORKERS', TIMELINE_STREAM_CLIENTS))
+
+# 使用耗时请求线程池的路径：(方法, 路径前缀)，方法为 None 时匹配所有方法
+BULK_ROUTES = (
+    ('GET', '/api/sales'),
+    ('GET', '/api/transactions'),
+    (None, '/api/reports/'),
+    (None, '/api/admin/'),
+)
+
+# 持续推送（不会自行结束）的路径，使用推送线程池
+STREAM_ROUTES = (
+    ('GET', '/api/analytics/timeline/stream'),
+)
+
+
+def is_bulk_request(method, path, query_string):
+    """整表导出、流式输出、报表和管理接口视为耗时请求"""
+    if b'stream=' in query_string:
+        return True
+    return any((route_method is None or route_method == method) and path.startswith(prefix)
+               for route_method, prefix in BULK_ROUTES)
+
+
+def is_stream_request(method, path):
+    """持续推送的连接（SSE）"""
+    return any(route_method == method and path == route_path for route_method, route_path in STREAM_ROUTES)
+
+
+def build_environ(scope, body):
+    """按 PEP 3333 由 ASGI 请求信息构造 WSGI environ"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'CONTENT_LENGTH': str(len(body)),
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+            continue
+        if name == 'CONTENT_LENGTH':
+            continue
+        key = 'HTTP_' + name
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+class ASGIApplication:
+    """将 WSGI 应用包装为 ASGI 应用"""
+
+    def __init__(self, wsgi_app, workers=ASGI_WORKERS, bulk_workers=ASGI_BULK_WORKERS,
+                 stream_workers=ASGI_STREAM_WORKERS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='asgi')
+        self.bulk_executor = ThreadPoolExecutor(max_workers=bulk_workers, thread_name_prefix='asgi-bulk')
+        self.stream_executor = ThreadPoolExecutor(max_workers=stream_workers, thread_name_prefix='asgi-stream')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self.handle_http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                self.bulk_executor.shutdown(wait=False)
+                self.stream_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def handle_http(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.extend(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+
+        if is_stream_request(scope['method'], scope['path']):
+            executor = self.stream_executor
+        elif is_bulk_request(scope['method'], scope['path'], scope['query_string']):
+            executor = self.bulk_executor
+        else:
+            executor = self.executor
+        loop = asyncio.get_running_loop()
+        # 同一请求的所有步骤在同一个上下文中执行（Flask 请求上下文基于 contextvars，流式响应跨多个线程生成）
+        context = contextvars.copy_context()
+
+        def run(func, *args):
+            return loop.run_in_executor(executor, context.run, func, *args)
+
+        response_start = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response_start.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response_start['status'] = int(status.split(' ', 1)[0])
+            response_start['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                         for name, value in headers]
+            response_start['buffered'] = any(name.lower() == 'content-length' for name, _ in headers)
+            return written.append
+
+        def call_app(environ):
+            iterable = self.wsgi_app(environ, start_response)
+            if not response_start.get('buffered'):
+                return iterable, None
+            # 带 Content-Length 的响应已在内存中生成，在同一个线程中取出全部内容
+            try:
+                return None, b''.join(written + list(iterable))
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+
+        iterable, content = await run(call_app, build_environ(scope, bytes(body)))
+        if iterable is None:
+            await self._send_start(send, response_start)
+            await send({'type': 'http.response.body', 'body': content})
+            return
+
+        # 请求体已读完，之后收到的消息只有 http.disconnect
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        pending = None
+        try:
+            iterator = iter(iterable)
+            pending = run(next, iterator, None)
+            await asyncio.wait((pending, disconnected), return_when=asyncio.FIRST_COMPLETED)
+            if disconnected.done():
+                return
+            chunk, pending = pending.result(), None
+            await self._send_start(send, response_start)
+            for data in written:
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                pending = run(next, iterator, None)
+                await asyncio.wait((pending, disconnected), return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    return
+                chunk, pending = pending.result(), None
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            if pending is not None:
+                # 客户端已断开：生成器正在线程中执行时不能关闭，等这一块生成完后丢弃
+                await asyncio.wait((pending,))
+                if not pending.cancelled():
+                    pending.exception()
+            if hasattr(iterable, 'close'):
+                await run(iterable.close)
+
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    @staticmethod
+    async def _send_start(send, response_start):
+        response_start['sent'] = True
+        await send({
+            'type': 'http.response.start',
+            'status': response_start['status'],
+            'headers': response_start['headers'],
+        })
+
+
+application = ASGIApplication(app)
@@ -0,0 +1,238 @@
+"""
+静态资源内存缓存与压缩
+启动时预先读取页面/样式文件并生成 gzip/brotli 压缩版本，按文件修改时间失效；
+为每个文件计算内容哈希，用于强ETag和带哈希的长期缓存URL；
+同时提供API响应的压缩协商
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import time
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖
+    brotli = None
+
+# 超过该字节数的响应才进行压缩
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+
+# 超过该字节数的文件不放入内存缓存
+ASSET_MAX_CACHE_SIZE = 4 * 1024 * 1024
+
+# 两次检查文件修改时间之间的最小间隔（秒），间隔内直接使用内存中的内容
+ASSET_CHECK_INTERVAL = float(os.environ.get('ASSET_CHECK_INTERVAL', 2))
+
+# 带哈希URL中使用的内容哈希长度
+ASSET_HASH_LENGTH = 12
+
+# 带哈希的文件名，如 css/style.0123456789ab.css
+HASHED_NAME_RE = re.compile(r'^(?P<stem>.+)\.(?P<hash>[0-9a-f]{%d})(?P<ext>\.[A-Za-z0-9]+)$' % ASSET_HASH_LENGTH)
+
+# 页面中引用的静态文件，如 href="/static/css/style.css"
+STATIC_REF_RE = re.compile(rb'(href|src)="/static/([^"?#]+)"')
+
+CACHE_CONTROL_IMMUTABLE = 'public, max-age=31536000, immutable'
+CACHE_CONTROL_REVALIDATE = 'no-cache'
+
+COMPRESSIBLE_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript',
+    'application/javascript', 'application/json', 'application/x-ndjson',
+    'image/svg+xml',
+}
+
+
+def available_encodings():
+    """返回服务器支持的压缩编码（按优先级）"""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate_encoding(accept_encoding):
+    """根据 Accept-Encoding 请求头选择压缩编码，不支持时返回 None"""
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for part in accept_encoding.split(','):
+        pieces = part.strip().split(';')
+        coding = pieces[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in pieces[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+
+    best = None
+    best_quality = 0.0
+    for coding in available_encodings():
+        quality = accepted.get(coding, accepted.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress(data, encoding, static=False):
+    """压缩数据；静态资源使用最高压缩级别，动态响应优先速度"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if static else 4)
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=9 if static else 6, mtime=0)
+    return data
+
+
+def is_compressible(mimetype):
+    """判断该类型的内容是否值得压缩"""
+    return mimetype in COMPRESSIBLE_MIMETYPES or (mimetype or '').startswith('text/')
+
+
+def asset_path(root, relpath):
+    """相对路径对应的磁盘路径，路径不安全时返回 None
+
+    static/ 开头的路径必须仍在 static 目录内（不能通过 .. 访问数据库、源码等文件），
+    其余路径只允许根目录下的文件名（页面及 sw.js）
+    """
+    directory, _, name = relpath.partition('/')
+    if not name:
+        return safe_join(root, relpath) if relpath not in ('', '.', '..') else None
+    if directory != 'static':
+        return None
+    return safe_join(os.path.join(root, 'static'), name)
+
+
+class Asset:
+    """单个已缓存的静态文件及其压缩版本"""
+
+    def __init__(self, path, mtime, data, mimetype, dependencies=None):
+        self.path = path
+        self.mtime = mtime
+        self.data = data
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(data).hexdigest()
+        # 页面中已改写为哈希URL的静态文件：{相对路径: 内容哈希}
+        self.dependencies = dependencies or {}
+        self.checked_at = time.monotonic()
+        self.variants = {}
+        if is_compressible(mimetype) and len(data) >= COMPRESS_MIN_SIZE:
+            for encoding in available_encodings():
+                compressed = compress(data, encoding, static=True)
+                if len(compressed) < len(data):
+                    self.variants[encoding] = compressed
+
+    def body_for(self, encoding):
+        """返回指定编码的内容；没有对应压缩版本时返回原始内容"""
+        if encoding and encoding in self.variants:
+            return self.variants[encoding], encoding
+        return self.data, None
+
+    def etag_for(self, encoding):
+        """强ETag：不同压缩编码的内容使用不同的ETag"""
+        suffix = {'gzip': '-gz', 'br': '-br'}.get(encoding, '')
+        return self.digest[:ASSET_HASH_LENGTH * 2] + suffix
+
+
+class AssetCache:
+    """以相对路径为键的静态文件缓存，文件修改时间变化时重新加载"""
+
+    def __init__(self, root):
+        self.root = root
+        self._assets = {}
+        self._lock = threading.RLock()
+
+    def get(self, relpath):
+        """获取缓存的文件；文件不存在或过大时返回 None"""
+        path = asset_path(self.root, relpath)
+        if path is None:
+            return None
+        # 以规范化后的路径为键，同一文件的不同写法共用一个缓存项
+        relpath = os.path.relpath(path, self.root).replace(os.sep, '/')
+        asset = self._assets.get(relpath)
+        if asset is not None and time.monotonic() - asset.checked_at < ASSET_CHECK_INTERVAL:
+            return asset
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._assets.pop(relpath, None)
+            return None
+        if not os.path.isfile(path) or stat.st_size > ASSET_MAX_CACHE_SIZE:
+            return None
+
+        with self._lock:
+            asset = self._assets.get(relpath)
+            if asset is None or asset.mtime != stat.st_mtime or self._dependencies_changed(asset):
+                asset = self._load(path, stat.st_mtime)
+                self._assets[relpath] = asset
+            else:
+                asset.checked_at = time.monotonic()
+        return asset
+
+    def resolve(self, relpath):
+        """解析请求路径，支持带哈希的文件名；返回 (asset, 是否为当前哈希URL)"""
+        asset = self.get(relpath)
+        if asset is not None:
+            return asset, False
+        match = HASHED_NAME_RE.match(relpath)
+        if match is None:
+            return None, False
+        asset = self.get(match.group('stem') + match.group('ext'))
+        if asset is None:
+            return None, False
+        # 旧哈希仍返回最新内容，但不允许长期缓存
+        return asset, asset.digest.startswith(match.group('hash'))
+
+    def hashed_url(self, relpath):
+        """返回带内容哈希的URL路径，文件不在缓存中时返回原路径"""
+        asset = self.get(relpath)
+        if asset is None:
+            return '/' + relpath
+        stem, ext = os.path.splitext(relpath)
+        return '/{}.{}{}'.format(stem, asset.digest[:ASSET_HASH_LENGTH], ext)
+
+    def preload(self, relpaths):
+        """启动时预先加载并压缩文件，返回成功加载的数量"""
+        loaded = 0
+        for relpath in relpaths:
+            try:
+                if self.get(relpath) is not None:
+                    loaded += 1
+            except Exception as e:
+                print(f"Error preloading asset {relpath}: {e}")
+        return loaded
+
+    def _load(self, path, mtime):
+        """读取文件；页面中的静态文件引用改写为带哈希的URL"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        dependencies = {}
+        if mimetype == 'text/html':
+            data = self._rewrite_static_refs(data, dependencies)
+        return Asset(path, mtime, data, mimetype, dependencies)
+
+    def _rewrite_static_refs(self, data, dependencies):
+        def replace(match):
+            relpath = 'static/' + match.group(2).decode('utf-8')
+            asset = self.get(relpath)
+            if asset is None:
+                return match.group(0)
+            dependencies[relpath] = asset.digest
+            return match.group(1) + b'="' + self.hashed_url(relpath).encode('utf-8') + b'"'
+        return STATIC_REF_RE.sub(replace, data)
+
+    def _dependencies_changed(self, asset):
+        for relpath, digest in asset.dependencies.items():
+            dependency = self.get(relpath)
+            if dependency is None or dependency.digest != digest:
+                return True
+        return False
@@ -0,0 +1,234 @@
+"""
+按收银台划分的购物车（临时销售）存储
+购物车保存在内存中，增删清空都只操作单个收银台的购物车；
+变更由后台线程批量写回 temp_sales 表，进程重启时从表中恢复。
+加入购物车时同步预留库存，删除/清空时释放，结算时转为实际扣减；
+过期的预留由后台任务调用 expire_reservations 释放并从购物车中移除对应记录
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+from database import RESERVATION_TTL_SECONDS
+
+# 默认收银台（未携带 X-Terminal-Id 的旧客户端共用）
+DEFAULT_TERMINAL = 'default'
+
+# 每次预留的记录id数量
+ID_BLOCK_SIZE = 100
+
+
+class CartStore:
+    """内存购物车 + 写回（write-behind）到 SQLite"""
+
+    def __init__(self, db, flush_interval=1.0, reservation_ttl=RESERVATION_TTL_SECONDS):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.reservation_ttl = reservation_ttl
+        self._carts = {}  # terminal_id -> {item_id: item}（按加入顺序）
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # 保证变更按顺序写入
+        self._dirty = {}  # item_id -> item（待写入）
+        self._deleted = set()  # 待删除的 item_id
+        self._next_id = 0
+        self._id_limit = 0
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+
+        for item in db.load_temp_sales():
+            self._carts.setdefault(item['terminal_id'], {})[item['id']] = item
+        # 上次退出前未写回的购物车记录已丢失，释放其预留（其他工作进程近期有操作的预留不受影响）
+        db.release_orphan_reservations(ttl_seconds=reservation_ttl)
+
+        self._flusher = threading.Thread(target=self._flush_loop, name='cart-store-flusher', daemon=True)
+        self._flusher.start()
+
+    def _allocate_id(self):
+        if self._next_id >= self._id_limit:
+            self._next_id = self.db.reserve_temp_sale_ids(ID_BLOCK_SIZE)
+            self._id_limit = self._next_id + ID_BLOCK_SIZE
+        item_id = self._next_id
+        self._next_id += 1
+        return item_id
+
+    def _mark_deleted(self, item_id):
+        self._dirty.pop(item_id, None)
+        self._deleted.add(item_id)
+
+    def _release(self, items):
+        """释放已移出购物车的记录的预留；失败时由过期检查兜底释放"""
+        try:
+            self.db.release_reservations(item['id'] for item in items)
+        except Exception as e:
+            print(f"Error releasing stock reservations: {e}")
+
+    def get_items(self, terminal_id):
+        """获取收银台购物车中的记录（最新加入的在前）"""
+        with self._lock:
+            cart = self._carts.get(terminal_id)
+            return [dict(item) for item in reversed(cart.values())] if cart else []
+
+    def get_item(self, terminal_id, item_id):
+        """获取购物车中的单条记录"""
+        with self._lock:
+            item = self._carts.get(terminal_id, {}).get(item_id)
+            return dict(item) if item else None
+
+    def add_item(self, terminal_id, barcode, name, quantity, price, total_price):
+        """向购物车添加一条记录并预留库存，返回该记录；可售数量不足时返回 None"""
+        with self._lock:
+            item_id = self._allocate_id()
+        if not self.db.reserve_stock(item_id, terminal_id, barcode, quantity, self.reservation_ttl):
+            return None
+
+        with self._lock:
+            item = {
+                'id': item_id,
+                'barcode': barcode,
+                'name': name,
+                'quantity': quantity,
+                'price': price,
+                'total_price': total_price,
+                'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'terminal_id': terminal_id,
+            }
+            self._carts.setdefault(terminal_id, {})[item['id']] = item
+            self._dirty[item['id']] = item
+        self._wakeup.set()
+        return dict(item)
+
+    def remove_item(self, terminal_id, item_id):
+        """从购物车删除一条记录，返回被删除的记录；不存在时返回 None"""
+        with self._lock:
+            cart = self._carts.get(terminal_id)
+            item = cart.pop(item_id, None) if cart else None
+            if item is None:
+                return None
+            if not cart:
+                del self._carts[terminal_id]
+            self._mark_deleted(item_id)
+        self._wakeup.set()
+        self._release([item])
+        return item
+
+    def clear(self, terminal_id):
+        """清空收银台的购物车，返回被删除的记录"""
+        with self._lock:
+            cart = self._carts.pop(terminal_id, None)
+            if not cart:
+                return []
+            for item_id in cart:
+                self._mark_deleted(item_id)
+        self._wakeup.set()
+        self._release(cart.values())
+        return list(cart.values())
+
+    def keepalive(self, terminal_id):
+        """延长收银台购物车的库存预留，返回预留数量"""
+        return self.db.extend_reservations(terminal_id, self.reservation_ttl)
+
+    def checkout(self, terminal_id, cashier=None, received_amount=None):
+        """将收银台的购物车结算为一笔交易并清空已结算的记录，返回交易id；购物车为空时返回 None
+
+        交易的 client_ref 为 temp-cart-<最新记录id>，与 temp_pos.html 离线结算时使用的一致，
+        两条路径不会重复记录同一个购物车；可售数量不足时抛出 ValueError
+        """
+        items = self.get_items(terminal_id)
+        if not items:
+            return None
+        transaction_id = self.db.checkout_cart(
+            list(reversed(items)), cashier=cashier, terminal_id=terminal_id,
+            received_amount=received_amount, client_ref='temp-cart-{}'.format(items[0]['id'])
+        )
+
+        # 预留已在结算事务中转为扣减，只需移出购物车；结算期间新加入的记录保留
+        with self._lock:
+            cart = self._carts.get(terminal_id, {})
+            for item in items:
+                if cart.pop(item['id'], None) is not None:
+                    self._mark_deleted(item['id'])
+            if not cart:
+                self._carts.pop(terminal_id, None)
+        self._wakeup.set()
+        return transaction_id
+
+    def expire(self, hours=24):
+        """删除所有收银台中超过指定小时数的记录，返回被删除的记录"""
+        cutoff = (datetime.now() - timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S')
+        expired = []
+        with self._lock:
+            for terminal_id in list(self._carts):
+                cart = self._carts[terminal_id]
+                for item_id in [item_id for item_id, item in cart.items() if item['date'] < cutoff]:
+                    expired.append(cart.pop(item_id))
+                    self._mark_deleted(item_id)
+                if not cart:
+                    del self._carts[terminal_id]
+        if expired:
+            self._wakeup.set()
+            self._release(expired)
+        return expired
+
+    def expire_reservations(self):
+        """释放已过期的库存预留并从购物车中移除对应记录，返回被移除的记录"""
+        released = self.db.expire_reservations()
+        removed = []
+        with self._lock:
+            for item_id, terminal_id in released:
+                cart = self._carts.get(terminal_id)
+                item = cart.pop(item_id, None) if cart else None
+                if item is None:
+                    continue
+                removed.append(item)
+                self._mark_deleted(item_id)
+                if not cart:
+                    del self._carts[terminal_id]
+        if removed:
+            self._wakeup.set()
+        return removed
+
+    def flush(self):
+        """将待写入的变更写回数据库，失败时保留变更等待下次重试"""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            if not self._dirty and not self._deleted:
+                return 0
+            upserts = list(self._dirty.values())
+            deleted_ids = list(self._deleted)
+            self._dirty = {}
+            self._deleted = set()
+
+        try:
+            self.db.save_temp_sale_changes([dict(item) for item in upserts], deleted_ids)
+        except Exception as e:
+            print(f"Error flushing temporary sales: {e}")
+            with self._lock:
+                # 期间有新变更的记录以新变更为准
+                for item in upserts:
+                    if item['id'] not in self._deleted:
+                        self._dirty.setdefault(item['id'], item)
+                for item_id in deleted_ids:
+                    if item_id not in self._dirty:
+                        self._deleted.add(item_id)
+            self._wakeup.set()
+            return 0
+        return len(upserts) + len(deleted_ids)
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # 合并短时间内的多次变更后再写入
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        """停止后台线程并写回剩余变更"""
+        self._stop.set()
+        self._wakeup.set()
+        self._flusher.join(timeout=5)
+        self.flush()
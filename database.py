@@ -2,17 +2,151 @@ import sqlite3
 import json
 import os
 import bcrypt
-from datetime import datetime
+import time
+import glob
+import re
+import threading
+from functools import partial
+from datetime import datetime, date, timedelta
+
+from archive import SalesArchive, ARCHIVE_SCHEMA, month_bounds, archive_cutoff
+from export import ColumnarExport, EXPORT_BATCH_ROWS, EXPORT_SCHEMA
+from storage import SQLiteBackend
+import pricing
+from forecasting import (DemandState, FORECAST_HISTORY_DAYS, MOVING_AVERAGE_DAYS, service_level_z,
+                         reorder_suggestion)
+
+# 各表对外输出的字段（按查询列顺序）
+PRODUCT_COLUMNS = ('id', 'barcode', 'name', 'category', 'quantity', 'cost_price', 'selling_price', 'profit_margin',
+                   'reserved_quantity', 'available_quantity', 'low_stock_threshold', 'effective_low_stock_threshold',
+                   'version')
+SALE_COLUMNS = ('id', 'barcode', 'name', 'quantity', 'price', 'total_price', 'cost_price', 'date')
+TRANSACTION_COLUMNS = ('id', 'cashier', 'terminal_id', 'line_count', 'item_count', 'total_price', 'total_cost',
+                       'received_amount', 'date')
+TEMP_SALE_COLUMNS = ('id', 'barcode', 'name', 'quantity', 'price', 'total_price', 'date', 'terminal_id')
+
+# 产品查询的字段表达式：可售数量由库存减去购物车预留得出
+PRODUCT_SELECT = ', '.join(
+    'quantity - reserved_quantity AS available_quantity' if column == 'available_quantity' else column
+    for column in PRODUCT_COLUMNS
+)
+
+# 可按字段修改的产品属性（利润率由成本价和售价计算）
+PRODUCT_EDITABLE_COLUMNS = ('barcode', 'name', 'category', 'quantity', 'cost_price', 'selling_price',
+                            'low_stock_threshold')
+
+# 产品、类别和全局都未设置低库存阈值时使用的阈值
+DEFAULT_LOW_STOCK_THRESHOLD = 10
+LOW_STOCK_ALERT_COLUMNS = ('id', 'product_id', 'barcode', 'name', 'category', 'quantity', 'threshold', 'created_at')
+
+# 产品目录统计：由触发器随产品的增删改增量维护的累计值，以及用于全量重算的聚合查询
+PRODUCT_STATS_COLUMNS = ('product_count', 'total_quantity', 'cost_value', 'selling_value', 'low_stock_count',
+                         'out_of_stock_count')
+PRODUCT_STATS_TERMS = (
+    ('product_count', '1'),
+    ('total_quantity', '{row}.quantity'),
+    ('cost_value', '{row}.cost_price * {row}.quantity'),
+    ('selling_value', '{row}.selling_price * {row}.quantity'),
+    ('low_stock_count', 'CASE WHEN {row}.quantity <= {row}.effective_low_stock_threshold THEN 1 ELSE 0 END'),
+    ('out_of_stock_count', 'CASE WHEN {row}.quantity <= 0 THEN 1 ELSE 0 END'),
+)
+PRODUCT_STATS_QUERY = 'SELECT {} FROM products'.format(', '.join(
+    'COALESCE(SUM({}), 0)'.format(term.format(row='products')) for _, term in PRODUCT_STATS_TERMS))
+
+# 流式读取时每次从游标取出的行数
+STREAM_BATCH_SIZE = 500
+
+# 购物车库存预留的有效期（秒），收银台有操作时自动延长
+RESERVATION_TTL_SECONDS = int(os.environ.get('RESERVATION_TTL_SECONDS', 900))
+# 启动时只释放超过该秒数未续期的无主预留：其他工作进程尚未写回的购物车记录最近仍有操作，不会被误释放
+ORPHAN_RESERVATION_IDLE_SECONDS = int(os.environ.get('ORPHAN_RESERVATION_IDLE_SECONDS', 120))
+
+# 存储维护：空闲页占比超过该值时才执行增量清理
+VACUUM_FREE_RATIO_THRESHOLD = 0.1
+# 每步增量清理释放的页数，以及单次维护的时间上限（秒）
+VACUUM_PAGES_PER_STEP = 256
+MAINTENANCE_TIME_BUDGET = 0.5
+# 近似 ANALYZE 时每个索引最多检查的行数，保证耗时可控
+ANALYSIS_LIMIT = 1000
+# 表增长统计快照的保留天数
+STORAGE_STATS_RETENTION_DAYS = 90
+AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+
+# 销售归档：主数据库保留最近几个月（含当月）的数据，更早的月份移入归档文件
+ARCHIVE_HOT_MONTHS = int(os.environ.get('ARCHIVE_HOT_MONTHS', 3))
+ARCHIVE_COMPRESS = os.environ.get('ARCHIVE_COMPRESS', '0') == '1'
+ARCHIVE_PERIOD_COLUMNS = ('period', 'filename', 'sales_count', 'transaction_count', 'min_transaction_id',
+                          'max_transaction_id', 'total_price', 'archived_at')
+PERIOD_RE = re.compile(r'^\d{4}-\d{2}$')
+
+# 报表快照：报表和汇总查询读取定期从主库复制的只读快照，不与收银写入争用主库；
+# 每次检查主库自上次复制以来是否有提交，没有变化时不复制
+REPORT_SNAPSHOT_INTERVAL = int(os.environ.get('REPORT_SNAPSHOT_INTERVAL', 60))
+SALES_SUMMARY_GROUPS = {
+    'day': 'substr(date, 1, 10)',
+    'month': 'substr(date, 1, 7)',
+    'product': 'barcode',
+}
+
+# 日结（Z报表）：日结时按索引汇总当天的交易、销售和作废记录，冻结保存到只读的快照表
+Z_REPORT_COLUMNS = ('id', 'business_date', 'closed_at', 'closed_by', 'transaction_count', 'item_count',
+                    'revenue', 'cost', 'profit', 'profit_margin', 'void_count', 'void_quantity', 'void_amount',
+                    'stock_quantity', 'stock_cost_value', 'stock_selling_value')
+Z_REPORT_CASHIER_COLUMNS = ('cashier', 'transaction_count', 'item_count', 'revenue', 'cost', 'profit',
+                            'void_count', 'void_amount')
+Z_REPORT_PRODUCT_COLUMNS = ('barcode', 'name', 'quantity_sold', 'revenue', 'cost', 'quantity_voided',
+                            'closing_quantity')
+Z_REPORT_TABLES = ('z_reports', 'z_report_cashiers', 'z_report_products')
+BUSINESS_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+class DayClosedError(ValueError):
+    """营业日已经日结"""
+
+
+class VersionConflictError(ValueError):
+    """产品在客户端读取之后已被修改（版本号不一致），current 为当前的产品"""
+
+    def __init__(self, message, current):
+        super().__init__(message)
+        self.current = current
+
 
 class POSDatabase:
-    def __init__(self, db_path="pos_system.db"):
+    def __init__(self, db_path="pos_system.db", archive_dir=None, report_path=None, backend=None):
         self.db_path = db_path
+        self.backend = backend or SQLiteBackend(db_path)
+        self.report_path = report_path or os.path.splitext(db_path)[0] + '.report.db'
+        # 检测主库变化的常驻连接，及上次复制快照时主库的 data_version
+        self._watch_conn = None
+        self._report_data_version = None
+        self._report_lock = threading.Lock()
+        self.archive = SalesArchive(
+            archive_dir or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'archive'),
+            compress=ARCHIVE_COMPRESS
+        )
+        # 销售监听：提交后以 (事件, 销售记录列表) 调用，事件为 'add' 或 'delete'
+        self.sale_listeners = []
         self.init_database()
     
+    def add_sale_listener(self, listener):
+        """注册销售监听（如实时销售分析）"""
+        self.sale_listeners.append(listener)
+    
+    def _notify_sales(self, event, sales):
+        """在事务提交后通知销售监听，监听出错不影响销售本身"""
+        if not sales:
+            return
+        for listener in self.sale_listeners:
+            try:
+                listener(event, sales)
+            except Exception as e:
+                print(f"Error notifying sale listener: {e}")
+    
     @staticmethod
     def hash_password(password):
         """哈希密码"""
-        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
     
     @staticmethod
     def verify_password(password, hashed):
@@ -21,11 +155,30 @@ class POSDatabase:
             hashed = hashed.encode('utf-8')
         return bcrypt.checkpw(password.encode('utf-8'), hashed)
     
+    def _connect(self):
+        """从存储后端获取数据库连接（启用外键约束）"""
+        return self.backend.connect()
+    
+    def _require_sqlite(self, feature):
+        """只适用于 SQLite 数据库文件的功能（WAL、清理、文件备份、归档等）"""
+        if self.backend.dialect != 'sqlite':
+            raise NotImplementedError(f'{feature} requires the SQLite backend')
+    
     def init_database(self):
         """初始化数据库表"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
+        sqlite = self.backend.dialect == 'sqlite'
+        if sqlite:
+            # 新数据库在创建任何表之前启用增量清理（旧数据库由 migrate_auto_vacuum 转换）
+            cursor.execute('PRAGMA page_count')
+            if cursor.fetchone()[0] == 0:
+                cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            
+            # 使用WAL日志模式：读写互不阻塞，由后台任务定期执行检查点
+            cursor.execute('PRAGMA journal_mode = WAL')
+        
         # 创建用户表
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -54,6 +207,86 @@ class POSDatabase:
             )
         ''')
         
+        # 购物车中已预留（尚未结算）的数量
+        self._ensure_column(cursor, 'products', 'reserved_quantity', 'INTEGER NOT NULL DEFAULT 0')
+        # 行版本号：产品属性或库存每次修改时加1，用于修改产品时的比较并交换（乐观并发控制）
+        self._ensure_column(cursor, 'products', 'version', 'INTEGER NOT NULL DEFAULT 1')
+        
+        # 产品搜索的全文索引（名称、类别）
+        self.fts_enabled = self._create_product_search_index(cursor)
+
+        # 低库存阈值：产品未设置时依次使用类别阈值、全局阈值；生效的阈值预先计算保存在产品行中
+        self._ensure_column(cursor, 'products', 'low_stock_threshold', 'INTEGER')
+        thresholds_added = self._ensure_column(
+            cursor, 'products', 'effective_low_stock_threshold',
+            'INTEGER NOT NULL DEFAULT {}'.format(DEFAULT_LOW_STOCK_THRESHOLD))
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS low_stock_thresholds (
+                scope TEXT NOT NULL CHECK (scope IN ('global', 'category')),
+                category TEXT NOT NULL DEFAULT '',
+                threshold INTEGER NOT NULL CHECK (threshold >= 0),
+                PRIMARY KEY (scope, category)
+            )
+        ''')
+        # 低库存查询按 库存 - 阈值 的表达式索引读取，不扫描全表
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_products_low_stock
+            ON products((quantity - effective_low_stock_threshold))
+        ''')
+        if thresholds_added:
+            self._refresh_effective_thresholds(cursor)
+
+        # 产品目录统计的累计值（依赖生效的低库存阈值）
+        self.stats_enabled = self._create_product_stats(cursor)
+
+        # 库存从阈值以上降到阈值及以下时记录的低库存提醒
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS low_stock_alerts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+                quantity INTEGER NOT NULL,
+                threshold INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+            )
+        ''')
+
+        # 各产品需求预测的平滑状态，through_day 为已计入的最后一天（日序数）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS demand_forecasts (
+                product_id INTEGER PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,
+                level REAL NOT NULL,
+                square REAL NOT NULL,
+                first_day INTEGER NOT NULL,
+                through_day INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+            )
+        ''')
+
+        # 实时销售分析计数器的保存点：各分桶的累计值，以及保存时已计入的销售id
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sales_analytics_buckets (
+                granularity TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                barcode TEXT NOT NULL,
+                name TEXT,
+                quantity INTEGER NOT NULL,
+                revenue REAL NOT NULL,
+                PRIMARY KEY (granularity, bucket, barcode)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sales_analytics_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                last_sale_id INTEGER NOT NULL,
+                applied_ids TEXT NOT NULL,
+                last_void_id INTEGER,
+                applied_void_ids TEXT,
+                saved_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+            )
+        ''')
+        self._ensure_column(cursor, 'sales_analytics_state', 'last_void_id', 'INTEGER')
+        self._ensure_column(cursor, 'sales_analytics_state', 'applied_void_ids', 'TEXT')
+
         # 创建销售记录表
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS sales (
@@ -64,10 +297,18 @@ class POSDatabase:
                 price REAL NOT NULL,
                 total_price REAL NOT NULL,
                 cost_price REAL NOT NULL,
-                date TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+                date TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+                client_ref TEXT
             )
         ''')
         
+        # 离线同步的销售记录以客户端生成的 client_ref 去重
+        self._ensure_column(cursor, 'sales', 'client_ref', 'TEXT')
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_sales_client_ref
+            ON sales(client_ref) WHERE client_ref IS NOT NULL
+        ''')
+        
         # 创建临时销售表
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS temp_sales (
@@ -77,15 +318,306 @@ class POSDatabase:
                 quantity INTEGER NOT NULL,
                 price REAL NOT NULL,
                 total_price REAL NOT NULL,
-                date TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+                date TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+                terminal_id TEXT NOT NULL DEFAULT 'default'
+            )
+        ''')
+        
+        # 临时销售按收银台划分（旧数据归入 default 收银台）
+        self._ensure_column(cursor, 'temp_sales', 'terminal_id', "TEXT NOT NULL DEFAULT 'default'")
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_temp_sales_terminal ON temp_sales(terminal_id)')
+        
+        # 创建库存预留表：购物车中的每条记录预留对应产品的库存，过期后由后台线程释放
+        reservations_existed = self.backend.table_exists(cursor, 'stock_reservations')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stock_reservations (
+                temp_sale_id INTEGER PRIMARY KEY,
+                terminal_id TEXT NOT NULL,
+                product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+                quantity INTEGER NOT NULL CHECK (quantity > 0),
+                expires_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_stock_reservations_expires_at ON stock_reservations(expires_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_stock_reservations_terminal ON stock_reservations(terminal_id)')
+        if not reservations_existed:
+            self.migrate_temp_sales_to_reservations(cursor)
+        
+        # 创建交易（小票）表，每笔交易的明细行关联到 sales 中的记录
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS transactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                cashier TEXT,
+                terminal_id TEXT,
+                line_count INTEGER NOT NULL DEFAULT 0,
+                item_count INTEGER NOT NULL DEFAULT 0,
+                total_price REAL NOT NULL DEFAULT 0,
+                total_cost REAL NOT NULL DEFAULT 0,
+                received_amount REAL,
+                date TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+                client_ref TEXT UNIQUE
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions(date)')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS transaction_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                transaction_id INTEGER NOT NULL REFERENCES transactions(id) ON DELETE CASCADE,
+                sale_id INTEGER NOT NULL UNIQUE REFERENCES sales(id) ON DELETE CASCADE,
+                line_no INTEGER NOT NULL,
+                product_id INTEGER REFERENCES products(id) ON DELETE SET NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_transaction_items_transaction
+            ON transaction_items(transaction_id, line_no)
+        ''')
+        
+        # 已执行过的一次性数据迁移
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                name TEXT PRIMARY KEY,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # 将尚未归属交易的销售记录（旧数据）迁移为交易，只执行一次（之后的销售都在记录时归属交易）
+        self._run_migration(cursor, 'sales_to_transactions', self.migrate_sales_to_transactions)
+        
+        # 作废（删除）的销售记录，日结时按作废时间统计
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sale_voids (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sale_id INTEGER NOT NULL,
+                transaction_id INTEGER,
+                barcode TEXT NOT NULL,
+                name TEXT NOT NULL,
+                quantity INTEGER NOT NULL,
+                total_price REAL NOT NULL,
+                cost_price REAL NOT NULL,
+                sale_date TIMESTAMP,
+                cashier TEXT,
+                voided_by TEXT,
+                voided_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sale_voids_voided_at ON sale_voids(voided_at)')
+        
+        # 日结（Z报表）快照：写入后不可修改
+        self._create_z_report_tables(cursor)
+        
+        # 创建幂等键表（保存首次请求的响应，供重试时直接返回）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                status_code INTEGER,
+                response_body BLOB,
+                created_at REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at)')
+        
+        # 创建后台任务租约表（多个工作进程中同一任务只由一个进程执行）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS job_leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT,
+                expires_at REAL NOT NULL DEFAULT 0,
+                last_started_at REAL,
+                last_finished_at REAL,
+                last_status TEXT
+            ) WITHOUT ROWID
+        ''')
+        
+        # 创建归档分区表：记录已移入归档文件的月份
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archive_periods (
+                period TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                sales_count INTEGER NOT NULL,
+                transaction_count INTEGER NOT NULL,
+                min_transaction_id INTEGER,
+                max_transaction_id INTEGER,
+                total_price REAL NOT NULL DEFAULT 0,
+                archived_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
             )
         ''')
         
+        # 创建存储统计快照表（用于计算各表的增长速度）
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS storage_stats (
+                taken_at REAL NOT NULL,
+                table_name TEXT NOT NULL,
+                row_count INTEGER NOT NULL,
+                size_bytes INTEGER,
+                PRIMARY KEY (taken_at, table_name)
+            ) WITHOUT ROWID
+        ''')
+        
         # 初始化默认用户
         self.init_default_users(cursor)
         
         conn.commit()
         conn.close()
+        
+        if sqlite:
+            self.ensure_statistics()
+    
+    def _create_product_search_index(self, cursor):
+        """创建产品名称和类别的全文索引，返回是否可用
+        
+        使用 trigram 分词，支持任意子串（含中文）匹配；索引由触发器与 products 表同步，
+        只有名称或类别变化时才更新，库存数量的修改不涉及索引
+        """
+        if self.backend.dialect != 'sqlite':
+            return False
+        existed = self.backend.table_exists(cursor, 'products_fts')
+        try:
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+                    name, category, content='products', content_rowid='id', tokenize='trigram'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            print(f"Error creating product search index: {e}")
+            return False
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+                INSERT INTO products_fts (rowid, name, category) VALUES (new.id, new.name, new.category);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+                INSERT INTO products_fts (products_fts, rowid, name, category)
+                VALUES ('delete', old.id, old.name, old.category);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, category ON products BEGIN
+                INSERT INTO products_fts (products_fts, rowid, name, category)
+                VALUES ('delete', old.id, old.name, old.category);
+                INSERT INTO products_fts (rowid, name, category) VALUES (new.id, new.name, new.category);
+            END
+        ''')
+        if not existed:
+            cursor.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+        return True
+    
+    def _create_z_report_tables(self, cursor):
+        """创建日结快照表；SQLite 上用触发器禁止修改和删除已保存的日结"""
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS z_reports (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                business_date TEXT UNIQUE NOT NULL,
+                closed_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+                closed_by TEXT,
+                transaction_count INTEGER NOT NULL,
+                item_count INTEGER NOT NULL,
+                revenue REAL NOT NULL,
+                cost REAL NOT NULL,
+                profit REAL NOT NULL,
+                profit_margin REAL NOT NULL,
+                void_count INTEGER NOT NULL,
+                void_quantity INTEGER NOT NULL,
+                void_amount REAL NOT NULL,
+                stock_quantity INTEGER NOT NULL,
+                stock_cost_value REAL NOT NULL,
+                stock_selling_value REAL NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS z_report_cashiers (
+                report_id INTEGER NOT NULL REFERENCES z_reports(id),
+                cashier TEXT NOT NULL,
+                transaction_count INTEGER NOT NULL,
+                item_count INTEGER NOT NULL,
+                revenue REAL NOT NULL,
+                cost REAL NOT NULL,
+                profit REAL NOT NULL,
+                void_count INTEGER NOT NULL,
+                void_amount REAL NOT NULL,
+                PRIMARY KEY (report_id, cashier)
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS z_report_products (
+                report_id INTEGER NOT NULL REFERENCES z_reports(id),
+                barcode TEXT NOT NULL,
+                name TEXT NOT NULL,
+                quantity_sold INTEGER NOT NULL,
+                revenue REAL NOT NULL,
+                cost REAL NOT NULL,
+                quantity_voided INTEGER NOT NULL,
+                closing_quantity INTEGER,
+                PRIMARY KEY (report_id, barcode)
+            )
+        ''')
+        if self.backend.dialect != 'sqlite':
+            return
+        for table in Z_REPORT_TABLES:
+            for event in ('UPDATE', 'DELETE'):
+                cursor.execute('''
+                    CREATE TRIGGER IF NOT EXISTS {0}_immutable_{1} BEFORE {2} ON {0}
+                    BEGIN SELECT RAISE(ABORT, 'Z-reports are immutable'); END
+                '''.format(table, event.lower(), event))
+    
+    def _create_product_stats(self, cursor):
+        """创建产品目录统计的单行累计表及维护触发器，返回是否可用
+
+        产品的增删和库存、价格、阈值的修改由触发器在同一事务中增量更新累计值，
+        读取统计不需要扫描产品表；新建时按当前产品全量计算一次
+        """
+        if self.backend.dialect != 'sqlite':
+            return False
+        existed = self.backend.table_exists(cursor, 'product_stats')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS product_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                product_count INTEGER NOT NULL DEFAULT 0,
+                total_quantity INTEGER NOT NULL DEFAULT 0,
+                cost_value REAL NOT NULL DEFAULT 0,
+                selling_value REAL NOT NULL DEFAULT 0,
+                low_stock_count INTEGER NOT NULL DEFAULT 0,
+                out_of_stock_count INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        def assignments(*rows):
+            return ', '.join('{0} = {0} {1}'.format(column, ' '.join(
+                '{} ({})'.format(sign, term.format(row=row)) for sign, row in rows))
+                for column, term in PRODUCT_STATS_TERMS
+                if not (column == 'product_count' and len(rows) == 2))
+
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS product_stats_insert AFTER INSERT ON products BEGIN
+                UPDATE product_stats SET {} WHERE id = 1;
+            END
+        '''.format(assignments(('+', 'new'))))
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS product_stats_delete AFTER DELETE ON products BEGIN
+                UPDATE product_stats SET {} WHERE id = 1;
+            END
+        '''.format(assignments(('-', 'old'))))
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS product_stats_update
+            AFTER UPDATE OF quantity, cost_price, selling_price, effective_low_stock_threshold ON products BEGIN
+                UPDATE product_stats SET {} WHERE id = 1;
+            END
+        '''.format(assignments(('-', 'old'), ('+', 'new'))))
+        if not existed:
+            cursor.execute(PRODUCT_STATS_QUERY)
+            cursor.execute('INSERT INTO product_stats (id, {}) VALUES (1, {})'.format(
+                ', '.join(PRODUCT_STATS_COLUMNS), ', '.join('?' * len(PRODUCT_STATS_COLUMNS))), cursor.fetchone())
+        return True
+
+    def _ensure_column(self, cursor, table, column, definition):
+        """为旧数据库补充新增字段，返回是否新增了字段"""
+        if column in self.backend.column_names(cursor, table):
+            return False
+        cursor.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, definition))
+        return True
     
     def init_default_users(self, cursor):
         """初始化默认用户"""
@@ -112,71 +644,227 @@ class POSDatabase:
         """添加产品"""
         try:
             profit_margin = ((selling_price - cost_price) / selling_price) * 100
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             cursor.execute('''
                 INSERT INTO products (barcode, name, category, quantity, cost_price, selling_price, profit_margin)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             ''', (barcode, name, category, quantity, cost_price, selling_price, profit_margin))
-            
+            self._refresh_effective_thresholds(cursor, 'WHERE barcode = ?', (barcode,))
+
             conn.commit()
             conn.close()
             return True
-        except sqlite3.IntegrityError:
+        except self.backend.IntegrityError:
+            conn.close()  # 未关闭的连接会一直持有写锁
             return False  # 条码重复
         except Exception as e:
             print(f"Error adding product: {e}")
             return False
     
+    def _iter_rows(self, query, params=(), batch_size=STREAM_BATCH_SIZE, connect=None):
+        """按批从游标读取记录，连接在迭代结束后关闭；connect 用于读取归档分区"""
+        conn = (connect or self._connect)()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            conn.close()
+    
+    def iter_product_rows(self):
+        """逐条获取所有产品的原始行（字段顺序同 PRODUCT_COLUMNS）"""
+        query = 'SELECT {} FROM products ORDER BY category, name'.format(PRODUCT_SELECT)
+        return self._iter_rows(query)
+    
+    def iter_products(self):
+        """逐条获取所有产品（生成器，用于流式响应）"""
+        for row in self.iter_product_rows():
+            yield dict(zip(PRODUCT_COLUMNS, row))
+    
     def get_all_products(self):
         """获取所有产品"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM products ORDER BY category, name')
-        products = cursor.fetchall()
-        
-        conn.close()
-        
-        return [
-            {
-                'id': p[0],
-                'barcode': p[1],
-                'name': p[2],
-                'category': p[3],
-                'quantity': p[4],
-                'cost_price': p[5],
-                'selling_price': p[6],
-                'profit_margin': p[7]
-            }
-            for p in products
-        ]
+        return list(self.iter_products())
     
-    def update_product(self, product_id, barcode, name, category, quantity, cost_price, selling_price):
-        """更新产品"""
+    def reprice_products(self, filters, rule, apply=False, token=None):
+        """按规则批量调价：filters 选择产品，rule 见 pricing.validate_rule
+
+        filters 可包含 category（类别或类别列表）、barcode_prefix（条码前缀，如厂商代码）、
+        min_price / max_price（当前售价区间）及 ids。apply 为 False 时只返回预览；
+        为 True 时在同一事务中重新计算并写入全部新价格，传入预览返回的 token 时
+        若价格在预览后已被修改则抛出 PreviewMismatchError。新售价不高于成本价的产品跳过不改
+        """
+        conditions = []
+        params = []
+        category = filters.get('category')
+        if category:
+            categories = category if isinstance(category, list) else [category]
+            conditions.append('category IN ({})'.format(', '.join('?' * len(categories))))
+            params.extend(categories)
+        if filters.get('barcode_prefix'):
+            # 按条码范围扫描（与产品搜索的条码前缀匹配相同）
+            conditions.append('barcode >= ? AND barcode < ?')
+            params.extend([filters['barcode_prefix'], filters['barcode_prefix'] + '\U0010ffff'])
+        if filters.get('min_price') is not None:
+            conditions.append('selling_price >= ?')
+            params.append(float(filters['min_price']))
+        if filters.get('max_price') is not None:
+            conditions.append('selling_price <= ?')
+            params.append(float(filters['max_price']))
+        if filters.get('ids'):
+            conditions.append('id IN ({})'.format(', '.join('?' * len(filters['ids']))))
+            params.extend(filters['ids'])
+        query = 'SELECT id, barcode, name, quantity, cost_price, selling_price FROM products {} ORDER BY id'.format(
+            'WHERE ' + ' AND '.join(conditions) if conditions else '')
+
+        conn = self._connect()
         try:
-            profit_margin = ((selling_price - cost_price) / selling_price) * 100
-            conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
+            if apply:
+                cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            new_prices = pricing.compute_prices([row[4] for row in rows], [row[5] for row in rows], rule)
+
+            changes = []
+            skipped = []
+            old_value = new_value = 0.0
+            for (product_id, barcode, name, quantity, cost_price, selling_price), new_price in zip(rows, new_prices):
+                if new_price <= cost_price:
+                    skipped.append({'id': product_id, 'barcode': barcode, 'name': name,
+                                    'cost_price': cost_price, 'new_price': new_price, 'reason': 'below_cost'})
+                    continue
+                if new_price == round(selling_price, 2):
+                    continue
+                changes.append({
+                    'id': product_id, 'barcode': barcode, 'name': name, 'quantity': quantity,
+                    'cost_price': cost_price, 'old_price': selling_price, 'new_price': new_price,
+                    'old_margin': round(pricing.profit_margin(cost_price, selling_price), 2),
+                    'new_margin': round(pricing.profit_margin(cost_price, new_price), 2)
+                })
+                old_value += selling_price * quantity
+                new_value += new_price * quantity
+
+            preview_token = pricing.preview_token(changes)
+            if apply:
+                if token and token != preview_token:
+                    raise pricing.PreviewMismatchError('Product prices changed since the preview')
+                cursor.executemany('''
+                    UPDATE products
+                    SET selling_price = ?, profit_margin = ?, version = version + 1, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', [(change['new_price'], pricing.profit_margin(change['cost_price'], change['new_price']),
+                       change['id']) for change in changes])
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+        return {
+            'matched': len(rows),
+            'count': len(changes),
+            'changes': changes,
+            'skipped': skipped,
+            'old_selling_value': round(old_value, 2),
+            'new_selling_value': round(new_value, 2),
+            'preview_token': preview_token,
+            'applied': apply
+        }
+
+    def update_product(self, product_id, barcode, name, category, quantity, cost_price, selling_price, version=None):
+        """更新产品；指定 version 时只有版本未变化才写入，否则抛出 VersionConflictError"""
+        try:
+            return self.patch_product(product_id, {
+                'barcode': barcode, 'name': name, 'category': category, 'quantity': quantity,
+                'cost_price': cost_price, 'selling_price': selling_price
+            }, version=version) is not None
+        except VersionConflictError:
+            raise
+        except Exception as e:
+            print(f"Update product error: {e}")
+            return False
+    
+    def patch_product(self, product_id, changes, version=None, quantity_change=None):
+        """按字段修改产品，返回修改后的产品（产品不存在时返回 None）
+
+        changes 只包含要修改的字段（见 PRODUCT_EDITABLE_COLUMNS）。version 为客户端读取产品时的版本号，
+        指定时在同一事务中比较并交换：版本已变化则不写入并抛出 VersionConflictError（附当前产品）。
+        quantity_change 为相对的库存增减，与收银的并发扣减一样直接累加，不会覆盖其他修改
+        """
+        unknown = [column for column in changes if column not in PRODUCT_EDITABLE_COLUMNS]
+        if unknown:
+            raise ValueError('Unknown product fields: {}'.format(', '.join(unknown)))
+        if quantity_change and 'quantity' in changes:
+            raise ValueError('quantity and quantity_change cannot be used together')
+        
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT {} FROM products WHERE id = ?'.format(PRODUCT_SELECT), (product_id,))
+            row = cursor.fetchone()
+            if row is None:
+                conn.rollback()
+                return None
+            current = dict(zip(PRODUCT_COLUMNS, row))
+            if version is not None and current['version'] != version:
+                raise VersionConflictError('Product was modified by another user', current)
+            
+            if changes.get('barcode', current['barcode']) != current['barcode']:
+                cursor.execute('SELECT 1 FROM products WHERE barcode = ? AND id != ?', (changes['barcode'], product_id))
+                if cursor.fetchone():
+                    raise ValueError('Barcode already exists')
+            
+            assignments = ['{} = ?'.format(column) for column in PRODUCT_EDITABLE_COLUMNS if column in changes]
+            params = [changes[column] for column in PRODUCT_EDITABLE_COLUMNS if column in changes]
+            if 'cost_price' in changes or 'selling_price' in changes:
+                selling_price = changes.get('selling_price', current['selling_price'])
+                if selling_price <= 0:
+                    raise ValueError('selling_price must be greater than 0')
+                assignments.append('profit_margin = ?')
+                params.append(pricing.profit_margin(changes.get('cost_price', current['cost_price']), selling_price))
+            if quantity_change:
+                assignments.append('quantity = quantity + ?')
+                params.append(quantity_change)
+            if not assignments:
+                conn.rollback()
+                return current
             
             cursor.execute('''
-                UPDATE products 
-                SET barcode=?, name=?, category=?, quantity=?, cost_price=?, selling_price=?, profit_margin=?, updated_at=CURRENT_TIMESTAMP
-                WHERE id=?
-            ''', (barcode, name, category, quantity, cost_price, selling_price, profit_margin, product_id))
+                UPDATE products SET {}, version = version + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND version = ?
+            '''.format(', '.join(assignments)), params + [product_id, current['version']])
+            if cursor.rowcount == 0:
+                # 不支持 BEGIN IMMEDIATE 加锁的后端上，读取之后被其他事务修改
+                raise VersionConflictError('Product was modified by another user', current)
+            # 类别或产品阈值变化时生效的阈值随之变化
+            if 'category' in changes or 'low_stock_threshold' in changes:
+                self._refresh_effective_thresholds(cursor, 'WHERE id = ?', (product_id,))
+            cursor.execute('SELECT {} FROM products WHERE id = ?'.format(PRODUCT_SELECT), (product_id,))
+            product = dict(zip(PRODUCT_COLUMNS, cursor.fetchone()))
+            if product['quantity'] < current['quantity']:
+                self._record_low_stock_alerts(cursor, 'id = ?', (product_id,), current['quantity'] - product['quantity'])
             
             conn.commit()
+            return product
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
             conn.close()
-            return True
-        except Exception as e:
-            print(f"Update product error: {e}")
-            return False
     
     def delete_product(self, product_id):
         """删除产品"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             cursor.execute('DELETE FROM products WHERE id=?', (product_id,))
@@ -190,203 +878,1014 @@ class POSDatabase:
     
     def get_product_by_barcode(self, barcode):
         """根据条码获取产品"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
-        cursor.execute('SELECT * FROM products WHERE barcode=?', (barcode,))
+        cursor.execute('SELECT {} FROM products WHERE barcode=?'.format(PRODUCT_SELECT), (barcode,))
         product = cursor.fetchone()
         
         conn.close()
         
         if product:
-            return {
-                'id': product[0],
-                'barcode': product[1],
-                'name': product[2],
-                'category': product[3],
-                'quantity': product[4],
-                'cost_price': product[5],
-                'selling_price': product[6],
-                'profit_margin': product[7]
-            }
+            return dict(zip(PRODUCT_COLUMNS, product))
         return None
     
+    def search_products(self, query='', category=None, limit=50, offset=0):
+        """搜索产品：条码前缀匹配排在最前（完全匹配优先），其余按名称/类别全文索引的相关度排序
+        
+        返回 {'items', 'total', 'facets'}，facets 为各类别的匹配数量（不受 category 过滤影响）
+        """
+        terms = query.split()
+        matches = []
+        params = []
+        if len(terms) == 1:
+            # 条码前缀：在 barcode 唯一索引上做范围查询
+            matches.append('''
+                SELECT id AS product_id, CASE WHEN barcode = ? THEN -2e9 ELSE -1e9 END AS score
+                FROM products WHERE barcode >= ? AND barcode < ?
+            ''')
+            params += [terms[0], terms[0], terms[0] + '\U0010ffff']
+        if terms and self.fts_enabled and all(len(term) >= 3 for term in terms):
+            matches.append('''
+                SELECT rowid AS product_id, rank AS score
+                FROM products_fts WHERE products_fts MATCH ? AND rank MATCH 'bm25(10.0, 1.0)'
+            ''')
+            params.append(' '.join('"{}"'.format(term.replace('"', '""')) for term in terms))
+        elif terms:
+            # trigram 索引只能匹配3个字符以上的词，较短的词按子串扫描
+            matches.append('SELECT id AS product_id, 0 AS score FROM products WHERE ' + ' AND '.join(
+                ["(LOWER(name) LIKE ? ESCAPE '\\' OR LOWER(category) LIKE ? ESCAPE '\\')"] * len(terms)))
+            for term in terms:
+                pattern = '%{}%'.format(re.sub(r'([\\%_])', r'\\\1', term.lower()))
+                params += [pattern, pattern]
+        else:
+            matches.append('SELECT id AS product_id, 0 AS score FROM products')
+        
+        matched = '''
+            products JOIN (
+                SELECT product_id, MIN(score) AS score FROM ({}) AS candidates GROUP BY product_id
+            ) AS m ON m.product_id = products.id
+        '''.format(' UNION ALL '.join(matches))
+        
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT products.category, COUNT(*) FROM {}
+                GROUP BY products.category ORDER BY products.category
+            '''.format(matched), params)
+            facets = [{'category': row[0], 'count': row[1]} for row in cursor.fetchall()]
+            
+            cursor.execute('''
+                SELECT {} FROM {} {}
+                ORDER BY m.score, products.category, products.name
+                LIMIT ? OFFSET ?
+            '''.format(PRODUCT_SELECT, matched, 'WHERE products.category = ?' if category else ''),
+                params + ([category] if category else []) + [limit, offset])
+            items = [dict(zip(PRODUCT_COLUMNS, row)) for row in cursor.fetchall()]
+        finally:
+            conn.close()
+        
+        total = sum(facet['count'] for facet in facets if not category or facet['category'] == category)
+        return {'items': items, 'total': total, 'facets': facets}
+    
     def update_product_quantity(self, barcode, quantity_change):
         """更新产品库存"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             cursor.execute('''
                 UPDATE products 
-                SET quantity = quantity + ?, updated_at = CURRENT_TIMESTAMP
+                SET quantity = quantity + ?, version = version + 1, updated_at = CURRENT_TIMESTAMP
                 WHERE barcode = ?
             ''', (quantity_change, barcode))
-            
+            if quantity_change < 0:
+                self._record_low_stock_alerts(cursor, 'barcode = ?', (barcode,), -quantity_change)
+
             conn.commit()
             conn.close()
             return True
         except Exception as e:
             print(f"Error updating product quantity: {e}")
             return False
-    
-    def add_sale(self, barcode, name, quantity, price, total_price, cost_price):
-        """添加销售记录"""
+
+    def _refresh_effective_thresholds(self, cursor, where='', params=()):
+        """重新计算产品生效的低库存阈值：产品阈值 > 类别阈值 > 全局阈值 > 默认值"""
+        cursor.execute('''
+            UPDATE products
+            SET effective_low_stock_threshold = COALESCE(
+                low_stock_threshold,
+                (SELECT threshold FROM low_stock_thresholds t
+                 WHERE t.scope = 'category' AND t.category = products.category),
+                (SELECT threshold FROM low_stock_thresholds t WHERE t.scope = 'global'),
+                ?)
+            {}
+        '''.format(where), (DEFAULT_LOW_STOCK_THRESHOLD,) + tuple(params))
+
+    def _record_low_stock_alerts(self, cursor, where, params, decrease):
+        """库存减少 decrease 后从阈值以上降到阈值及以下的产品记录低库存提醒（在当前事务中）"""
+        cursor.execute('''
+            INSERT INTO low_stock_alerts (product_id, quantity, threshold)
+            SELECT id, quantity, effective_low_stock_threshold FROM products
+            WHERE {} AND quantity <= effective_low_stock_threshold
+              AND quantity + ? > effective_low_stock_threshold
+        '''.format(where), tuple(params) + (decrease,))
+
+    def get_low_stock_thresholds(self):
+        """获取低库存阈值设置：全局、各类别及单独设置了阈值的产品"""
+        conn = self._connect()
         try:
-            conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
-            
+            cursor.execute('SELECT scope, category, threshold FROM low_stock_thresholds')
+            global_threshold = None
+            categories = {}
+            for scope, category, threshold in cursor.fetchall():
+                if scope == 'global':
+                    global_threshold = threshold
+                else:
+                    categories[category] = threshold
             cursor.execute('''
-                INSERT INTO sales (barcode, name, quantity, price, total_price, cost_price, date)
-                VALUES (?, ?, ?, ?, ?, ?, datetime('now', 'localtime'))
-            ''', (barcode, name, quantity, price, total_price, cost_price))
-            
-            conn.commit()
+                SELECT barcode, low_stock_threshold FROM products
+                WHERE low_stock_threshold IS NOT NULL
+                ORDER BY barcode
+            ''')
+            products = dict(cursor.fetchall())
+        finally:
             conn.close()
-            return True
-        except Exception as e:
-            print(f"Error adding sale record: {e}")
-            return False
-    
-    def get_all_sales(self):
-        """获取所有销售记录"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM sales ORDER BY date DESC')
-        sales = cursor.fetchall()
-        
-        conn.close()
-        
-        return [
-            {
-                'id': s[0],
-                'barcode': s[1],
-                'name': s[2],
-                'quantity': s[3],
-                'price': s[4],
-                'total_price': s[5],
-                'cost_price': s[6],
-                'date': s[7]
-            }
-            for s in sales
-        ]
-    
-    def delete_sale(self, sale_id):
-        """删除销售记录"""
+        return {
+            'default': DEFAULT_LOW_STOCK_THRESHOLD,
+            'global': global_threshold,
+            'categories': categories,
+            'products': products
+        }
+
+    def set_low_stock_thresholds(self, global_threshold=None, categories=None, products=None):
+        """设置低库存阈值并重新计算受影响产品生效的阈值
+
+        categories 为 {类别: 阈值}，products 为 {条码: 阈值}；阈值为 None 时删除该项设置，
+        global_threshold 传入 'clear' 时删除全局阈值。条码不存在时抛出 ValueError
+        """
+        conn = self._connect()
         try:
-            conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
-            
-            # 先获取销售记录信息，用于恢复库存
-            cursor.execute('SELECT barcode, quantity FROM sales WHERE id = ?', (sale_id,))
-            sale = cursor.fetchone()
-            
-            if not sale:
-                conn.close()
-                return False
-            
-            # 删除销售记录
-            cursor.execute('DELETE FROM sales WHERE id = ?', (sale_id,))
-            
+            cursor.execute('BEGIN IMMEDIATE')
+            if global_threshold == 'clear':
+                cursor.execute("DELETE FROM low_stock_thresholds WHERE scope = 'global'")
+            elif global_threshold is not None:
+                cursor.execute('''
+                    INSERT OR REPLACE INTO low_stock_thresholds (scope, category, threshold)
+                    VALUES ('global', '', ?)
+                ''', (global_threshold,))
+            for category, threshold in (categories or {}).items():
+                if threshold is None:
+                    cursor.execute("DELETE FROM low_stock_thresholds WHERE scope = 'category' AND category = ?",
+                                   (category,))
+                else:
+                    cursor.execute('''
+                        INSERT OR REPLACE INTO low_stock_thresholds (scope, category, threshold)
+                        VALUES ('category', ?, ?)
+                    ''', (category, threshold))
+            for barcode, threshold in (products or {}).items():
+                cursor.execute('UPDATE products SET low_stock_threshold = ?, version = version + 1 WHERE barcode = ?',
+                               (threshold, barcode))
+                if cursor.rowcount == 0:
+                    raise ValueError(f'Product not found: {barcode}')
+
+            # 全局阈值影响所有产品；否则只重新计算相关类别和产品
+            if global_threshold is not None:
+                self._refresh_effective_thresholds(cursor)
+            else:
+                category_names = list(categories or {})
+                barcodes = list(products or {})
+                conditions = []
+                if category_names:
+                    conditions.append('category IN ({})'.format(', '.join('?' * len(category_names))))
+                if barcodes:
+                    conditions.append('barcode IN ({})'.format(', '.join('?' * len(barcodes))))
+                if conditions:
+                    self._refresh_effective_thresholds(
+                        cursor, 'WHERE ' + ' OR '.join(conditions), category_names + barcodes)
             conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
             conn.close()
-            return True
-        except Exception as e:
-            print(f"Error deleting sale record: {e}")
-            return False
-    
-    def add_temp_sale(self, barcode, name, quantity, price, total_price):
-        """添加临时销售记录"""
+        return self.get_low_stock_thresholds()
+
+    def get_low_stock_products(self, limit=100, offset=0):
+        """获取库存不高于生效阈值的产品（按表达式索引读取），缺口最大的排在最前"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT COUNT(*) FROM products WHERE quantity - effective_low_stock_threshold <= 0
+            ''')
+            total = cursor.fetchone()[0]
+            cursor.execute('''
+                SELECT {} FROM products
+                WHERE quantity - effective_low_stock_threshold <= 0
+                ORDER BY quantity - effective_low_stock_threshold, barcode
+                LIMIT ? OFFSET ?
+            '''.format(PRODUCT_SELECT), (limit, offset))
+            items = [dict(zip(PRODUCT_COLUMNS, row)) for row in cursor.fetchall()]
+        finally:
+            conn.close()
+        return {'items': items, 'total': total}
+
+    def get_low_stock_alerts(self, after_id=0, limit=100):
+        """获取 id 大于 after_id 的低库存提醒（按 id 升序），用于增量轮询"""
+        conn = self._connect()
         try:
-            conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
-            
             cursor.execute('''
-                INSERT INTO temp_sales (barcode, name, quantity, price, total_price, date)
-                VALUES (?, ?, ?, ?, ?, datetime('now', 'localtime'))
-            ''', (barcode, name, quantity, price, total_price))
+                SELECT a.id, a.product_id, p.barcode, p.name, p.category, a.quantity, a.threshold, a.created_at
+                FROM low_stock_alerts a JOIN products p ON p.id = a.product_id
+                WHERE a.id > ?
+                ORDER BY a.id
+                LIMIT ?
+            ''', (after_id, limit))
+            return [dict(zip(LOW_STOCK_ALERT_COLUMNS, row)) for row in cursor.fetchall()]
+        finally:
+            conn.close()
+
+    def add_sale(self, barcode, name, quantity, price, total_price, cost_price, cashier=None):
+        """添加销售记录（作为单行交易）"""
+        try:
+            conn = self._connect()
+            cursor = conn.cursor()
+            
+            recorded = []
+            self._record_transaction(cursor, [{
+                'barcode': barcode, 'name': name, 'quantity': quantity, 'price': price,
+                'total_price': total_price, 'cost_price': cost_price
+            }], cashier=cashier, update_stock=False, recorded=recorded)
             
             conn.commit()
             conn.close()
+            self._notify_sales('add', recorded)
             return True
         except Exception as e:
-            print(f"Error adding temporary sale record: {e}")
+            print(f"Error adding sale record: {e}")
             return False
     
-    def get_temp_sales(self):
-        """获取临时销售记录"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _check_day_open(self, cursor, timestamp=None):
+        """写入的销售或作废的时间（默认现在）所在的营业日已经日结时抛出 DayClosedError"""
+        business_date = timestamp[:10] if timestamp else date.today().isoformat()
+        cursor.execute('SELECT 1 FROM z_reports WHERE business_date = ?', (business_date,))
+        if cursor.fetchone():
+            raise DayClosedError(f'Business day already closed: {business_date}')
+    
+    def _record_transaction(self, cursor, lines, cashier=None, terminal_id=None, received_amount=None,
+                            date=None, client_ref=None, update_stock=True, recorded=None):
+        """在当前事务中写入交易头及其销售明细，返回交易id
         
-        cursor.execute('SELECT * FROM temp_sales ORDER BY date DESC')
-        temp_sales = cursor.fetchall()
+        明细行包含 barcode, name, quantity, price, total_price, cost_price，可选 client_ref；
+        带 client_ref 的行若已存在则跳过（只忽略 client_ref 重复，其他约束错误照常抛出）。交易中没有任何新行时返回 None。
+        recorded 为列表时追加写入的销售记录（提交后用于通知销售监听）。销售时间所在的营业日已经日结时抛出 DayClosedError
+        """
+        self._check_day_open(cursor, date)
+        cursor.execute('''
+            INSERT INTO transactions (cashier, terminal_id, received_amount, date, client_ref)
+            VALUES (?, ?, ?, COALESCE(?, datetime('now', 'localtime')), ?)
+        ''', (cashier, terminal_id, received_amount, date, client_ref))
+        transaction_id = cursor.lastrowid
+        cursor.execute('SELECT date FROM transactions WHERE id = ?', (transaction_id,))
+        transaction_date = cursor.fetchone()[0]
         
-        conn.close()
+        line_no = 0
+        for line in lines:
+            cursor.execute('''
+                INSERT INTO sales (barcode, name, quantity, price, total_price, cost_price, date, client_ref)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (client_ref) WHERE client_ref IS NOT NULL DO NOTHING
+            ''', (line['barcode'], line['name'], line['quantity'], line['price'],
+                  line['total_price'], line['cost_price'], transaction_date, line.get('client_ref')))
+            if cursor.rowcount == 0:
+                continue
+            
+            line_no += 1
+            sale_id = cursor.lastrowid
+            cursor.execute('''
+                INSERT INTO transaction_items (transaction_id, sale_id, line_no, product_id)
+                VALUES (?, ?, ?, (SELECT id FROM products WHERE barcode = ?))
+            ''', (transaction_id, sale_id, line_no, line['barcode']))
+            if recorded is not None:
+                recorded.append({'id': sale_id, 'barcode': line['barcode'], 'name': line['name'],
+                                 'quantity': line['quantity'], 'total_price': line['total_price'],
+                                 'date': transaction_date, 'transaction_id': transaction_id})
+            
+            if update_stock:
+                cursor.execute('''
+                    UPDATE products 
+                    SET quantity = quantity - ?, version = version + 1, updated_at = CURRENT_TIMESTAMP
+                    WHERE barcode = ?
+                ''', (line['quantity'], line['barcode']))
+                self._record_low_stock_alerts(cursor, 'barcode = ?', (line['barcode'],), line['quantity'])
+
+        if line_no == 0:
+            cursor.execute('DELETE FROM transactions WHERE id = ?', (transaction_id,))
+            return None
         
-        return [
-            {
-                'id': s[0],
-                'barcode': s[1],
-                'name': s[2],
-                'quantity': s[3],
-                'price': s[4],
-                'total_price': s[5],
-                'date': s[6]
-            }
-            for s in temp_sales
-        ]
+        self._refresh_transaction_totals(cursor, transaction_id)
+        return transaction_id
     
-    def clear_temp_sales(self):
-        """清空临时销售记录"""
+    def _refresh_transaction_totals(self, cursor, transaction_id):
+        """重新计算交易头的汇总字段；没有明细行的交易会被删除，返回交易是否仍存在"""
+        cursor.execute('''
+            SELECT COUNT(*), COALESCE(SUM(s.quantity), 0), COALESCE(SUM(s.total_price), 0),
+                   COALESCE(SUM(s.cost_price * s.quantity), 0)
+            FROM transaction_items ti JOIN sales s ON s.id = ti.sale_id
+            WHERE ti.transaction_id = ?
+        ''', (transaction_id,))
+        line_count, item_count, total_price, total_cost = cursor.fetchone()
+        
+        if line_count == 0:
+            cursor.execute('DELETE FROM transactions WHERE id = ?', (transaction_id,))
+            return False
+        
+        cursor.execute('''
+            UPDATE transactions
+            SET line_count = ?, item_count = ?, total_price = ?, total_cost = ?
+            WHERE id = ?
+        ''', (line_count, item_count, total_price, total_cost, transaction_id))
+        return True
+    
+    def _run_migration(self, cursor, name, migrate):
+        """执行尚未执行过的一次性迁移 migrate(cursor)，并在 schema_migrations 中记录"""
+        cursor.execute('SELECT 1 FROM schema_migrations WHERE name = ?', (name,))
+        if cursor.fetchone():
+            return False
+        migrate(cursor)
+        cursor.execute('INSERT INTO schema_migrations (name) VALUES (?)', (name,))
+        return True
+    
+    def migrate_sales_to_transactions(self, cursor):
+        """为未归属交易的销售记录各建一笔交易
+
+        旧数据没有收银员信息，同一时间的多行可能来自不同收银台，因此不合并为一张小票
+        """
+        cursor.execute('''
+            SELECT s.id, s.date, s.barcode FROM sales s
+            WHERE NOT EXISTS (SELECT 1 FROM transaction_items ti WHERE ti.sale_id = s.id)
+            ORDER BY s.id
+        ''')
+        orphans = cursor.fetchall()
+        
+        for sale_id, sale_date, barcode in orphans:
+            cursor.execute('INSERT INTO transactions (date) VALUES (?)', (sale_date,))
+            transaction_id = cursor.lastrowid
+            cursor.execute('''
+                INSERT INTO transaction_items (transaction_id, sale_id, line_no, product_id)
+                VALUES (?, ?, 1, (SELECT id FROM products WHERE barcode = ?))
+            ''', (transaction_id, sale_id, barcode))
+            self._refresh_transaction_totals(cursor, transaction_id)
+        return len(orphans)
+    
+    def create_transaction(self, lines, cashier=None, terminal_id=None, received_amount=None, update_stock=True):
+        """创建一笔交易（小票）及其明细，返回交易id，失败时返回 None"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
-            cursor.execute('DELETE FROM temp_sales')
+            recorded = []
+            transaction_id = self._record_transaction(
+                cursor, lines, cashier=cashier, terminal_id=terminal_id,
+                received_amount=received_amount, update_stock=update_stock, recorded=recorded
+            )
             
             conn.commit()
             conn.close()
-            return True
+            self._notify_sales('add', recorded)
+            return transaction_id
         except Exception as e:
-            print(f"Error clearing temporary sales: {e}")
-            return False
+            print(f"Error creating transaction: {e}")
+            return None
+    
+    def get_transaction(self, transaction_id):
+        """根据id获取交易（小票）及其明细，主库中没有时按id范围查找归档分区"""
+        sources = [self._connect] + [
+            partial(self.archive.connect, period['filename']) for period in self.get_archive_periods()
+            if period['min_transaction_id'] is not None
+            and period['min_transaction_id'] <= transaction_id <= period['max_transaction_id']
+        ]
+        for connect in sources:
+            conn = connect()
+            try:
+                transaction = self._read_transaction(conn.cursor(), transaction_id)
+            finally:
+                conn.close()
+            if transaction:
+                return transaction
+        return None
+    
+    def _read_transaction(self, cursor, transaction_id):
+        cursor.execute('SELECT {} FROM transactions WHERE id = ?'.format(', '.join(TRANSACTION_COLUMNS)),
+                       (transaction_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        
+        cursor.execute('''
+            SELECT ti.line_no, s.id, ti.product_id, s.barcode, s.name, s.quantity, s.price, s.total_price, s.cost_price
+            FROM transaction_items ti JOIN sales s ON s.id = ti.sale_id
+            WHERE ti.transaction_id = ?
+            ORDER BY ti.line_no
+        ''', (transaction_id,))
+        items = cursor.fetchall()
+        
+        transaction = dict(zip(TRANSACTION_COLUMNS, row))
+        transaction['items'] = [
+            dict(zip(('line_no', 'sale_id', 'product_id', 'barcode', 'name', 'quantity', 'price',
+                      'total_price', 'cost_price'), item))
+            for item in items
+        ]
+        return transaction
+    
+    def get_transactions(self, start_date=None, end_date=None, limit=50, offset=0):
+        """按时间倒序获取交易列表（不含明细），可按日期范围过滤；依次读取主库和归档分区"""
+        where, params = self._date_filter(start_date, end_date)
+        
+        rows = []
+        for connect in self._partition_sources(start_date, end_date):
+            if len(rows) >= limit:
+                break
+            conn = connect()
+            try:
+                cursor = conn.cursor()
+                # 偏移量跨过整个分区时只需计数
+                if offset:
+                    cursor.execute('SELECT COUNT(*) FROM transactions {}'.format(where), params)
+                    count = cursor.fetchone()[0]
+                    if count <= offset:
+                        offset -= count
+                        continue
+                cursor.execute('SELECT {} FROM transactions {} ORDER BY date DESC, id DESC LIMIT ? OFFSET ?'.format(
+                    ', '.join(TRANSACTION_COLUMNS), where), params + [limit - len(rows), offset])
+                rows.extend(cursor.fetchall())
+                offset = 0
+            finally:
+                conn.close()
+        
+        return [dict(zip(TRANSACTION_COLUMNS, row)) for row in rows]
+    
+    @staticmethod
+    def _date_filter(start_date=None, end_date=None):
+        """生成按 date 字段过滤的 WHERE 子句及参数"""
+        conditions = []
+        params = []
+        if start_date:
+            conditions.append('date >= ?')
+            params.append(start_date)
+        if end_date:
+            conditions.append('date < ?')
+            params.append(end_date)
+        return ('WHERE ' + ' AND '.join(conditions) if conditions else ''), params
     
-    def delete_temp_sale(self, temp_sale_id):
-        """删除单个临时销售记录"""
+    def sync_sales(self, sales, cashier=None, terminal_id=None):
+        """批量导入离线队列中的销售记录（单个事务），按 client_ref 去重
+        
+        每条记录：client_ref, barcode, name, quantity, price, total_price, cost_price，
+        可选 date（客户端销售时间）、update_stock（是否同时扣减库存，默认是）
+        以及 transaction_ref（相同值的记录归入同一笔交易，未提供时每条记录单独成交易）。
+        销售时间所在的营业日已经日结的交易不写入，列在 rejected 中
+        """
+        accepted = []
+        duplicates = []
+        rejected = []
+        recorded = []
+        
+        # 按 transaction_ref 分组，保持原有顺序
+        groups = {}
+        for sale in sales:
+            groups.setdefault(sale.get('transaction_ref') or sale['client_ref'], []).append(sale)
+        
+        conn = self._connect()
         try:
-            conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
-            
-            cursor.execute('DELETE FROM temp_sales WHERE id = ?', (temp_sale_id,))
+            for transaction_ref, lines in groups.items():
+                cursor.execute('SELECT 1 FROM transactions WHERE client_ref = ?', (transaction_ref,))
+                if cursor.fetchone():
+                    duplicates.extend(line['client_ref'] for line in lines)
+                    continue
+                
+                # 已同步过的行在 _record_transaction 中会被跳过
+                cursor.execute('SELECT client_ref FROM sales WHERE client_ref IN ({})'.format(
+                    ', '.join('?' * len(lines))), [line['client_ref'] for line in lines])
+                existing = set(row[0] for row in cursor.fetchall())
+                
+                new_lines = [line for line in lines if line['client_ref'] not in existing]
+                if new_lines:
+                    try:
+                        self._check_day_open(cursor, new_lines[0].get('date'))
+                    except DayClosedError as e:
+                        rejected.extend({'client_ref': line['client_ref'], 'error': str(e)} for line in new_lines)
+                        new_lines = []
+                if new_lines:
+                    # 同一笔交易的库存处理方式以第一行为准
+                    self._record_transaction(
+                        cursor, new_lines, cashier=cashier, terminal_id=terminal_id,
+                        date=new_lines[0].get('date'), client_ref=transaction_ref,
+                        update_stock=new_lines[0].get('update_stock', True), recorded=recorded
+                    )
+                accepted.extend(line['client_ref'] for line in new_lines)
+                duplicates.extend(line['client_ref'] for line in lines if line['client_ref'] in existing)
             
             conn.commit()
+            self._notify_sales('add', recorded)
+            return {'accepted': accepted, 'duplicates': duplicates, 'rejected': rejected}
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
             conn.close()
-            return True
-        except Exception as e:
-            print(f"Error deleting temporary sale record: {e}")
-            return False
     
-    def cleanup_old_temp_sales(self, hours=24):
-        """清理过期的临时销售记录"""
+    def iter_sales(self, start_date=None, end_date=None):
+        """逐条获取销售记录（生成器，用于流式响应），按时间倒序依次读取主库和归档分区"""
+        where, params = self._date_filter(start_date, end_date)
+        query = 'SELECT {} FROM sales {} ORDER BY date DESC'.format(', '.join(SALE_COLUMNS), where)
+        for connect in self._partition_sources(start_date, end_date):
+            for row in self._iter_rows(query, params, connect=connect):
+                yield dict(zip(SALE_COLUMNS, row))
+    
+    def get_all_sales(self):
+        """获取所有销售记录"""
+        return list(self.iter_sales())
+    
+    def delete_sale(self, sale_id, voided_by=None):
+        """删除（作废）销售记录，作废记录保存在 sale_voids 表中供日结统计"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
-            # 删除超过指定小时数的临时销售记录
+            # 先获取销售记录信息，用于恢复库存
+            cursor.execute('SELECT barcode, quantity, name, total_price, date, cost_price FROM sales WHERE id = ?',
+                           (sale_id,))
+            sale = cursor.fetchone()
+            
+            if not sale:
+                conn.close()
+                return False
+            # 作废按作废时间计入当天的日结
+            self._check_day_open(cursor)
+            
             cursor.execute('''
-                DELETE FROM temp_sales 
-                WHERE datetime(date) < datetime('now', '-{} hours')
-            '''.format(hours))
+                SELECT ti.transaction_id, t.cashier FROM transaction_items ti
+                JOIN transactions t ON t.id = ti.transaction_id
+                WHERE ti.sale_id = ?
+            ''', (sale_id,))
+            item = cursor.fetchone()
+            cursor.execute('''
+                INSERT INTO sale_voids (sale_id, transaction_id, barcode, name, quantity, total_price, cost_price,
+                                        sale_date, cashier, voided_by)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (sale_id, item[0] if item else None, sale[0], sale[2], sale[1], sale[3], sale[5], sale[4],
+                  item[1] if item else None, voided_by))
+            void_id = cursor.lastrowid
             
-            cleaned_count = cursor.rowcount
+            # 删除销售记录（交易明细通过外键级联删除），并更新所属交易的汇总
+            cursor.execute('DELETE FROM sales WHERE id = ?', (sale_id,))
+            transaction_deleted = bool(item) and not self._refresh_transaction_totals(cursor, item[0])
             
             conn.commit()
             conn.close()
-            return cleaned_count
+            self._notify_sales('delete', [{'id': sale_id, 'barcode': sale[0], 'quantity': sale[1], 'name': sale[2],
+                                           'total_price': sale[3], 'date': sale[4],
+                                           'transaction_id': item[0] if item else None,
+                                           'transaction_deleted': transaction_deleted, 'void_id': void_id}])
+            return True
         except Exception as e:
-            print(f"Error cleaning up old temporary sales: {e}")
+            print(f"Error deleting sale record: {e}")
+            return False
+    
+    # 临时销售（购物车）持久化方法，购物车本身由 cart_store.CartStore 在内存中维护
+    def load_temp_sales(self):
+        """读取所有临时销售记录（启动时恢复购物车）"""
+        query = 'SELECT {} FROM temp_sales ORDER BY id'.format(', '.join(TEMP_SALE_COLUMNS))
+        return [dict(zip(TEMP_SALE_COLUMNS, row)) for row in self._iter_rows(query)]
+    
+    def save_temp_sale_changes(self, upserts, deleted_ids):
+        """在单个事务中写入购物车的变更：upserts 为临时销售记录列表，deleted_ids 为删除的记录id"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            if deleted_ids:
+                cursor.executemany('DELETE FROM temp_sales WHERE id = ?', [(item_id,) for item_id in deleted_ids])
+            if upserts:
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO temp_sales ({})
+                    VALUES ({})
+                '''.format(', '.join(TEMP_SALE_COLUMNS), ', '.join('?' * len(TEMP_SALE_COLUMNS))),
+                    [tuple(item[column] for column in TEMP_SALE_COLUMNS) for item in upserts])
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def reserve_temp_sale_ids(self, count):
+        """预留一段临时销售记录id（推进 AUTOINCREMENT 序列），返回第一个可用id
+        
+        id 从不复用：已结算购物车的 client_ref 由临时记录id生成
+        """
+        conn = self._connect()
+        try:
+            first_id = self.backend.reserve_ids(conn.cursor(), 'temp_sales', count)
+            conn.commit()
+            return first_id
+        finally:
+            conn.close()
+
+    # 库存预留方法：products.reserved_quantity 为各产品未过期预留数量之和，
+    # 可售数量 = quantity - reserved_quantity，无需每次汇总预留表
+    def migrate_temp_sales_to_reservations(self, cursor):
+        """旧版本在加入购物车时已直接扣减库存：将其退回库存并改为预留"""
+        expires_at = time.time() + RESERVATION_TTL_SECONDS
+        cursor.execute('''
+            SELECT t.id, t.terminal_id, p.id, t.quantity
+            FROM temp_sales t JOIN products p ON p.barcode = t.barcode
+            WHERE t.quantity > 0
+        ''')
+        rows = cursor.fetchall()
+        for temp_sale_id, terminal_id, product_id, quantity in rows:
+            cursor.execute('''
+                UPDATE products SET quantity = quantity + ?, reserved_quantity = reserved_quantity + ?
+                WHERE id = ?
+            ''', (quantity, quantity, product_id))
+            cursor.execute('''
+                INSERT INTO stock_reservations (temp_sale_id, terminal_id, product_id, quantity, expires_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (temp_sale_id, terminal_id, product_id, quantity, expires_at))
+        return len(rows)
+
+    def reserve_stock(self, temp_sale_id, terminal_id, barcode, quantity, ttl_seconds=RESERVATION_TTL_SECONDS):
+        """为购物车中的一条记录预留库存，同时延长该收银台其他预留的有效期
+
+        可售数量不足或产品不存在时返回 False
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            # 条件更新保证并发加入购物车时不会超卖
+            cursor.execute('''
+                UPDATE products SET reserved_quantity = reserved_quantity + ?
+                WHERE barcode = ? AND quantity - reserved_quantity >= ?
+            ''', (quantity, barcode, quantity))
+            if cursor.rowcount == 0:
+                conn.rollback()
+                return False
+
+            expires_at = time.time() + ttl_seconds
+            cursor.execute('''
+                INSERT INTO stock_reservations (temp_sale_id, terminal_id, product_id, quantity, expires_at)
+                VALUES (?, ?, (SELECT id FROM products WHERE barcode = ?), ?, ?)
+            ''', (temp_sale_id, terminal_id, barcode, quantity, expires_at))
+            cursor.execute('UPDATE stock_reservations SET expires_at = ? WHERE terminal_id = ?',
+                           (expires_at, terminal_id))
+            conn.commit()
+            return True
+        finally:
+            conn.close()
+
+    def extend_reservations(self, terminal_id, ttl_seconds=RESERVATION_TTL_SECONDS):
+        """延长收银台所有预留的有效期，返回预留数量"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('UPDATE stock_reservations SET expires_at = ? WHERE terminal_id = ?',
+                           (time.time() + ttl_seconds, terminal_id))
+            conn.commit()
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def _release_reservations(self, cursor, where, params=()):
+        """在当前事务中释放满足条件的预留，返回 [(temp_sale_id, terminal_id)]"""
+        cursor.execute('''
+            SELECT temp_sale_id, terminal_id, product_id, quantity FROM stock_reservations WHERE {}
+        '''.format(where), params)
+        rows = cursor.fetchall()
+        if rows:
+            cursor.executemany('''
+                UPDATE products SET reserved_quantity = MAX(reserved_quantity - ?, 0) WHERE id = ?
+            ''', [(quantity, product_id) for _, _, product_id, quantity in rows])
+            cursor.executemany('DELETE FROM stock_reservations WHERE temp_sale_id = ?',
+                               [(row[0],) for row in rows])
+        return [(row[0], row[1]) for row in rows]
+
+    def release_reservations(self, temp_sale_ids):
+        """释放指定购物车记录的预留（删除或清空购物车时），返回释放的数量"""
+        temp_sale_ids = list(temp_sale_ids)
+        if not temp_sale_ids:
             return 0
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            released = self._release_reservations(
+                cursor, 'temp_sale_id IN ({})'.format(', '.join('?' * len(temp_sale_ids))), temp_sale_ids
+            )
+            conn.commit()
+            return len(released)
+        finally:
+            conn.close()
+
+    def expire_reservations(self, now=None):
+        """释放所有已过期的预留，返回 [(temp_sale_id, terminal_id)]"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            released = self._release_reservations(cursor, 'expires_at <= ?', (now or time.time(),))
+            conn.commit()
+            return released
+        finally:
+            conn.close()
+
+    def release_orphan_reservations(self, ttl_seconds=RESERVATION_TTL_SECONDS,
+                                    idle_seconds=ORPHAN_RESERVATION_IDLE_SECONDS):
+        """释放没有对应临时销售记录的预留（进程异常退出时未写回的购物车记录）
+
+        其他仍在运行的工作进程的购物车记录可能尚未写回 temp_sales，因此只释放最近 idle_seconds 秒内
+        没有创建或续期过的预留（续期时 expires_at 重置为当前时间 + ttl_seconds）
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            released = self._release_reservations(
+                cursor, 'temp_sale_id NOT IN (SELECT id FROM temp_sales) AND expires_at <= ?',
+                (time.time() + ttl_seconds - idle_seconds,)
+            )
+            conn.commit()
+            return len(released)
+        finally:
+            conn.close()
+
+    def checkout_cart(self, items, cashier=None, terminal_id=None, received_amount=None, client_ref=None):
+        """将购物车记录结算为一笔交易：预留转为实际扣减库存，返回交易id
+
+        items 为购物车记录（含 id, barcode, name, quantity, price, total_price）；
+        明细行的 client_ref 为 temp-<记录id>，与离线同步去重规则一致。
+        同一 client_ref 的交易已存在时直接返回其id；预留已过期且可售数量不足时抛出 ValueError
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            if client_ref:
+                cursor.execute('SELECT id FROM transactions WHERE client_ref = ?', (client_ref,))
+                existing = cursor.fetchone()
+                if existing:
+                    conn.rollback()
+                    return existing[0]
+
+            lines = []
+            for item in items:
+                line_ref = 'temp-{}'.format(item['id'])
+                cursor.execute('SELECT 1 FROM sales WHERE client_ref = ?', (line_ref,))
+                already_synced = cursor.fetchone() is not None
+
+                cursor.execute('SELECT product_id, quantity FROM stock_reservations WHERE temp_sale_id = ?',
+                               (item['id'],))
+                reservation = cursor.fetchone()
+                if reservation:
+                    cursor.execute('DELETE FROM stock_reservations WHERE temp_sale_id = ?', (item['id'],))
+                    # 已通过离线同步扣减过库存的记录只释放预留
+                    sold = 0 if already_synced else reservation[1]
+                    cursor.execute('''
+                        UPDATE products
+                        SET quantity = quantity - ?, reserved_quantity = MAX(reserved_quantity - ?, 0),
+                            version = version + 1, updated_at = CURRENT_TIMESTAMP
+                        WHERE id = ?
+                    ''', (sold, reservation[1], reservation[0]))
+                    if sold:
+                        self._record_low_stock_alerts(cursor, 'id = ?', (reservation[0],), sold)
+                elif not already_synced:
+                    # 预留已过期：按当前可售数量扣减
+                    cursor.execute('''
+                        UPDATE products SET quantity = quantity - ?, version = version + 1, updated_at = CURRENT_TIMESTAMP
+                        WHERE barcode = ? AND quantity - reserved_quantity >= ?
+                    ''', (item['quantity'], item['barcode'], item['quantity']))
+                    if cursor.rowcount == 0:
+                        raise ValueError(f"Insufficient stock: {item['barcode']}")
+                    self._record_low_stock_alerts(cursor, 'barcode = ?', (item['barcode'],), item['quantity'])
+
+                cursor.execute('SELECT cost_price FROM products WHERE barcode = ?', (item['barcode'],))
+                product = cursor.fetchone()
+                lines.append({
+                    'barcode': item['barcode'],
+                    'name': item['name'],
+                    'quantity': item['quantity'],
+                    'price': item['price'],
+                    'total_price': item['total_price'],
+                    'cost_price': product[0] if product else 0,
+                    'client_ref': line_ref
+                })
+
+            recorded = []
+            transaction_id = self._record_transaction(
+                cursor, lines, cashier=cashier, terminal_id=terminal_id,
+                received_amount=received_amount, client_ref=client_ref, update_stock=False,
+                recorded=recorded
+            )
+            conn.commit()
+            self._notify_sales('add', recorded)
+            return transaction_id
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    # 销售归档方法
+    def get_archive_periods(self, connect=None):
+        """获取已归档的月份（按月份倒序）"""
+        query = 'SELECT {} FROM archive_periods ORDER BY period DESC'.format(', '.join(ARCHIVE_PERIOD_COLUMNS))
+        return [dict(zip(ARCHIVE_PERIOD_COLUMNS, row)) for row in self._iter_rows(query, connect=connect)]
+    
+    def _partition_sources(self, start_date=None, end_date=None, connect=None):
+        """返回与日期范围有交集的数据分区的连接函数：主库（或 connect 指定的快照）在前，归档按月份倒序"""
+        hot = connect or self._connect
+        sources = [hot]
+        for period in self.get_archive_periods(connect=hot):
+            period_start, period_end = month_bounds(period['period'])
+            if (start_date and period_end <= start_date) or (end_date and period_start >= end_date):
+                continue
+            sources.append(partial(self.archive.connect, period['filename']))
+        return sources
+    
+    def archive_closed_months(self, hot_months=ARCHIVE_HOT_MONTHS):
+        """将早于最近 hot_months 个月的销售数据按月移入归档文件，返回各月的归档结果"""
+        self._require_sqlite('Sales archiving')
+        cutoff = archive_cutoff(hot_months)
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT substr(date, 1, 7) FROM transactions WHERE date < ?
+                UNION SELECT substr(date, 1, 7) FROM sales WHERE date < ?
+                ORDER BY 1
+            ''', (cutoff, cutoff))
+            periods = [row[0] for row in cursor.fetchall() if row[0] and PERIOD_RE.match(row[0])]
+        finally:
+            conn.close()
+        
+        return [self.archive_period(period) for period in periods]
+    
+    def archive_period(self, period):
+        """将一个月份（YYYY-MM）的销售、交易及明细移入归档文件
+        
+        先写入归档文件，再在主库的一个事务中删除已归档的行并登记分区；
+        该月已有归档时与新数据合并（如之后同步进来的离线销售）
+        """
+        self._require_sqlite('Sales archiving')
+        start, end = month_bounds(period)
+        columns = {table: ', '.join(spec[0]) for table, spec in ARCHIVE_SCHEMA.items()}
+        
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN')  # 在同一个读快照中取出三张表的数据
+            cursor.execute('SELECT {} FROM transactions WHERE date >= ? AND date < ? ORDER BY id'.format(
+                columns['transactions']), (start, end))
+            transactions = cursor.fetchall()
+            cursor.execute('''
+                SELECT {} FROM transaction_items
+                WHERE transaction_id IN (SELECT id FROM transactions WHERE date >= ? AND date < ?)
+                ORDER BY id
+            '''.format(columns['transaction_items']), (start, end))
+            items = cursor.fetchall()
+            cursor.execute('''
+                SELECT {} FROM sales
+                WHERE (date >= ? AND date < ?)
+                   OR id IN (SELECT ti.sale_id FROM transaction_items ti JOIN transactions t ON t.id = ti.transaction_id
+                             WHERE t.date >= ? AND t.date < ?)
+                ORDER BY id
+            '''.format(columns['sales']), (start, end, start, end))
+            sales = cursor.fetchall()
+            cursor.execute('SELECT filename FROM archive_periods WHERE period = ?', (period,))
+            existing = cursor.fetchone()
+            conn.rollback()
+        finally:
+            conn.close()
+        
+        if not sales and not transactions:
+            return {'period': period, 'sales': 0, 'transactions': 0}
+        
+        tables = {'sales': sales, 'transactions': transactions, 'transaction_items': items}
+        if existing:
+            for table in tables:
+                merged = {row[0]: row for row in self.archive.read_rows(existing[0], table)}
+                merged.update((row[0], row) for row in tables[table])
+                tables[table] = [merged[key] for key in sorted(merged)]
+        filename = self.archive.write(period, tables)
+        
+        transaction_ids = [row[0] for row in tables['transactions']]
+        total_price = sum(row[5] for row in tables['transactions'])
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            # 按id删除：归档期间新写入该月的记录留在主库，下次归档时合并
+            cursor.executemany('DELETE FROM transactions WHERE id = ?', [(row[0],) for row in transactions])
+            cursor.executemany('DELETE FROM sales WHERE id = ?', [(row[0],) for row in sales])
+            cursor.execute('''
+                INSERT OR REPLACE INTO archive_periods
+                    (period, filename, sales_count, transaction_count, min_transaction_id, max_transaction_id,
+                     total_price)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (period, filename, len(tables['sales']), len(transaction_ids),
+                  min(transaction_ids, default=None), max(transaction_ids, default=None), total_price))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        
+        # 压缩设置变化后旧格式的归档文件不再使用
+        if existing and existing[0] != filename:
+            self.archive.remove(existing[0])
+        return {'period': period, 'sales': len(sales), 'transactions': len(transactions)}
+    
+    def export_columnar(self, export_dir, export_format=None, rebuild=False):
+        """将上次导出之后的新销售按月写入列式文件，并整体替换产品表文件（见 export.py）
+
+        销售按id递增读取（归档分区在前，主库在后），每个文件最多 EXPORT_BATCH_ROWS 行；
+        上次导出之后作废了已导出的销售时，先按当前数据重写这些销售所在月份的文件。
+        rebuild 为 True 时删除导出目录后全部重新导出。返回本次导出的文件和行数
+        """
+        export = ColumnarExport(export_dir, export_format, rebuild)
+        last_sale_id = export.last_sale_id
+        # 先读取作废记录再读取销售：之后新增的作废留到下次导出处理
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM sale_voids')
+            last_void_id = cursor.fetchone()[0]
+            cursor.execute('''
+                SELECT DISTINCT COALESCE(NULLIF(substr(sale_date, 1, 7), ''), 'unknown') FROM sale_voids
+                WHERE id > ? AND id <= ? AND sale_id <= ?
+            ''', (export.last_void_id, last_void_id, export.last_sale_id))
+            voided_months = sorted(row[0] for row in cursor.fetchall())
+        finally:
+            conn.close()
+        columns = ', '.join('ti.transaction_id' if name == 'transaction_id' else 's.' + name
+                            for name, column_type in EXPORT_SCHEMA['sales'])
+        
+        files = []
+        rewritten = 0
+        for month in voided_months:
+            if month == 'unknown':
+                condition, params = "COALESCE(s.date, '') = ''", ()
+            else:
+                condition, params = 's.date >= ? AND s.date < ?', month_bounds(month)
+            query = '''
+                SELECT {} FROM sales s LEFT JOIN transaction_items ti ON ti.sale_id = s.id
+                WHERE s.id <= ? AND {} ORDER BY s.id
+            '''.format(columns, condition)
+            detached = export.detach_sales(month)
+            batch = []
+            for connect in reversed(self._partition_sources(*params)):
+                for row in self._iter_rows(query, (export.last_sale_id,) + tuple(params), connect=connect):
+                    batch.append(row)
+                    if len(batch) >= EXPORT_BATCH_ROWS:
+                        files.append(export.write_sales(month, batch))
+                        batch = []
+                    rewritten += 1
+            if batch:
+                files.append(export.write_sales(month, batch))
+            export.remove_files(detached)
+        
+        query = '''
+            SELECT {} FROM sales s LEFT JOIN transaction_items ti ON ti.sale_id = s.id
+            WHERE s.id > ? ORDER BY s.id
+        '''.format(columns)
+        exported = 0
+        batches = {}  # 月份 -> 待写入的行
+        for connect in reversed(self._partition_sources()):
+            for row in self._iter_rows(query, (export.last_sale_id,), connect=connect):
+                month = (row[7] or '')[:7] or 'unknown'
+                batch = batches.setdefault(month, [])
+                batch.append(row)
+                if len(batch) >= EXPORT_BATCH_ROWS:
+                    files.append(export.write_sales(month, batch))
+                    batches[month] = []
+                exported += 1
+                last_sale_id = max(last_sale_id, row[0])
+        for month, batch in sorted(batches.items()):
+            if batch:
+                files.append(export.write_sales(month, batch))
+        
+        products = list(self._iter_rows('SELECT {} FROM products ORDER BY id'.format(
+            ', '.join(name for name, column_type in EXPORT_SCHEMA['products']))))
+        files.append(export.write_products(products))
+        export.save_manifest(last_sale_id, last_void_id)
+        return {
+            'format': export.format,
+            'sales': exported,
+            'rewritten_months': voided_months,
+            'rewritten_sales': rewritten,
+            'products': len(products),
+            'last_sale_id': last_sale_id,
+            'files': files
+        }
     
     def backup_data(self):
         """备份数据"""
@@ -414,12 +1913,14 @@ class POSDatabase:
             with open(backup_file, 'r', encoding='utf-8') as f:
                 backup_data = json.load(f)
             
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             # 清空现有数据
             cursor.execute('DELETE FROM products')
             cursor.execute('DELETE FROM sales')
+            cursor.execute('DELETE FROM transactions')
+            cursor.execute('DELETE FROM stock_reservations')
             
             # 恢复产品数据
             for product in backup_data.get('products', []):
@@ -437,6 +1938,9 @@ class POSDatabase:
                 ''', (sale['barcode'], sale['name'], sale['quantity'], 
                      sale['price'], sale['total_price'], sale['cost_price'], sale['date']))
             
+            # 备份中只有销售明细，每条销售恢复为一笔交易
+            self.migrate_sales_to_transactions(cursor)
+            
             conn.commit()
             conn.close()
             
@@ -445,11 +1949,1000 @@ class POSDatabase:
             print(f"Error restoring data: {e}")
             return False
 
+    # 幂等键管理方法
+    def begin_idempotent_request(self, key, fingerprint, lock_timeout=60):
+        """登记一个幂等请求
+        
+        返回 (state, stored)：state 为 'new'（首次请求，已占用该键）、'replay'（已完成，
+        stored 为 (status_code, response_body)）、'in_progress'（相同键的请求仍在处理）
+        或 'mismatch'（相同键对应了不同的请求内容）
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            now = time.time()
+            cursor.execute('''
+                INSERT OR IGNORE INTO idempotency_keys (key, fingerprint, created_at)
+                VALUES (?, ?, ?)
+            ''', (key, fingerprint, now))
+            if cursor.rowcount == 1:
+                conn.commit()
+                return 'new', None
+            
+            cursor.execute('''
+                SELECT fingerprint, status_code, response_body, created_at
+                FROM idempotency_keys WHERE key = ?
+            ''', (key,))
+            row = cursor.fetchone()
+            if row is None:
+                return 'in_progress', None
+            if row[0] != fingerprint:
+                return 'mismatch', None
+            if row[1] is not None:
+                return 'replay', (row[1], row[2])
+            
+            # 处理中的请求超时（如进程崩溃），允许重试接管
+            if now - row[3] > lock_timeout:
+                cursor.execute('''
+                    UPDATE idempotency_keys SET created_at = ?
+                    WHERE key = ? AND status_code IS NULL AND created_at = ?
+                ''', (now, key, row[3]))
+                conn.commit()
+                if cursor.rowcount == 1:
+                    return 'new', None
+            return 'in_progress', None
+        finally:
+            conn.close()
+    
+    def complete_idempotent_request(self, key, status_code, response_body):
+        """保存幂等请求的响应"""
+        try:
+            conn = self._connect()
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE idempotency_keys SET status_code = ?, response_body = ?
+                WHERE key = ?
+            ''', (status_code, response_body, key))
+            
+            conn.commit()
+            conn.close()
+            return True
+        except Exception as e:
+            print(f"Error saving idempotent response: {e}")
+            return False
+    
+    def release_idempotent_request(self, key):
+        """释放未完成的幂等键（请求失败时调用，允许客户端重试）"""
+        try:
+            conn = self._connect()
+            cursor = conn.cursor()
+            
+            cursor.execute('DELETE FROM idempotency_keys WHERE key = ? AND status_code IS NULL', (key,))
+            
+            conn.commit()
+            conn.close()
+            return True
+        except Exception as e:
+            print(f"Error releasing idempotency key: {e}")
+            return False
+    
+    def purge_idempotency_keys(self, ttl_seconds=86400):
+        """清理过期的幂等键"""
+        try:
+            conn = self._connect()
+            cursor = conn.cursor()
+            
+            cursor.execute('DELETE FROM idempotency_keys WHERE created_at < ?', (time.time() - ttl_seconds,))
+            purged_count = cursor.rowcount
+            
+            conn.commit()
+            conn.close()
+            return purged_count
+        except Exception as e:
+            print(f"Error purging idempotency keys: {e}")
+            return 0
+
+    # 后台任务与数据库维护方法
+    def acquire_job_lease(self, name, owner, lease_seconds, min_gap=0):
+        """获取任务租约：租约空闲且距上次开始执行超过 min_gap 秒时成功，返回 True/False"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO job_leases (name, owner, expires_at, last_started_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE
+                SET owner = excluded.owner, expires_at = excluded.expires_at, last_started_at = excluded.last_started_at
+                WHERE job_leases.expires_at <= ? AND COALESCE(job_leases.last_started_at, 0) <= ?
+            ''', (name, owner, now + lease_seconds, now, now, now - min_gap))
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+    
+    def release_job_lease(self, name, owner, succeeded=True):
+        """释放任务租约并记录执行结果"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE job_leases SET owner = NULL, expires_at = 0, last_finished_at = ?, last_status = ?
+                WHERE name = ? AND owner = ?
+            ''', (time.time(), 'success' if succeeded else 'failed', name, owner))
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+    
+    def get_job_leases(self):
+        """获取所有任务租约（各进程共享的最近执行情况）"""
+        columns = ('name', 'owner', 'expires_at', 'last_started_at', 'last_finished_at', 'last_status')
+        query = 'SELECT {} FROM job_leases ORDER BY name'.format(', '.join(columns))
+        return [dict(zip(columns, row)) for row in self._iter_rows(query)]
+    
+    def checkpoint_wal(self, mode='PASSIVE'):
+        """执行WAL检查点，返回 {'busy', 'log_frames', 'checkpointed_frames'}"""
+        self._require_sqlite('WAL checkpoint')
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            raise ValueError(f'Invalid checkpoint mode: {mode}')
+        conn = self._connect()
+        try:
+            busy, log_frames, checkpointed_frames = conn.execute(
+                'PRAGMA wal_checkpoint({})'.format(mode)).fetchone()
+            return {'busy': busy, 'log_frames': log_frames, 'checkpointed_frames': checkpointed_frames}
+        finally:
+            conn.close()
+    
+    def optimize_database(self, analyze=False):
+        """更新查询优化器统计信息
+
+        默认执行 PRAGMA optimize（只分析统计信息可能已过时的表，并限制每个索引检查的行数）；
+        analyze 为 True 时执行完整的 ANALYZE
+        """
+        self._require_sqlite('Query optimizer maintenance')
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA analysis_limit = {}'.format(0 if analyze else ANALYSIS_LIMIT))
+            conn.execute('ANALYZE' if analyze else 'PRAGMA optimize')
+            conn.commit()
+            return True
+        finally:
+            conn.close()
+    
+    # 存储维护方法
+    def ensure_statistics(self):
+        """数据库从未收集过统计信息时执行一次近似 ANALYZE，返回是否执行"""
+        self._require_sqlite('Query optimizer maintenance')
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone():
+                return False
+            cursor.execute('PRAGMA analysis_limit = {}'.format(ANALYSIS_LIMIT))
+            cursor.execute('ANALYZE')
+            conn.commit()
+            return True
+        finally:
+            conn.close()
+    
+    def migrate_auto_vacuum(self, max_size=None):
+        """将旧数据库转换为 auto_vacuum=INCREMENTAL（需要执行一次 VACUUM），返回是否转换
+        
+        VACUUM 期间数据库不可写，因此不在启动时执行，由夜间维护任务（或手动运行该任务）转换；
+        数据库超过 max_size 字节时跳过。转换完成后记录在 schema_migrations 中
+        """
+        self._require_sqlite('Auto-vacuum migration')
+        conn = self._connect()
+        try:
+            conn.isolation_level = None  # VACUUM 不能在事务中执行
+            cursor = conn.cursor()
+            cursor.execute('PRAGMA auto_vacuum')
+            if cursor.fetchone()[0] == 2:
+                return False
+            cursor.execute('PRAGMA page_count')
+            page_count = cursor.fetchone()[0]
+            cursor.execute('PRAGMA page_size')
+            page_size = cursor.fetchone()[0]
+            if max_size is not None and page_count * page_size > max_size:
+                return False
+            
+            size = page_count * page_size
+            print(f"Converting database to incremental auto-vacuum ({size / 1024 / 1024:.1f} MB), writes are blocked...")
+            started = time.monotonic()
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            cursor.execute('VACUUM')
+            cursor.execute("INSERT OR IGNORE INTO schema_migrations (name) VALUES ('auto_vacuum_incremental')")
+            print(f"Auto-vacuum conversion finished in {time.monotonic() - started:.1f}s")
+            return True
+        finally:
+            conn.close()
+    
+    def incremental_vacuum(self, time_budget=MAINTENANCE_TIME_BUDGET, pages_per_step=VACUUM_PAGES_PER_STEP,
+                           min_free_ratio=VACUUM_FREE_RATIO_THRESHOLD):
+        """分步归还空闲页：每步是一个短事务，步间其他连接可以写入；超过时间上限即停止，返回释放的页数"""
+        self._require_sqlite('Incremental vacuum')
+        conn = self._connect()
+        try:
+            conn.isolation_level = None
+            cursor = conn.cursor()
+            cursor.execute('PRAGMA auto_vacuum')
+            if cursor.fetchone()[0] != 2:
+                return 0
+            cursor.execute('PRAGMA freelist_count')
+            free_pages = cursor.fetchone()[0]
+            cursor.execute('PRAGMA page_count')
+            page_count = cursor.fetchone()[0]
+            if free_pages == 0 or free_pages < page_count * min_free_ratio:
+                return 0
+            
+            freed = 0
+            deadline = time.monotonic() + time_budget
+            while free_pages > 0 and time.monotonic() < deadline:
+                cursor.execute('PRAGMA incremental_vacuum({})'.format(pages_per_step)).fetchall()
+                cursor.execute('PRAGMA freelist_count')
+                remaining = cursor.fetchone()[0]
+                freed += free_pages - remaining
+                if remaining >= free_pages:
+                    break
+                free_pages = remaining
+            return freed
+        finally:
+            conn.close()
+    
+    def _table_sizes(self, cursor):
+        """返回 {表名: (行数, 占用字节数)}；SQLite 未编译 dbstat 时字节数为 None"""
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")
+        tables = [row[0] for row in cursor.fetchall()]
+        
+        sizes = {}
+        try:
+            # 表及其索引占用的页面（索引计入所属表）
+            cursor.execute('''
+                SELECT COALESCE(m.tbl_name, d.name), SUM(d.pgsize)
+                FROM dbstat d LEFT JOIN sqlite_master m ON m.name = d.name
+                GROUP BY 1
+            ''')
+            sizes = dict(cursor.fetchall())
+        except sqlite3.OperationalError:
+            pass
+        
+        result = {}
+        for table in tables:
+            cursor.execute('SELECT COUNT(*) FROM "{}"'.format(table.replace('"', '""')))
+            result[table] = (cursor.fetchone()[0], sizes.get(table))
+        return result
+    
+    def record_storage_snapshot(self):
+        """记录各表的行数和大小（用于计算增长速度），并清理过期快照，返回记录的表数量"""
+        self._require_sqlite('Storage statistics')
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            sizes = self._table_sizes(cursor)
+            cursor.executemany('''
+                INSERT OR REPLACE INTO storage_stats (taken_at, table_name, row_count, size_bytes)
+                VALUES (?, ?, ?, ?)
+            ''', [(now, table, rows, size) for table, (rows, size) in sizes.items()])
+            cursor.execute('DELETE FROM storage_stats WHERE taken_at < ?',
+                           (now - STORAGE_STATS_RETENTION_DAYS * 86400,))
+            conn.commit()
+            return len(sizes)
+        finally:
+            conn.close()
+    
+    def get_storage_stats(self):
+        """获取存储状况：文件大小、空闲页比例、清理模式，以及各表的行数、大小和近一天的增长"""
+        self._require_sqlite('Storage statistics')
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            pragmas = {}
+            for name in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum'):
+                cursor.execute('PRAGMA {}'.format(name))
+                pragmas[name] = cursor.fetchone()[0]
+            sizes = self._table_sizes(cursor)
+            
+            # 与约一天前（没有则取最早）的快照比较
+            cursor.execute('''
+                SELECT taken_at FROM storage_stats WHERE taken_at <= ?
+                ORDER BY taken_at DESC LIMIT 1
+            ''', (time.time() - 86400,))
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute('SELECT MIN(taken_at) FROM storage_stats')
+                row = cursor.fetchone()
+            baseline_at = row[0] if row else None
+            baseline = {}
+            if baseline_at is not None:
+                cursor.execute('SELECT table_name, row_count, size_bytes FROM storage_stats WHERE taken_at = ?',
+                               (baseline_at,))
+                baseline = {name: (rows, size) for name, rows, size in cursor.fetchall()}
+        finally:
+            conn.close()
+        
+        elapsed_days = (time.time() - baseline_at) / 86400 if baseline_at else 0
+        tables = []
+        for table, (rows, size) in sorted(sizes.items()):
+            previous = baseline.get(table)
+            growth = None
+            # 快照间隔不足一小时时外推的日增长没有意义
+            if previous is not None and elapsed_days >= 1 / 24:
+                growth = round((rows - previous[0]) / elapsed_days, 1)
+            tables.append({'name': table, 'rows': rows, 'size_bytes': size, 'rows_per_day': growth})
+        
+        file_size = os.path.getsize(self.db_path) if os.path.exists(self.db_path) else 0
+        wal_path = self.db_path + '-wal'
+        page_count = pragmas['page_count']
+        return {
+            'file_size': file_size,
+            'wal_size': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+            'page_size': pragmas['page_size'],
+            'page_count': page_count,
+            'freelist_count': pragmas['freelist_count'],
+            'free_ratio': round(pragmas['freelist_count'] / page_count, 4) if page_count else 0,
+            'auto_vacuum': AUTO_VACUUM_MODES.get(pragmas['auto_vacuum'], pragmas['auto_vacuum']),
+            'growth_baseline_at': (datetime.fromtimestamp(baseline_at).strftime('%Y-%m-%d %H:%M:%S')
+                                   if baseline_at else None),
+            'tables': tables
+        }
+    
+    def backup_database(self, backup_dir='backups', keep=7):
+        """使用SQLite在线备份生成数据库快照文件，只保留最近 keep 个，返回备份文件路径"""
+        self._require_sqlite('Online backup')
+        os.makedirs(backup_dir, exist_ok=True)
+        prefix = os.path.splitext(os.path.basename(self.db_path))[0]
+        backup_path = os.path.join(backup_dir, '{}-{}.db'.format(prefix, datetime.now().strftime('%Y%m%d-%H%M%S')))
+        
+        source = self._connect()
+        target = sqlite3.connect(backup_path)
+        try:
+            # 分批复制页面，期间其他连接仍可写入
+            source.backup(target, pages=1024, sleep=0.01)
+        finally:
+            target.close()
+            source.close()
+        
+        backups = sorted(glob.glob(os.path.join(backup_dir, prefix + '-*.db')))
+        for old_backup in backups[:-keep] if keep > 0 else []:
+            os.remove(old_backup)
+        return backup_path
+    
+    # 报表快照方法
+    def _data_version(self):
+        """主库的 PRAGMA data_version：其他连接（含其他进程）每次提交后变化，只在同一连接上比较才有意义"""
+        if self._watch_conn is None:
+            self._watch_conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        return self._watch_conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def refresh_report_snapshot(self, force=False):
+        """主库自上次复制以来有提交时复制报表快照，返回快照信息（refreshed 表示本次是否复制）
+        
+        先复制到临时文件再改名替换，正在读取旧快照的报表查询不受影响
+        """
+        self._require_sqlite('Report snapshot')
+        with self._report_lock:
+            # 复制前读取版本号：复制期间的提交会使下次检查时再复制一次
+            data_version = self._data_version()
+            if (not force and data_version == self._report_data_version
+                    and os.path.exists(self.report_path)):
+                return dict(self.get_report_snapshot_info(), refreshed=False)
+            self._copy_report_snapshot()
+            self._report_data_version = data_version
+        return dict(self.get_report_snapshot_info(), refreshed=True)
+
+    def _copy_report_snapshot(self):
+        tmp_path = self.report_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        
+        source = self._connect()
+        target = sqlite3.connect(tmp_path)
+        try:
+            # 一次复制全部页面：WAL模式下只占用一个读事务，不阻塞收银写入
+            # （分批复制时，期间主库的每次写入都会使复制重新开始）
+            source.backup(target)
+            # 快照以只读方式打开，改回普通日志模式后不需要 -wal/-shm 文件
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            target.close()
+            source.close()
+        
+        os.replace(tmp_path, self.report_path)
+    
+    def get_report_snapshot_info(self):
+        """获取报表快照的生成时间、已过去的秒数和文件大小；快照尚未生成时 snapshot_at 为 None"""
+        try:
+            stat = os.stat(self.report_path)
+        except FileNotFoundError:
+            return {'snapshot_at': None, 'age_seconds': None, 'size': 0}
+        return {
+            'snapshot_at': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
+            'age_seconds': round(time.time() - stat.st_mtime, 1),
+            'size': stat.st_size
+        }
+    
+    def _report_connect(self):
+        """以只读方式打开报表快照；快照尚未生成时（或非 SQLite 后端）读取主库"""
+        if self.backend.dialect != 'sqlite' or not os.path.exists(self.report_path):
+            return self._connect()
+        return sqlite3.connect('file:{}?mode=ro'.format(os.path.abspath(self.report_path)), uri=True)
+    
+    def get_sales_summary(self, start_date=None, end_date=None, group_by='day'):
+        """按日、月或产品汇总销售额、成本和毛利（读取报表快照及归档分区）"""
+        if group_by not in SALES_SUMMARY_GROUPS:
+            raise ValueError(f'Invalid group_by: {group_by}')
+        where, params = self._date_filter(start_date, end_date)
+        query = '''
+            SELECT {} AS key, MAX(name), COUNT(*), SUM(quantity), SUM(total_price), SUM(cost_price * quantity)
+            FROM sales {}
+            GROUP BY key
+        '''.format(SALES_SUMMARY_GROUPS[group_by], where)
+        
+        # 各分区分别聚合后再合并（同一天或同一产品可能分布在多个分区中）
+        groups = {}
+        for connect in self._partition_sources(start_date, end_date, connect=self._report_connect):
+            for key, name, sale_count, quantity, revenue, cost in self._iter_rows(query, params, connect=connect):
+                group = groups.setdefault(key, {'key': key, 'sale_count': 0, 'quantity': 0,
+                                                'revenue': 0.0, 'cost': 0.0})
+                if group_by == 'product':
+                    group.setdefault('name', name)
+                group['sale_count'] += sale_count
+                group['quantity'] += quantity
+                group['revenue'] += revenue
+                group['cost'] += cost
+        
+        rows = sorted(groups.values(), key=lambda group: group['key'])
+        if group_by == 'product':
+            rows.sort(key=lambda group: group['revenue'], reverse=True)
+        for group in rows:
+            group['revenue'] = round(group['revenue'], 2)
+            group['cost'] = round(group['cost'], 2)
+            group['profit'] = round(group['revenue'] - group['cost'], 2)
+        
+        return {
+            'group_by': group_by,
+            'rows': rows,
+            'total': {
+                'sale_count': sum(group['sale_count'] for group in rows),
+                'quantity': sum(group['quantity'] for group in rows),
+                'revenue': round(sum(group['revenue'] for group in rows), 2),
+                'cost': round(sum(group['cost'] for group in rows), 2),
+                'profit': round(sum(group['profit'] for group in rows), 2)
+            }
+        }
+    
+    def get_product_stats(self):
+        """产品目录统计：产品数、库存总量、库存成本和售价总值、潜在利润、平均毛利率、低库存及缺货数量
+
+        读取触发器维护的累计值；没有累计表的后端按产品表实时聚合
+        """
+        conn = self._connect()
+        try:
+            stats = self._read_product_stats(conn.cursor())
+        finally:
+            conn.close()
+        stats['cost_value'] = round(stats['cost_value'], 2)
+        stats['selling_value'] = round(stats['selling_value'], 2)
+        stats['potential_profit'] = round(stats['selling_value'] - stats['cost_value'], 2)
+        stats['avg_profit_margin'] = (round(stats['potential_profit'] / stats['selling_value'] * 100, 1)
+                                      if stats['selling_value'] > 0 else 0)
+        return stats
+
+    def _read_product_stats(self, cursor):
+        """在当前连接中读取目录统计的原始值"""
+        if self.stats_enabled:
+            cursor.execute('SELECT {} FROM product_stats WHERE id = 1'.format(', '.join(PRODUCT_STATS_COLUMNS)))
+        else:
+            cursor.execute(PRODUCT_STATS_QUERY)
+        return dict(zip(PRODUCT_STATS_COLUMNS, cursor.fetchone()))
+
+    def recompute_product_stats(self):
+        """按产品表全量重算目录统计并覆盖累计值，返回各项与重算前累计值的差异（用于核对）"""
+        if not self.stats_enabled:
+            return {}
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT {} FROM product_stats WHERE id = 1'.format(', '.join(PRODUCT_STATS_COLUMNS)))
+            running = cursor.fetchone()
+            cursor.execute(PRODUCT_STATS_QUERY)
+            recomputed = cursor.fetchone()
+            cursor.execute('UPDATE product_stats SET {} WHERE id = 1'.format(
+                ', '.join('{} = ?'.format(column) for column in PRODUCT_STATS_COLUMNS)), recomputed)
+            conn.commit()
+        finally:
+            conn.close()
+        # 金额为浮点累加，忽略不足一分的误差
+        drift = {}
+        for column, before, after in zip(PRODUCT_STATS_COLUMNS, running, recomputed):
+            difference = round(after - before, 2)
+            if difference:
+                drift[column] = difference
+        return drift
+
+    def get_inventory_summary(self, low_stock_threshold=None):
+        """库存汇总：产品数、库存成本和售价总值、低库存及缺货数量，以及按类别的汇总（读取报表快照）
+
+        未指定 low_stock_threshold 时按各产品生效的低库存阈值统计
+        """
+        query = '''
+            SELECT category, COUNT(*), SUM(quantity), SUM(cost_price * quantity), SUM(selling_price * quantity),
+                   SUM(CASE WHEN quantity > 0 AND quantity <= COALESCE(?, effective_low_stock_threshold) THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN quantity <= 0 THEN 1 ELSE 0 END)
+            FROM products
+            GROUP BY category
+            ORDER BY category
+        '''
+        columns = ('category', 'product_count', 'total_quantity', 'cost_value', 'selling_value',
+                   'low_stock_count', 'out_of_stock_count')
+        categories = [dict(zip(columns, row))
+                      for row in self._iter_rows(query, (low_stock_threshold,), connect=self._report_connect)]
+        
+        summary = {column: sum(category[column] for category in categories) for column in columns[1:]}
+        for entry in categories + [summary]:
+            entry['cost_value'] = round(entry['cost_value'], 2)
+            entry['selling_value'] = round(entry['selling_value'], 2)
+            entry['potential_profit'] = round(entry['selling_value'] - entry['cost_value'], 2)
+            entry['avg_profit_margin'] = (round(entry['potential_profit'] / entry['selling_value'] * 100, 1)
+                                          if entry['selling_value'] > 0 else 0)
+        summary['low_stock_threshold'] = low_stock_threshold
+        summary['categories'] = categories
+        return summary
+    
+    @staticmethod
+    def _business_date(value=None):
+        """规范化营业日：未指定或 'today' 时为今天；格式应为 YYYY-MM-DD 且不晚于今天"""
+        today = date.today()
+        if value in (None, '', 'today'):
+            return today.isoformat()
+        if value == 'yesterday':
+            return (today - timedelta(days=1)).isoformat()
+        if not BUSINESS_DATE_RE.match(str(value)):
+            raise ValueError('Business date must be YYYY-MM-DD')
+        try:
+            business_date = date.fromisoformat(value)
+        except ValueError:
+            raise ValueError('Business date must be YYYY-MM-DD')
+        if business_date > today:
+            raise ValueError('Business date cannot be in the future')
+        return value
+    
+    def _compute_z_report(self, business_date, cursor=None):
+        """按日期索引汇总营业日的交易（按收银员）、销售（按产品）和当天的作废记录，返回 (汇总, 收银员, 产品)
+
+        cursor 为日结事务的游标：主库在该事务中读取（归档分区只读，单独读取）。
+        营业日结束时的库存按当前库存加回营业日结束之后的销售数量推算
+        """
+        start = business_date + ' 00:00:00'
+        end = (date.fromisoformat(business_date) + timedelta(days=1)).isoformat() + ' 00:00:00'
+        cashiers = {}
+        products = {}
+        
+        def rows(query, params, connect=None):
+            # connect 为 None 时读取主库
+            if connect is None and cursor is not None:
+                cursor.execute(query, params)
+                return cursor.fetchall()
+            return self._iter_rows(query, params, connect=connect)
+        
+        def cashier_entry(cashier):
+            return cashiers.setdefault(cashier or '', dict(
+                zip(Z_REPORT_CASHIER_COLUMNS, (cashier or '', 0, 0, 0.0, 0.0, 0.0, 0, 0.0))))
+        
+        def product_entry(barcode, name):
+            return products.setdefault(barcode, dict(
+                zip(Z_REPORT_PRODUCT_COLUMNS, (barcode, name, 0, 0.0, 0.0, 0, None))))
+        
+        transaction_query = '''
+            SELECT cashier, COUNT(*), SUM(item_count), SUM(total_price), SUM(total_cost)
+            FROM transactions WHERE date >= ? AND date < ?
+            GROUP BY cashier
+        '''
+        sales_query = '''
+            SELECT barcode, MAX(name), SUM(quantity), SUM(total_price), SUM(cost_price * quantity)
+            FROM sales WHERE date >= ? AND date < ?
+            GROUP BY barcode
+        '''
+        for connect in [None] + self._partition_sources(start, end)[1:]:
+            for cashier, count, items, revenue, cost in rows(transaction_query, (start, end), connect):
+                entry = cashier_entry(cashier)
+                entry['transaction_count'] += count
+                entry['item_count'] += items
+                entry['revenue'] += revenue
+                entry['cost'] += cost
+            for barcode, name, quantity, revenue, cost in rows(sales_query, (start, end), connect):
+                entry = product_entry(barcode, name)
+                entry['quantity_sold'] += quantity
+                entry['revenue'] += revenue
+                entry['cost'] += cost
+        
+        # 作废按作废时间计入当天，归属执行作废的用户
+        void_query = '''
+            SELECT voided_by, barcode, MAX(name), COUNT(*), SUM(quantity), SUM(total_price)
+            FROM sale_voids WHERE voided_at >= ? AND voided_at < ?
+            GROUP BY voided_by, barcode
+        '''
+        for voided_by, barcode, name, count, quantity, amount in rows(void_query, (start, end)):
+            entry = cashier_entry(voided_by)
+            entry['void_count'] += count
+            entry['void_amount'] += amount
+            product_entry(barcode, name)['quantity_voided'] += quantity
+        
+        # 营业日结束之后的销量（日结昨天或更早时）
+        sold_after = {}
+        after_query = 'SELECT barcode, SUM(quantity) FROM sales WHERE date >= ? GROUP BY barcode'
+        for connect in [None] + self._partition_sources(end)[1:]:
+            for barcode, quantity in rows(after_query, (end,), connect):
+                sold_after[barcode] = sold_after.get(barcode, 0) + quantity
+        
+        # 有销售或作废的产品在营业日结束时的库存，以及推算库存总值时需要加回的销量
+        stock = self._read_product_stats(cursor) if cursor is not None else self.get_product_stats()
+        stock_quantity, stock_cost_value, stock_selling_value = (
+            stock['total_quantity'], stock['cost_value'], stock['selling_value'])
+        barcodes = sorted(set(products) | set(sold_after))
+        for offset in range(0, len(barcodes), 500):
+            chunk = barcodes[offset:offset + 500]
+            for barcode, quantity, cost_price, selling_price in rows(
+                    'SELECT barcode, quantity, cost_price, selling_price FROM products WHERE barcode IN ({})'.format(
+                        ', '.join('?' * len(chunk))), chunk):
+                returned = sold_after.get(barcode, 0)
+                if barcode in products:
+                    products[barcode]['closing_quantity'] = quantity + returned
+                stock_quantity += returned
+                stock_cost_value += returned * cost_price
+                stock_selling_value += returned * selling_price
+        
+        for entry in list(cashiers.values()) + list(products.values()):
+            entry['revenue'] = round(entry['revenue'], 2)
+            entry['cost'] = round(entry['cost'], 2)
+        for entry in cashiers.values():
+            entry['profit'] = round(entry['revenue'] - entry['cost'], 2)
+            entry['void_amount'] = round(entry['void_amount'], 2)
+        
+        revenue = round(sum(entry['revenue'] for entry in cashiers.values()), 2)
+        cost = round(sum(entry['cost'] for entry in cashiers.values()), 2)
+        summary = {
+            'business_date': business_date,
+            'transaction_count': sum(entry['transaction_count'] for entry in cashiers.values()),
+            'item_count': sum(entry['item_count'] for entry in cashiers.values()),
+            'revenue': revenue,
+            'cost': cost,
+            'profit': round(revenue - cost, 2),
+            'profit_margin': round((revenue - cost) / revenue * 100, 2) if revenue > 0 else 0,
+            'void_count': sum(entry['void_count'] for entry in cashiers.values()),
+            'void_quantity': sum(entry['quantity_voided'] for entry in products.values()),
+            'void_amount': round(sum(entry['void_amount'] for entry in cashiers.values()), 2),
+            'stock_quantity': stock_quantity,
+            'stock_cost_value': round(stock_cost_value, 2),
+            'stock_selling_value': round(stock_selling_value, 2)
+        }
+        return (summary,
+                sorted(cashiers.values(), key=lambda entry: (-entry['revenue'], entry['cashier'])),
+                sorted(products.values(), key=lambda entry: (-entry['revenue'], entry['barcode'])))
+    
+    def close_day(self, business_date=None, closed_by=None):
+        """日结：汇总营业日（默认今天）并冻结保存为Z报表，返回保存的报表；已日结时抛出 DayClosedError
+
+        汇总和保存在同一个写事务中进行，期间写入的销售要么计入报表，要么在日结之后被拒绝（见 _check_day_open）
+        """
+        business_date = self._business_date(business_date)
+        
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT 1 FROM z_reports WHERE business_date = ?', (business_date,))
+            if cursor.fetchone():
+                raise DayClosedError(f'Business day already closed: {business_date}')
+            summary, cashiers, products = self._compute_z_report(business_date, cursor)
+            columns = Z_REPORT_COLUMNS[4:]
+            cursor.execute('INSERT INTO z_reports (business_date, closed_by, {}) VALUES (?, ?, {})'.format(
+                ', '.join(columns), ', '.join('?' * len(columns))),
+                [business_date, closed_by] + [summary[column] for column in columns])
+            report_id = cursor.lastrowid
+            cursor.executemany('INSERT INTO z_report_cashiers (report_id, {}) VALUES (?, {})'.format(
+                ', '.join(Z_REPORT_CASHIER_COLUMNS), ', '.join('?' * len(Z_REPORT_CASHIER_COLUMNS))),
+                [[report_id] + [entry[column] for column in Z_REPORT_CASHIER_COLUMNS] for entry in cashiers])
+            cursor.executemany('INSERT INTO z_report_products (report_id, {}) VALUES (?, {})'.format(
+                ', '.join(Z_REPORT_PRODUCT_COLUMNS), ', '.join('?' * len(Z_REPORT_PRODUCT_COLUMNS))),
+                [[report_id] + [entry[column] for column in Z_REPORT_PRODUCT_COLUMNS] for entry in products])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return self.get_z_report(business_date)
+    
+    def close_previous_day(self, closed_by='scheduler'):
+        """日结昨天（尚未日结时），返回 (营业日, 是否本次日结)"""
+        business_date = self._business_date('yesterday')
+        try:
+            self.close_day(business_date, closed_by)
+            return business_date, True
+        except DayClosedError:
+            return business_date, False
+    
+    def get_z_report(self, business_date=None):
+        """读取营业日的Z报表（含收银员和产品明细）；尚未日结时返回按当前数据计算的预览（closed 为 False）"""
+        business_date = self._business_date(business_date)
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT {} FROM z_reports WHERE business_date = ?'.format(', '.join(Z_REPORT_COLUMNS)),
+                           (business_date,))
+            row = cursor.fetchone()
+            if row:
+                report = dict(zip(Z_REPORT_COLUMNS, row))
+                cursor.execute('''
+                    SELECT {} FROM z_report_cashiers WHERE report_id = ? ORDER BY revenue DESC, cashier
+                '''.format(', '.join(Z_REPORT_CASHIER_COLUMNS)), (report['id'],))
+                report['cashiers'] = [dict(zip(Z_REPORT_CASHIER_COLUMNS, r)) for r in cursor.fetchall()]
+                cursor.execute('''
+                    SELECT {} FROM z_report_products WHERE report_id = ? ORDER BY revenue DESC, barcode
+                '''.format(', '.join(Z_REPORT_PRODUCT_COLUMNS)), (report['id'],))
+                report['products'] = [dict(zip(Z_REPORT_PRODUCT_COLUMNS, r)) for r in cursor.fetchall()]
+                report['closed'] = True
+                return report
+        finally:
+            conn.close()
+        
+        summary, cashiers, products = self._compute_z_report(business_date)
+        summary.update({'closed': False, 'cashiers': cashiers, 'products': products})
+        return summary
+    
+    def get_z_reports(self, limit=30, offset=0):
+        """已保存的Z报表汇总（不含明细），按营业日倒序"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) FROM z_reports')
+            total = cursor.fetchone()[0]
+            cursor.execute('SELECT {} FROM z_reports ORDER BY business_date DESC LIMIT ? OFFSET ?'.format(
+                ', '.join(Z_REPORT_COLUMNS)), (limit, offset))
+            return {'items': [dict(zip(Z_REPORT_COLUMNS, row)) for row in cursor.fetchall()], 'total': total}
+        finally:
+            conn.close()
+    
+    def _daily_product_sales(self, start_date, end_date):
+        """按 (条码, 日期) 汇总日期范围内的销量（读取主库及归档分区）"""
+        query = '''
+            SELECT barcode, substr(date, 1, 10) AS day, SUM(quantity)
+            FROM sales WHERE date >= ? AND date < ?
+            GROUP BY barcode, day
+        '''
+        totals = {}
+        for connect in self._partition_sources(start_date, end_date):
+            for barcode, day, quantity in self._iter_rows(query, (start_date, end_date), connect=connect):
+                totals[barcode, day] = totals.get((barcode, day), 0) + quantity
+        return totals
+
+    def update_demand_forecasts(self, through=None, rebuild=False):
+        """将各产品的需求预测更新到 through（默认昨天）为止，只读取上次更新之后的销售
+
+        首次计算（或 rebuild）时读取最近 FORECAST_HISTORY_DAYS 天的历史；返回本次计入的天数等信息
+        """
+        through_day = (through or date.today() - timedelta(days=1)).toordinal()
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            if rebuild:
+                cursor.execute('DELETE FROM demand_forecasts')
+                conn.commit()
+            cursor.execute('SELECT product_id, level, square, first_day, through_day FROM demand_forecasts')
+            states = {row[0]: DemandState(*row[1:]) for row in cursor.fetchall()}
+            cursor.execute('SELECT barcode, id FROM products')
+            product_ids = dict(cursor.fetchall())
+        finally:
+            conn.close()
+
+        watermark = max((state.day for state in states.values()), default=None)
+        start_day = watermark + 1 if watermark is not None else through_day - FORECAST_HISTORY_DAYS + 1
+        if start_day > through_day:
+            return {'through': date.fromordinal(through_day).isoformat(), 'days': 0, 'products': len(states)}
+
+        # 只有有销售的 (产品, 日期) 需要逐个计入，其余日子在下一次计入或最后统一衰减
+        totals = self._daily_product_sales(date.fromordinal(start_day).strftime('%Y-%m-%d'),
+                                           date.fromordinal(through_day + 1).strftime('%Y-%m-%d'))
+        day_numbers = {}
+        for (barcode, day), quantity in sorted(totals.items()):
+            product_id = product_ids.get(barcode)
+            if product_id is None:
+                continue  # 已删除的产品
+            state = states.get(product_id)
+            if state is None:
+                state = states[product_id] = DemandState()
+            if day not in day_numbers:
+                day_numbers[day] = date.fromisoformat(day).toordinal()
+            state.advance(day_numbers[day], quantity)
+        for state in states.values():
+            if state.day < through_day:
+                state.advance(through_day)
+
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT OR REPLACE INTO demand_forecasts (product_id, level, square, first_day, through_day)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(product_id, state.level, state.square, state.first_day, state.day)
+                  for product_id, state in states.items()])
+            conn.commit()
+        finally:
+            conn.close()
+        return {
+            'through': date.fromordinal(through_day).isoformat(),
+            'days': through_day - start_day + 1,
+            'products': len(states),
+            'sale_days': len(totals)
+        }
+
+    def get_reorder_suggestions(self, lead_time, service_level, review_days, include_all=False, limit=100, offset=0):
+        """补货建议：按需求预测计算各产品的安全库存、补货点和建议补货量
+
+        默认只返回可售数量不高于补货点的产品，按可售天数升序（最急的在前）；
+        同时给出最近 MOVING_AVERAGE_DAYS 天的简单移动平均日销量作对照
+        """
+        z = service_level_z(service_level)
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT p.id, p.barcode, p.name, p.category, p.quantity - p.reserved_quantity,
+                       f.level, f.square, f.first_day, f.through_day
+                FROM products p JOIN demand_forecasts f ON f.product_id = p.id
+            ''')
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+
+        through_day = max((row[8] for row in rows), default=None)
+        moving_totals = {}
+        if through_day is not None:
+            window_start = date.fromordinal(through_day - MOVING_AVERAGE_DAYS + 1).strftime('%Y-%m-%d')
+            window_end = date.fromordinal(through_day + 1).strftime('%Y-%m-%d')
+            for (barcode, _), quantity in self._daily_product_sales(window_start, window_end).items():
+                moving_totals[barcode] = moving_totals.get(barcode, 0) + quantity
+
+        items = []
+        for product_id, barcode, name, category, available, level, square, first_day, day in rows:
+            state = DemandState(level, square, first_day, day)
+            suggestion = reorder_suggestion(available, state.mean(), state.std(), lead_time, z, review_days)
+            if not include_all and not (suggestion['daily_demand'] > 0 and available <= suggestion['reorder_point']):
+                continue
+            suggestion.update({
+                'id': product_id, 'barcode': barcode, 'name': name, 'category': category,
+                'available_quantity': available,
+                'moving_average': round(moving_totals.get(barcode, 0) / MOVING_AVERAGE_DAYS, 3)
+            })
+            items.append(suggestion)
+        items.sort(key=lambda item: (item['days_of_cover'] is None, item['days_of_cover'] or 0, item['barcode']))
+
+        return {
+            'through': date.fromordinal(through_day).isoformat() if through_day is not None else None,
+            'lead_time': lead_time,
+            'service_level': service_level,
+            'review_days': review_days,
+            'total': len(items),
+            'items': items[offset:offset + limit]
+        }
+
+    def get_sales_after(self, after_id, start_date):
+        """读取 id 大于 after_id 且销售时间不早于 start_date 的销售（按 id 升序），返回 (销售列表, 当前最大销售id)"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM sales')
+            max_id = cursor.fetchone()[0]
+            cursor.execute('''
+                SELECT s.id, s.barcode, s.name, s.quantity, s.total_price, s.date, ti.transaction_id
+                FROM sales s LEFT JOIN transaction_items ti ON ti.sale_id = s.id
+                WHERE s.id > ? AND s.id <= ? AND s.date >= ?
+                ORDER BY s.id
+            ''', (after_id, max_id, start_date))
+            columns = ('id', 'barcode', 'name', 'quantity', 'total_price', 'date', 'transaction_id')
+            return [dict(zip(columns, row)) for row in cursor.fetchall()], max_id
+        finally:
+            conn.close()
+
+    def get_sale_voids_after(self, after_id, start_date):
+        """读取 id 大于 after_id 且原销售时间不早于 start_date 的作废记录（按 id 升序），返回 (作废记录列表, 当前最大作废id)；
+        transaction_deleted 表示作废后所属交易已不存在且这是该交易最后一条作废记录。after_id 为 None 时只返回最大作废id"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM sale_voids')
+            max_id = cursor.fetchone()[0]
+            if after_id is None:
+                return [], max_id
+            cursor.execute('''
+                SELECT v.id, v.sale_id, v.barcode, v.name, v.quantity, v.total_price, v.sale_date, v.transaction_id,
+                       v.transaction_id IS NOT NULL
+                       AND NOT EXISTS (SELECT 1 FROM transactions t WHERE t.id = v.transaction_id)
+                       AND NOT EXISTS (SELECT 1 FROM sale_voids later
+                                       WHERE later.transaction_id = v.transaction_id AND later.id > v.id)
+                FROM sale_voids v
+                WHERE v.id > ? AND v.id <= ? AND v.sale_date >= ?
+                ORDER BY v.id
+            ''', (after_id, max_id, start_date))
+            columns = ('id', 'sale_id', 'barcode', 'name', 'quantity', 'total_price', 'date', 'transaction_id',
+                       'transaction_deleted')
+            return [dict(zip(columns, row)) for row in cursor.fetchall()], max_id
+        finally:
+            conn.close()
+
+    def get_sales_per_minute(self, start_date, through_id, extra_ids=()):
+        """销售时间不早于 start_date、id 不大于 through_id（或在 extra_ids 中）的销售按分钟汇总，
+        返回 (分钟 'YYYY-MM-DD HH:MM', 销售额, 销量, 交易数) 列表"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            extra_ids = list(extra_ids)
+            cursor.execute('''
+                SELECT substr(s.date, 1, 16), SUM(s.total_price), SUM(s.quantity),
+                       COUNT(DISTINCT COALESCE(ti.transaction_id, -s.id))
+                FROM sales s LEFT JOIN transaction_items ti ON ti.sale_id = s.id
+                WHERE s.date >= ? AND (s.id <= ?{})
+                GROUP BY substr(s.date, 1, 16)
+            '''.format(' OR s.id IN ({})'.format(', '.join('?' * len(extra_ids))) if extra_ids else ''),
+                [start_date, through_id] + extra_ids)
+            return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def save_sales_analytics(self, last_sale_id, applied_ids, rows, last_void_id=None, applied_void_ids=()):
+        """保存实时销售分析的计数器（整体替换上一次的保存点）"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('DELETE FROM sales_analytics_buckets')
+            cursor.executemany('''
+                INSERT INTO sales_analytics_buckets (granularity, bucket, barcode, name, quantity, revenue)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            cursor.execute('''
+                INSERT OR REPLACE INTO sales_analytics_state (id, last_sale_id, applied_ids, last_void_id,
+                                                              applied_void_ids, saved_at)
+                VALUES (1, ?, ?, ?, ?, datetime('now', 'localtime'))
+            ''', (last_sale_id, json.dumps(applied_ids), last_void_id, json.dumps(list(applied_void_ids))))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return len(rows)
+
+    def load_sales_analytics(self):
+        """读取实时销售分析的保存点，返回 (last_sale_id, 已计入的更大的销售id列表, 行列表, last_void_id,
+        已扣除的更大的作废id列表)；没有保存点时返回 None"""
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT last_sale_id, applied_ids, last_void_id, applied_void_ids FROM sales_analytics_state WHERE id = 1
+            ''')
+            state = cursor.fetchone()
+            if state is None:
+                return None
+            cursor.execute('''
+                SELECT granularity, bucket, barcode, name, quantity, revenue FROM sales_analytics_buckets
+            ''')
+            return state[0], json.loads(state[1]), cursor.fetchall(), state[2], json.loads(state[3] or '[]')
+        finally:
+            conn.close()
+
     # 用户管理方法
     def authenticate_user(self, username, password):
         """验证用户登录"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             # 先获取用户信息（包括密码哈希）
@@ -473,7 +2966,7 @@ class POSDatabase:
     def get_user_by_id(self, user_id):
         """根据ID获取用户信息"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             cursor.execute('SELECT id, username, role FROM users WHERE id = ?', (user_id,))
@@ -495,7 +2988,7 @@ class POSDatabase:
     def get_all_users(self):
         """获取所有用户（仅root可用）"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             cursor.execute('SELECT id, username, role, created_at FROM users ORDER BY created_at DESC')
@@ -522,7 +3015,7 @@ class POSDatabase:
             if role not in ['root', 'admin', 'user']:
                 return False
                 
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             # 哈希密码
@@ -536,7 +3029,8 @@ class POSDatabase:
             conn.commit()
             conn.close()
             return True
-        except sqlite3.IntegrityError:
+        except self.backend.IntegrityError:
+            conn.close()  # 未关闭的连接会一直持有写锁
             return False  # 用户名重复
         except Exception as e:
             print(f"Error adding user: {e}")
@@ -548,7 +3042,7 @@ class POSDatabase:
             if role not in ['root', 'admin', 'user']:
                 return False
                 
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             if password:
@@ -569,7 +3063,8 @@ class POSDatabase:
             conn.commit()
             conn.close()
             return True
-        except sqlite3.IntegrityError:
+        except self.backend.IntegrityError:
+            conn.close()  # 未关闭的连接会一直持有写锁
             return False  # 用户名重复
         except Exception as e:
             print(f"Error updating user: {e}")
@@ -578,7 +3073,7 @@ class POSDatabase:
     def delete_user(self, user_id):
         """删除用户（仅root可用）"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             # 检查是否为默认用户
@@ -601,7 +3096,7 @@ class POSDatabase:
     def change_password(self, user_id, old_password, new_password):
         """修改密码"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
             
             # 获取当前密码哈希
@@ -0,0 +1,220 @@
+"""
+销售数据的列式导出
+将销售记录按月分区写入列式压缩文件（export/sales/month=YYYY-MM/part-<首个id>.<扩展名>），产品表整体写入 products.<扩展名>；
+每次只导出上次之后的新销售（按销售id递增）；导出之后有销售被作废时，重写这些销售所在月份的文件。
+安装了 pyarrow（pip install pyarrow）时写入 Parquet 或 Arrow IPC 文件，否则写入 NumPy 的 .npz 文件
+（按 .npy 格式直接生成，写入时不需要 numpy，读取时用 numpy.load）。
+导出目录下的 _manifest.json 记录格式、字段类型、已导出的文件、最后一个销售id和最后处理的作废记录id
+"""
+
+import calendar
+import json
+import os
+import shutil
+import sys
+import zipfile
+from array import array
+from datetime import datetime
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # pyarrow 为可选依赖
+    pyarrow = None
+
+EXPORT_FORMATS = ('parquet', 'arrow', 'npz')
+EXPORT_EXTENSIONS = {'parquet': '.parquet', 'arrow': '.arrow', 'npz': '.npz'}
+# 每个文件最多包含的销售记录数（同一月份超出时分为多个文件）
+EXPORT_BATCH_ROWS = int(os.environ.get('EXPORT_BATCH_ROWS', 100000))
+EXPORT_MANIFEST = '_manifest.json'
+
+# 导出的字段及类型：int64、float64、string、timestamp（秒，按数据库中的本地时间）
+EXPORT_SCHEMA = {
+    'sales': (
+        ('id', 'int64'), ('barcode', 'string'), ('name', 'string'), ('quantity', 'int64'),
+        ('price', 'float64'), ('total_price', 'float64'), ('cost_price', 'float64'),
+        ('date', 'timestamp'), ('transaction_id', 'int64'),
+    ),
+    'products': (
+        ('id', 'int64'), ('barcode', 'string'), ('name', 'string'), ('category', 'string'),
+        ('quantity', 'int64'), ('cost_price', 'float64'), ('selling_price', 'float64'),
+        ('profit_margin', 'float64'), ('low_stock_threshold', 'int64'),
+        ('effective_low_stock_threshold', 'int64'),
+    ),
+}
+
+# .npz 中的空值：整数为 -1，浮点数为 NaN，字符串为空串，时间为 NaT
+NPZ_INT_NULL = -1
+NPZ_NAT = -2 ** 63
+
+
+def default_format():
+    return 'parquet' if pyarrow is not None else 'npz'
+
+
+def validate_format(export_format):
+    """检查导出格式，未指定时按已安装的库选择；格式不可用时抛出 ValueError"""
+    export_format = export_format or default_format()
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError('format must be one of: {}'.format(', '.join(EXPORT_FORMATS)))
+    if export_format in ('parquet', 'arrow') and pyarrow is None:
+        raise ValueError('{} export requires pyarrow (pip install pyarrow)'.format(export_format))
+    return export_format
+
+
+def to_timestamp(value):
+    """数据库中的时间 'YYYY-MM-DD HH:MM:SS' 转为秒数（按本地时间原样计数，不做时区换算）"""
+    if not value:
+        return None
+    return calendar.timegm(datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S').timetuple())
+
+
+def load_manifest(export_dir):
+    """读取导出目录的 _manifest.json，尚未导出时返回 None"""
+    path = os.path.join(export_dir, EXPORT_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class ColumnarExport:
+    """导出目录：按列写入文件并维护 _manifest.json"""
+
+    def __init__(self, export_dir, export_format=None, rebuild=False):
+        self.export_dir = export_dir
+        self.manifest = load_manifest(export_dir)
+        if rebuild or self.manifest is None:
+            self.format = validate_format(export_format)
+            if rebuild and os.path.isdir(export_dir):
+                shutil.rmtree(export_dir)
+            self.manifest = {
+                'format': self.format,
+                'last_sale_id': 0,
+                'last_void_id': 0,
+                'schema': {table: dict(columns) for table, columns in EXPORT_SCHEMA.items()},
+                'files': {'sales': [], 'products': None},
+            }
+        else:
+            self.format = self.manifest['format']
+            if export_format and export_format != self.format:
+                validate_format(export_format)
+                raise ValueError('Export directory already contains {} files; use rebuild to change the format'.format(
+                    self.format))
+            validate_format(self.format)
+        os.makedirs(export_dir, exist_ok=True)
+
+    @property
+    def last_sale_id(self):
+        return self.manifest['last_sale_id']
+
+    @property
+    def last_void_id(self):
+        # 旧版本的清单没有该字段：从头检查所有作废记录
+        return self.manifest.get('last_void_id', 0)
+
+    def save_manifest(self, last_sale_id, last_void_id):
+        self.manifest['last_sale_id'] = last_sale_id
+        self.manifest['last_void_id'] = last_void_id
+        self.manifest['exported_at'] = datetime.now().isoformat()
+        path = os.path.join(self.export_dir, EXPORT_MANIFEST)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def write_sales(self, month, rows):
+        """写入一个月份的一批销售（字段顺序同 EXPORT_SCHEMA['sales']，按id升序），返回相对路径"""
+        relpath = 'sales/month={}/part-{:012d}{}'.format(month, rows[0][0], EXPORT_EXTENSIONS[self.format])
+        self._write(relpath, EXPORT_SCHEMA['sales'], rows)
+        self.manifest['files']['sales'].append(relpath)
+        return relpath
+
+    def detach_sales(self, month):
+        """从清单中移除一个月份的全部销售文件（文件保留，重写后用 remove_files 删除），返回其相对路径"""
+        prefix = 'sales/month={}/'.format(month)
+        detached = [relpath for relpath in self.manifest['files']['sales'] if relpath.startswith(prefix)]
+        self.manifest['files']['sales'] = [relpath for relpath in self.manifest['files']['sales']
+                                           if not relpath.startswith(prefix)]
+        return detached
+
+    def remove_files(self, relpaths):
+        """删除不再列在清单中的文件"""
+        listed = set(self.manifest['files']['sales'])
+        for relpath in relpaths:
+            path = os.path.join(self.export_dir, *relpath.split('/'))
+            if relpath not in listed and os.path.exists(path):
+                os.remove(path)
+
+    def write_products(self, rows):
+        """整体替换产品表文件，返回相对路径"""
+        relpath = 'products' + EXPORT_EXTENSIONS[self.format]
+        self._write(relpath, EXPORT_SCHEMA['products'], rows)
+        self.manifest['files']['products'] = relpath
+        return relpath
+
+    def _write(self, relpath, schema, rows):
+        # 先写入临时文件再改名，读取方不会看到写了一半的文件
+        path = os.path.join(self.export_dir, *relpath.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        columns = [[row[index] for row in rows] for index in range(len(schema))]
+        for index, (name, column_type) in enumerate(schema):
+            if column_type == 'timestamp':
+                columns[index] = [to_timestamp(value) for value in columns[index]]
+        if self.format == 'npz':
+            write_npz(path + '.tmp', schema, columns)
+        else:
+            write_arrow(path + '.tmp', schema, columns, self.format)
+        os.replace(path + '.tmp', path)
+
+
+def write_arrow(path, schema, columns, export_format):
+    """写入 Parquet（zstd 压缩）或 Arrow IPC 文件（zstd 压缩，可用 pyarrow.memory_map 打开）"""
+    types = {'int64': pyarrow.int64(), 'float64': pyarrow.float64(), 'string': pyarrow.string()}
+    arrays = []
+    for (name, column_type), values in zip(schema, columns):
+        if column_type == 'timestamp':
+            arrays.append(pyarrow.array(values, type=pyarrow.int64()).cast(pyarrow.timestamp('s')))
+        else:
+            arrays.append(pyarrow.array(values, type=types[column_type]))
+    table = pyarrow.Table.from_arrays(arrays, names=[name for name, column_type in schema])
+    if export_format == 'parquet':
+        pyarrow.parquet.write_table(table, path, compression='zstd')
+        return
+    options = pyarrow.ipc.IpcWriteOptions(compression='zstd')
+    with pyarrow.OSFile(path, 'wb') as sink, pyarrow.ipc.new_file(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+
+
+def write_npz(path, schema, columns):
+    """写入与 numpy.savez_compressed 相同格式的 .npz 文件，每个字段一个 .npy 数组"""
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for (name, column_type), values in zip(schema, columns):
+            descr, data = npy_column(column_type, values)
+            archive.writestr(name + '.npy', npy_header(descr, len(values)) + data)
+
+
+def npy_header(descr, length):
+    """.npy 1.0 格式的文件头（长度对齐到64字节）"""
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}".format(descr, length)
+    padding = 64 - (10 + len(header) + 1) % 64
+    header = (header + ' ' * (padding % 64) + '\n').encode('latin-1')
+    return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header
+
+
+def npy_column(column_type, values):
+    """一列数据的 (dtype 描述, 小端字节)"""
+    if column_type == 'string':
+        values = ['' if value is None else str(value) for value in values]
+        width = max([len(value) for value in values] + [1])
+        return '<U{}'.format(width), b''.join(value.encode('utf-32-le').ljust(width * 4, b'\0') for value in values)
+    if column_type == 'float64':
+        data = array('d', [float('nan') if value is None else value for value in values])
+        descr = '<f8'
+    else:
+        null = NPZ_NAT if column_type == 'timestamp' else NPZ_INT_NULL
+        data = array('q', [null if value is None else value for value in values])
+        descr = '<M8[s]' if column_type == 'timestamp' else '<i8'
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return descr, data.tobytes()
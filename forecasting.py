@@ -0,0 +1,85 @@
+"""
+需求预测与补货点
+按产品的每日销量做指数平滑（EWMA），同时平滑销量的平方以得到日需求的波动（标准差）；
+没有销售的日子销量为 0，相隔 k 天的两次销售之间的衰减合并为一次 (1 - α)^k，
+因此只需处理有销售的 (产品, 日期) 组合，每日增量更新只读取新一天的销售。
+补货点 = 日均需求 × 到货天数 + 安全库存，安全库存 = z × 日需求标准差 × √到货天数
+"""
+
+import math
+import os
+from statistics import NormalDist
+
+# 平滑系数：越大越侧重近期销量
+FORECAST_ALPHA = float(os.environ.get('FORECAST_ALPHA', 0.1))
+# 首次计算时读取的销售历史天数
+FORECAST_HISTORY_DAYS = int(os.environ.get('FORECAST_HISTORY_DAYS', 730))
+# 补货建议的默认参数：到货天数、服务水平（不缺货的概率）和补货周期天数
+REORDER_LEAD_TIME_DAYS = int(os.environ.get('REORDER_LEAD_TIME_DAYS', 7))
+REORDER_SERVICE_LEVEL = float(os.environ.get('REORDER_SERVICE_LEVEL', 0.95))
+REORDER_REVIEW_DAYS = int(os.environ.get('REORDER_REVIEW_DAYS', 7))
+# 与指数平滑对照的简单移动平均的天数
+MOVING_AVERAGE_DAYS = 28
+
+
+class DemandState:
+    """一个产品的平滑状态：day 为已计入的最后一天（日序数），first_day 为第一次有销售的日期"""
+
+    __slots__ = ('level', 'square', 'first_day', 'day')
+
+    def __init__(self, level=0.0, square=0.0, first_day=None, day=None):
+        self.level = level
+        self.square = square
+        self.first_day = first_day
+        self.day = day
+
+    def advance(self, day, quantity=0, alpha=FORECAST_ALPHA):
+        """计入 day 当天的销量（之前未计入的日子销量为 0）"""
+        if self.day is None:
+            self.first_day = day
+            self.day = day - 1
+        decay = (1 - alpha) ** (day - self.day)
+        self.level = self.level * decay + alpha * quantity
+        self.square = self.square * decay + alpha * quantity * quantity
+        self.day = day
+
+    def _weight(self, alpha):
+        # 平滑初值为 0，按已计入的天数修正偏低的估计
+        if self.day is None:
+            return 0
+        return 1 - (1 - alpha) ** (self.day - self.first_day + 1)
+
+    def mean(self, alpha=FORECAST_ALPHA):
+        """日均需求"""
+        weight = self._weight(alpha)
+        return self.level / weight if weight > 0 else 0.0
+
+    def std(self, alpha=FORECAST_ALPHA):
+        """日需求的标准差"""
+        weight = self._weight(alpha)
+        if weight <= 0:
+            return 0.0
+        mean = self.level / weight
+        return math.sqrt(max(self.square / weight - mean * mean, 0.0))
+
+
+def service_level_z(service_level):
+    """服务水平对应的标准正态分位数，如 0.95 -> 1.645"""
+    if not 0.5 <= service_level < 1:
+        raise ValueError('service_level must be between 0.5 and 1')
+    return NormalDist().inv_cdf(service_level)
+
+
+def reorder_suggestion(available, mean, std, lead_time, z, review_days):
+    """计算安全库存、补货点和建议补货量（补到 补货点 + 补货周期内的需求）"""
+    safety_stock = z * std * math.sqrt(lead_time)
+    reorder_point = mean * lead_time + safety_stock
+    order_up_to = reorder_point + mean * review_days
+    return {
+        'daily_demand': round(mean, 3),
+        'demand_std': round(std, 3),
+        'safety_stock': math.ceil(safety_stock),
+        'reorder_point': math.ceil(reorder_point),
+        'days_of_cover': round(available / mean, 1) if mean > 0 else None,
+        'suggested_quantity': max(math.ceil(order_up_to - available), 0) if available <= reorder_point else 0
+    }
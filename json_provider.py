@@ -0,0 +1,99 @@
+"""
+快速JSON序列化层
+优先使用 orjson 编码（如已安装），否则回退到标准库 json；
+并缓存产品目录中每一行预先序列化好的JSON片段
+"""
+
+import json
+import threading
+from flask.json.provider import DefaultJSONProvider
+
+from database import PRODUCT_COLUMNS
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖
+    orjson = None
+
+
+def dumps_bytes(obj, default=DefaultJSONProvider.default, sort_keys=False):
+    """将对象编码为紧凑的UTF-8 JSON字节串"""
+    if orjson is not None:
+        # 日期时间和 dataclass 交给 default 处理，与 Flask 默认提供者的输出一致（日期为 HTTP 日期格式）
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=default, option=option)
+    return json.dumps(obj, default=default, ensure_ascii=False, sort_keys=sort_keys,
+                      separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """使用快速编码器的Flask JSON提供者
+
+    日期时间、Decimal、UUID 和 dataclass 的输出与默认提供者相同；使用 orjson 时的差异：
+    NaN/Infinity 输出为 null（标准库输出非标准的 NaN），超出64位的整数会报错
+    """
+
+    def dumps(self, obj, **kwargs):
+        # 有额外参数（如indent）时交给标准库处理，保证兼容
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps_bytes(obj, default=self.default, sort_keys=self.sort_keys).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # 调试模式下保留带缩进的可读输出
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = dumps_bytes(obj, default=self.default, sort_keys=self.sort_keys)
+        return self._app.response_class(body + b'\n', mimetype=self.mimetype)
+
+
+class ProductFragmentCache:
+    """按产品id缓存已序列化的JSON片段，行内容未变化时直接复用"""
+
+    def __init__(self):
+        self._fragments = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def render(self, rows):
+        """将产品行拼接为完整的 {"data": [...], "success": true} 响应体"""
+        with self._lock:
+            fragments = dict(self._fragments)
+            generation = self._generation
+        parts = []
+        updated = {}
+        seen = set()
+        for row in rows:
+            product_id = row[0]
+            cached = fragments.get(product_id)
+            if cached is None or cached[0] != row:
+                fragment = dumps_bytes(dict(zip(PRODUCT_COLUMNS, row)), sort_keys=True)
+                updated[product_id] = (row, fragment)
+            else:
+                fragment = cached[1]
+            parts.append(fragment)
+            seen.add(product_id)
+
+        # 新片段在锁内合并，并清理已删除产品的缓存片段；期间缓存被清空时不再写回
+        with self._lock:
+            if generation == self._generation:
+                self._fragments.update(updated)
+                if len(self._fragments) > len(seen):
+                    for product_id in [pid for pid in self._fragments if pid not in seen]:
+                        del self._fragments[product_id]
+
+        return b'{"data":[' + b','.join(parts) + b'],"success":true}\n'
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._fragments.clear()
+            self._generation += 1
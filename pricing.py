@@ -0,0 +1,97 @@
+"""
+批量调价
+按规则（目标毛利率、加成率或按比例调整售价）对一组产品的价格整列计算，再按价格步长和尾数取整；
+计算规则与产品页面的利润计算器一致：售价 = 成本价 ÷ (1 - 毛利率/100)。
+安装了 numpy（pip install numpy）时按数组整体计算，否则逐个计算，结果相同
+"""
+
+import hashlib
+import math
+
+try:
+    import numpy
+except ImportError:  # numpy 为可选依赖
+    numpy = None
+
+# 调价方式：margin 目标毛利率（%），markup 成本加成率（%），adjust 按当前售价调整的百分比
+REPRICE_MODES = ('margin', 'markup', 'adjust')
+# 默认按分取整
+DEFAULT_PRICE_STEP = 0.01
+
+
+class PreviewMismatchError(ValueError):
+    """提交调价时产品价格与预览时不一致"""
+
+
+def validate_rule(rule):
+    """检查并规范化调价规则，返回 (mode, value, step, ending)；规则无效时抛出 ValueError"""
+    if not isinstance(rule, dict):
+        raise ValueError('rule must be an object')
+    mode = rule.get('mode')
+    if mode not in REPRICE_MODES:
+        raise ValueError('rule.mode must be one of: {}'.format(', '.join(REPRICE_MODES)))
+    try:
+        value = float(rule.get('value'))
+        step = float(rule.get('step') or DEFAULT_PRICE_STEP)
+        ending = float(rule['ending']) if rule.get('ending') is not None else None
+    except (TypeError, ValueError):
+        raise ValueError('rule.value, rule.step and rule.ending must be numbers')
+    if mode == 'margin' and not 0 <= value < 100:
+        raise ValueError('Profit margin must be between 0 and 100 (exclusive)')
+    if mode in ('markup', 'adjust') and value <= -100:
+        raise ValueError('Percentage must be greater than -100')
+    if step <= 0:
+        raise ValueError('rule.step must be greater than 0')
+    if ending is not None and not 0 <= ending < 1:
+        raise ValueError('rule.ending must be between 0 and 1, e.g. 0.99')
+    return mode, value, step, ending
+
+
+def compute_prices(cost_prices, selling_prices, rule):
+    """按规则计算新售价（列表，顺序与输入一致），已取整到分"""
+    mode, value, step, ending = validate_rule(rule)
+    if numpy is not None:
+        return _compute_vectorized(cost_prices, selling_prices, mode, value, step, ending)
+    return [_compute_one(cost, selling, mode, value, step, ending)
+            for cost, selling in zip(cost_prices, selling_prices)]
+
+
+def _compute_vectorized(cost_prices, selling_prices, mode, value, step, ending):
+    cost = numpy.asarray(cost_prices, dtype=float)
+    if mode == 'margin':
+        prices = cost / (1 - value / 100)
+    elif mode == 'markup':
+        prices = cost * (1 + value / 100)
+    else:
+        prices = numpy.asarray(selling_prices, dtype=float) * (1 + value / 100)
+    # 先四舍五入到分，避免浮点误差使整数倍的价格被多进一档
+    prices = numpy.round(numpy.round(prices, 6) / step) * step
+    if ending is not None:
+        prices = numpy.ceil(numpy.round(prices - ending, 6)) + ending
+    return numpy.round(prices, 2).tolist()
+
+
+def _compute_one(cost, selling, mode, value, step, ending):
+    if mode == 'margin':
+        price = cost / (1 - value / 100)
+    elif mode == 'markup':
+        price = cost * (1 + value / 100)
+    else:
+        price = selling * (1 + value / 100)
+    price = round(round(price, 6) / step) * step
+    if ending is not None:
+        price = math.ceil(round(price - ending, 6)) + ending
+    return round(price, 2)
+
+
+def profit_margin(cost_price, selling_price):
+    """毛利率（%），与 add_product/update_product 的计算一致"""
+    return ((selling_price - cost_price) / selling_price) * 100
+
+
+def preview_token(changes):
+    """调价预览的校验值：由产品id、原售价和新售价计算，提交时用于确认价格在预览后未被修改"""
+    digest = hashlib.sha256()
+    for change in changes:
+        digest.update('{}:{!r}:{!r};'.format(change['id'], change['old_price'], change['new_price']).encode('utf-8'))
+    return digest.hexdigest()
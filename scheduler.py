@@ -0,0 +1,270 @@
+"""
+进程内后台任务调度器
+支持固定间隔任务和类 cron 表达式任务，任务在独立线程中执行，不占用请求处理；
+独占任务通过数据库中的任务租约保证多个工作进程中同一时间只有一个执行，
+并按上次执行时间避免各进程重复执行；每个任务记录执行次数、耗时和错误等指标
+"""
+
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+# 调度线程最长休眠时间（秒），保证系统时间调整后能及时重新计算
+MAX_SLEEP_SECONDS = 30
+
+# 独占任务租约的默认有效期（秒），执行超过该时间视为进程已异常退出
+DEFAULT_LEASE_SECONDS = 600
+
+CRON_FIELD_RANGES = (
+    (0, 59),  # 分
+    (0, 23),  # 时
+    (1, 31),  # 日
+    (1, 12),  # 月
+    (0, 6),   # 星期（0为星期日）
+)
+
+
+def _format_timestamp(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S') if timestamp else None
+
+
+def parse_cron_field(field, minimum, maximum):
+    """解析 cron 表达式的单个字段，支持 *、*/n、a-b、a-b/n 和逗号分隔的列表"""
+    values = set()
+    for part in field.split(','):
+        part, _, step = part.partition('/')
+        step = int(step) if step else 1
+        if part == '*':
+            start, end = minimum, maximum
+        elif '-' in part:
+            start, end = (int(value) for value in part.split('-', 1))
+        else:
+            start = end = int(part)
+        if step <= 0 or start < minimum or end > maximum or start > end:
+            raise ValueError(f'Invalid cron field: {field}')
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    """五段式 cron 表达式（分 时 日 月 星期），按本地时间计算"""
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f'Cron expression must have 5 fields: {expression}')
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            parse_cron_field(field, minimum, maximum)
+            for field, (minimum, maximum) in zip(fields, CRON_FIELD_RANGES)
+        )
+        # 与标准 cron 一致：日和星期都有限制时，满足其一即可
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def _day_matches(self, moment):
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, timestamp):
+        """返回指定时间之后的下一次执行时间（时间戳）"""
+        moment = datetime.fromtimestamp(timestamp).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366)
+        while moment < limit:
+            if moment.month not in self.months or not self._day_matches(moment):
+                moment = (moment + timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if moment.hour not in self.hours:
+                moment = (moment + timedelta(hours=1)).replace(minute=0)
+                continue
+            if moment.minute in self.minutes:
+                return moment.timestamp()
+            moment += timedelta(minutes=1)
+        raise ValueError(f'Cron expression never matches: {self.expression}')
+
+    def min_gap(self):
+        """两次执行之间的最小间隔（秒），用于判断其他进程是否已执行过本次任务"""
+        return 50
+
+
+class IntervalSchedule:
+    """固定间隔（秒）"""
+
+    def __init__(self, seconds):
+        if seconds <= 0:
+            raise ValueError('Interval must be greater than 0')
+        self.seconds = seconds
+        self.expression = f'every {seconds}s'
+
+    def next_after(self, timestamp):
+        return timestamp + self.seconds
+
+    def min_gap(self):
+        return self.seconds * 0.9
+
+
+class Job:
+    """一个已注册的后台任务及其执行指标"""
+
+    def __init__(self, name, func, schedule, exclusive=True, lease_seconds=DEFAULT_LEASE_SECONDS,
+                 run_at_start=False):
+        self.name = name
+        self.func = func
+        self.schedule = schedule
+        self.exclusive = exclusive
+        self.lease_seconds = lease_seconds
+        self.next_run = time.time() if run_at_start else schedule.next_after(time.time())
+        self.running = False
+        self.forced = False  # 手动触发的执行不受最小间隔限制
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.total_duration = 0.0
+        self.last_started_at = None
+        self.last_duration = None
+        self.last_result = None
+        self.last_error = None
+
+    def metrics(self):
+        return {
+            'name': self.name,
+            'schedule': self.schedule.expression,
+            'exclusive': self.exclusive,
+            'running': self.running,
+            'next_run_at': _format_timestamp(self.next_run),
+            'runs': self.runs,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'last_started_at': _format_timestamp(self.last_started_at),
+            'last_duration_ms': round(self.last_duration * 1000, 1) if self.last_duration is not None else None,
+            'avg_duration_ms': round(self.total_duration / self.runs * 1000, 1) if self.runs else None,
+            'last_result': self.last_result,
+            'last_error': self.last_error,
+        }
+
+
+class Scheduler:
+    """后台任务调度器：一个调度线程负责计时，每次执行在单独的线程中进行"""
+
+    def __init__(self, db):
+        self.db = db
+        self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), id(self))
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_interval_job(self, name, func, seconds, **options):
+        """注册固定间隔执行的任务"""
+        return self._add(Job(name, func, IntervalSchedule(seconds), **options))
+
+    def add_cron_job(self, name, func, expression, **options):
+        """注册按 cron 表达式执行的任务，如 '30 3 * * *' 表示每天3:30"""
+        return self._add(Job(name, func, CronSchedule(expression), **options))
+
+    def _add(self, job):
+        with self._lock:
+            if job.name in self._jobs:
+                raise ValueError(f'Job already registered: {job.name}')
+            self._jobs[job.name] = job
+        self._wakeup.set()
+        return job
+
+    def get_metrics(self):
+        """返回所有任务的执行指标"""
+        with self._lock:
+            return [job.metrics() for job in self._jobs.values()]
+
+    def run_now(self, name):
+        """立即在后台执行任务（不等待结果），任务不存在时返回 False"""
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is None:
+                return False
+            job.next_run = time.time()
+            job.forced = True
+        self._wakeup.set()
+        return True
+
+    def start(self):
+        """启动调度线程"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        """停止调度线程（正在执行的任务在其线程中继续完成）"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            now = time.time()
+            with self._lock:
+                due = []
+                for job in self._jobs.values():
+                    if job.next_run > now:
+                        continue
+                    job.next_run = job.schedule.next_after(now)
+                    if job.running:
+                        # 上一次执行尚未结束，跳过本次
+                        job.skipped += 1
+                        continue
+                    job.running = True
+                    due.append(job)
+                next_run = min((job.next_run for job in self._jobs.values()), default=now + MAX_SLEEP_SECONDS)
+
+            for job in due:
+                threading.Thread(target=self._run, args=(job,), name=f'job-{job.name}', daemon=True).start()
+
+            self._wakeup.wait(min(max(next_run - time.time(), 0), MAX_SLEEP_SECONDS))
+            self._wakeup.clear()
+
+    def _run(self, job):
+        try:
+            if job.exclusive and not self._acquire(job):
+                job.skipped += 1
+                return
+
+            started = time.time()
+            job.last_started_at = started
+            try:
+                job.last_result = job.func()
+                job.last_error = None
+                succeeded = True
+            except Exception as e:
+                print(f"Error running job {job.name}: {e}")
+                job.failures += 1
+                job.last_error = str(e)
+                succeeded = False
+            job.last_duration = time.time() - started
+            job.total_duration += job.last_duration
+            job.runs += 1
+
+            if job.exclusive:
+                self._release(job, succeeded)
+        finally:
+            job.forced = False
+            job.running = False
+
+    def _acquire(self, job):
+        try:
+            min_gap = 0 if job.forced else job.schedule.min_gap()
+            return self.db.acquire_job_lease(job.name, self.owner, job.lease_seconds, min_gap)
+        except Exception as e:
+            print(f"Error acquiring lease for job {job.name}: {e}")
+            return False
+
+    def _release(self, job, succeeded):
+        try:
+            self.db.release_job_lease(job.name, self.owner, succeeded)
+        except Exception as e:
+            print(f"Error releasing lease for job {job.name}: {e}")
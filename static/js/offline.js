@@ -0,0 +1,268 @@
+// 离线收银支持
+// 销售记录先写入 IndexedDB 队列（带客户端生成的 client_ref），再在后台批量同步到 /api/sync；
+// 服务器按 client_ref 去重，重复提交不会产生重复销售或重复扣减库存；
+// 服务器拒绝的销售（数据校验失败）移入 rejected_sales 并附上错误信息，不再重试，由收银员查看后重新提交或放弃；
+// 其他写请求通过 idempotentFetch 携带 Idempotency-Key，可放心超时重试
+
+(function (window) {
+    const DB_NAME = 'pos-offline';
+    const DB_VERSION = 2;
+    const STORE = 'pending_sales';
+    const REJECTED_STORE = 'rejected_sales';
+    const SYNC_INTERVAL = 30000;
+    const SYNC_BATCH_SIZE = 200;
+
+    let dbPromise = null;
+    let flushPromise = null;
+    let options = null;
+
+    function openDb() {
+        if (!dbPromise) {
+            dbPromise = new Promise((resolve, reject) => {
+                const request = indexedDB.open(DB_NAME, DB_VERSION);
+                request.onupgradeneeded = () => {
+                    const db = request.result;
+                    [STORE, REJECTED_STORE].forEach(name => {
+                        if (!db.objectStoreNames.contains(name)) {
+                            db.createObjectStore(name, { keyPath: 'client_ref' });
+                        }
+                    });
+                };
+                request.onsuccess = () => resolve(request.result);
+                request.onerror = () => reject(request.error);
+            });
+        }
+        return dbPromise;
+    }
+
+    async function withStore(mode, callback, storeName = STORE) {
+        const db = await openDb();
+        return new Promise((resolve, reject) => {
+            const tx = db.transaction(storeName, mode);
+            const result = callback(tx.objectStore(storeName));
+            tx.oncomplete = () => resolve(result && 'result' in result ? result.result : undefined);
+            tx.onerror = () => reject(tx.error);
+        });
+    }
+
+    // 生成幂等键
+    function newKey() {
+        if (window.crypto && crypto.randomUUID) {
+            return crypto.randomUUID();
+        }
+        return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2, 12);
+    }
+
+    // 本收银台的标识（首次使用时生成并保存在 localStorage 中）
+    function terminalId() {
+        let id = localStorage.getItem('terminalId');
+        if (!id) {
+            id = 'till-' + newKey();
+            localStorage.setItem('terminalId', id);
+        }
+        return id;
+    }
+
+    // 本地时间，格式与数据库一致：YYYY-MM-DD HH:MM:SS
+    function localTimestamp(date = new Date()) {
+        const pad = n => String(n).padStart(2, '0');
+        return `${date.getFullYear()}-${pad(date.getMonth() + 1)}-${pad(date.getDate())} ` +
+            `${pad(date.getHours())}:${pad(date.getMinutes())}:${pad(date.getSeconds())}`;
+    }
+
+    // 将一条销售加入本地队列
+    async function queueSale(sale) {
+        const record = {
+            ...sale,
+            client_ref: sale.client_ref || newKey(),
+            date: sale.date || localTimestamp()
+        };
+        await withStore('readwrite', store => store.put(record));
+        return record;
+    }
+
+    async function pendingSales() {
+        return (await withStore('readonly', store => store.getAll())) || [];
+    }
+
+    async function pendingCount() {
+        return (await withStore('readonly', store => store.count())) || 0;
+    }
+
+    async function removeSales(refs) {
+        if (refs.length === 0) {
+            return;
+        }
+        await withStore('readwrite', store => {
+            refs.forEach(ref => store.delete(ref));
+        });
+    }
+
+    // 被服务器拒绝的销售（含 error 和 rejected_at）
+    async function rejectedSales() {
+        return (await withStore('readonly', store => store.getAll(), REJECTED_STORE)) || [];
+    }
+
+    // 将被拒绝的销售从待同步队列移到 rejected_sales（同一事务中完成）
+    async function rejectSales(failed, batch) {
+        const records = new Map(batch.map(record => [record.client_ref, record]));
+        const rejected = failed.filter(entry => records.has(entry.client_ref));
+        if (rejected.length === 0) {
+            return [];
+        }
+        const rejectedAt = localTimestamp();
+        const db = await openDb();
+        const entries = rejected.map(entry => ({
+            ...records.get(entry.client_ref),
+            error: entry.error,
+            rejected_at: rejectedAt
+        }));
+        await new Promise((resolve, reject) => {
+            const tx = db.transaction([STORE, REJECTED_STORE], 'readwrite');
+            entries.forEach(entry => {
+                tx.objectStore(REJECTED_STORE).put(entry);
+                tx.objectStore(STORE).delete(entry.client_ref);
+            });
+            tx.oncomplete = () => resolve();
+            tx.onerror = () => reject(tx.error);
+        });
+        return entries;
+    }
+
+    // 放弃一条被拒绝的销售
+    async function discardRejected(ref) {
+        await withStore('readwrite', store => store.delete(ref), REJECTED_STORE);
+    }
+
+    // 将被拒绝的销售重新放回待同步队列（例如补录产品后），并立即同步
+    async function retryRejected(ref) {
+        const db = await openDb();
+        await new Promise((resolve, reject) => {
+            const tx = db.transaction([STORE, REJECTED_STORE], 'readwrite');
+            const request = tx.objectStore(REJECTED_STORE).get(ref);
+            request.onsuccess = () => {
+                if (request.result) {
+                    const { error, rejected_at, ...record } = request.result;
+                    tx.objectStore(STORE).put(record);
+                    tx.objectStore(REJECTED_STORE).delete(ref);
+                }
+            };
+            tx.oncomplete = () => resolve();
+            tx.onerror = () => reject(tx.error);
+        });
+        return flush();
+    }
+
+    // 将队列中的销售同步到服务器，同一时间只进行一次同步
+    function flush() {
+        if (!flushPromise) {
+            flushPromise = doFlush().finally(() => {
+                flushPromise = null;
+            });
+        }
+        return flushPromise;
+    }
+
+    async function doFlush() {
+        const summary = { synced: 0, failed: [] };
+        if (!options || !navigator.onLine) {
+            return summary;
+        }
+
+        const pending = await pendingSales();
+        for (let i = 0; i < pending.length; i += SYNC_BATCH_SIZE) {
+            const batch = pending.slice(i, i + SYNC_BATCH_SIZE);
+            const response = await fetch(`${options.apiBase}/sync`, {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Authorization': `Bearer ${options.getToken()}`,
+                    'X-Terminal-Id': terminalId()
+                },
+                body: JSON.stringify({ sales: batch })
+            });
+            const result = await response.json();
+            if (!result.success) {
+                throw new Error(result.error || 'Sync failed');
+            }
+
+            const done = result.data.accepted.concat(result.data.duplicates);
+            await removeSales(done);
+            summary.synced += result.data.accepted.length;
+            // 校验失败重试也不会成功，移出队列等待收银员处理
+            summary.failed = summary.failed.concat(await rejectSales(result.data.failed, batch));
+        }
+
+        if (summary.synced > 0 && options.onSynced) {
+            options.onSynced(summary);
+        }
+        if (summary.failed.length > 0 && options.onRejected) {
+            options.onRejected(summary.failed);
+        }
+        return summary;
+    }
+
+    function safeFlush() {
+        flush().catch(error => console.error('Offline sales sync failed:', error));
+    }
+
+    // 启动离线支持：注册 Service Worker，并在联网/定时时同步队列
+    function start(startOptions) {
+        options = startOptions;
+        if ('serviceWorker' in navigator) {
+            navigator.serviceWorker.register('/sw.js').catch(error => {
+                console.error('Service worker registration failed:', error);
+            });
+        }
+        window.addEventListener('online', safeFlush);
+        setInterval(safeFlush, SYNC_INTERVAL);
+        safeFlush();
+    }
+
+    // 判断是否为网络错误或超时（而不是服务器返回的业务错误）
+    function isNetworkError(error) {
+        return !navigator.onLine || error instanceof TypeError || error.name === 'AbortError';
+    }
+
+    // 带 Idempotency-Key 的写请求：超时或网络错误时用同一个键重试，服务器保证只执行一次
+    async function idempotentFetch(url, fetchOptions = {}, { retries = 2, timeout = 5000 } = {}) {
+        const headers = { ...(fetchOptions.headers || {}), 'Idempotency-Key': newKey() };
+        let lastError = null;
+        for (let attempt = 0; attempt <= retries; attempt++) {
+            const controller = new AbortController();
+            const timer = setTimeout(() => controller.abort(), timeout);
+            try {
+                const response = await fetch(url, { ...fetchOptions, headers, signal: controller.signal });
+                // 409 + Retry-After 表示首次请求仍在处理中
+                if (!(response.status === 409 && response.headers.has('Retry-After')) || attempt === retries) {
+                    return response;
+                }
+            } catch (error) {
+                if (!isNetworkError(error)) {
+                    throw error;
+                }
+                lastError = error;
+            } finally {
+                clearTimeout(timer);
+            }
+            await new Promise(resolve => setTimeout(resolve, 200 * 2 ** attempt));
+        }
+        throw lastError;
+    }
+
+    window.PosOffline = {
+        newKey,
+        terminalId,
+        localTimestamp,
+        queueSale,
+        pendingSales,
+        pendingCount,
+        rejectedSales,
+        discardRejected,
+        retryRejected,
+        flush,
+        start,
+        isNetworkError,
+        idempotentFetch
+    };
+})(window);
@@ -0,0 +1,331 @@
+"""
+存储后端
+POSDatabase 通过存储后端获取数据库连接，方法中的 SQL 统一按 SQLite 方言编写：
+SQLiteBackend 为默认的单文件数据库；PostgresBackend 连接 PostgreSQL 服务器（可选依赖 psycopg2），
+使用连接池，并将语句（? 占位符、INSERT OR IGNORE/REPLACE、标量 MAX/MIN、日期函数及建表类型）
+转换为 PostgreSQL 语法，多个应用节点可共用同一个数据库
+"""
+
+import os
+import re
+import sqlite3
+import threading
+from functools import lru_cache
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+    import psycopg2.pool
+except ImportError:  # 只有使用 PostgreSQL 后端时才需要
+    psycopg2 = None
+
+if psycopg2 is not None:
+    # BYTEA 字段按 bytes 返回（与 sqlite3 的 BLOB 一致，psycopg2 默认返回 memoryview）
+    BYTES = psycopg2.extensions.new_type(
+        psycopg2.BINARY.values, 'BYTES',
+        lambda value, cursor: bytes(psycopg2.BINARY(value, cursor)) if value is not None else None
+    )
+
+# PostgreSQL 连接池的最大连接数（每个进程）
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 10))
+
+# 日期时间统一以 'YYYY-MM-DD HH:MM:SS' 文本保存，按字符串比较和截取
+PG_DATETIME_FORMAT = "'YYYY-MM-DD HH24:MI:SS'"
+
+# 由自增序列生成 id 的表：插入时返回新行 id（对应 sqlite3 的 cursor.lastrowid）
+SERIAL_TABLES = {'users', 'products', 'sales', 'temp_sales', 'transactions', 'transaction_items',
+                 'low_stock_alerts', 'sale_voids', 'z_reports'}
+
+# INSERT OR REPLACE 转换为 ON CONFLICT ... DO UPDATE 时使用的冲突列（各表的主键）
+UPSERT_KEYS = {
+    'temp_sales': ('id',),
+    'archive_periods': ('period',),
+    'storage_stats': ('taken_at', 'table_name'),
+    'low_stock_thresholds': ('scope', 'category'),
+    'demand_forecasts': ('product_id',),
+    'sales_analytics_state': ('id',),
+}
+
+DDL_REPLACEMENTS = (
+    (re.compile(r'\bINTEGER PRIMARY KEY AUTOINCREMENT\b', re.I), 'SERIAL PRIMARY KEY'),
+    (re.compile(r'\bREAL\b', re.I), 'DOUBLE PRECISION'),
+    (re.compile(r'\bTIMESTAMP\b', re.I), 'TEXT'),
+    (re.compile(r'\bBLOB\b', re.I), 'BYTEA'),
+    (re.compile(r'\)\s*WITHOUT ROWID', re.I), ')'),
+)
+
+EXPRESSION_REPLACEMENTS = (
+    (re.compile(r"datetime\('now',\s*'localtime'\)", re.I),
+     'to_char(LOCALTIMESTAMP, {})'.format(PG_DATETIME_FORMAT)),
+    (re.compile(r'\bCURRENT_TIMESTAMP\b', re.I),
+     "to_char(CURRENT_TIMESTAMP AT TIME ZONE 'UTC', {})".format(PG_DATETIME_FORMAT)),
+)
+
+INSERT_RE = re.compile(r'INSERT\s+(?:OR\s+(IGNORE|REPLACE)\s+)?INTO\s+(\w+)\s*(?:\(([^)]*)\))?', re.I)
+SCALAR_FUNCTION_RE = re.compile(r'\b(MAX|MIN)\(', re.I)
+
+
+def _replace_scalar_min_max(sql):
+    """多参数的 MAX()/MIN() 在 SQLite 中是标量函数，对应 PostgreSQL 的 GREATEST()/LEAST()"""
+    result = []
+    position = 0
+    for match in SCALAR_FUNCTION_RE.finditer(sql):
+        depth = 0
+        scalar = False
+        for index in range(match.end() - 1, len(sql)):
+            if sql[index] == '(':
+                depth += 1
+            elif sql[index] == ')':
+                depth -= 1
+                if depth == 0:
+                    break
+            elif sql[index] == ',' and depth == 1:
+                scalar = True
+        if scalar:
+            result.append(sql[position:match.start()])
+            result.append('GREATEST(' if match.group(1).upper() == 'MAX' else 'LEAST(')
+            position = match.end()
+    result.append(sql[position:])
+    return ''.join(result)
+
+
+def _replace_placeholders(sql, has_params):
+    """? 占位符转换为 %s；带参数执行时字面的 % 需要写成 %%"""
+    result = []
+    quoted = False
+    for char in sql:
+        if char == "'":
+            quoted = not quoted
+        elif char == '?' and not quoted:
+            char = '%s'
+        elif char == '%' and has_params:
+            char = '%%'
+        result.append(char)
+    return ''.join(result)
+
+
+@lru_cache(maxsize=1024)
+def translate_sql(sql, has_params=True):
+    """将 SQLite 方言的语句转换为 PostgreSQL 语法
+
+    返回 (语句, 是否返回新行id)；不需要执行的语句（PRAGMA、BEGIN）返回 (None, False)
+    """
+    statement = sql.strip()
+    keyword = statement.split(None, 1)[0].upper() if statement else ''
+    if keyword in ('PRAGMA', 'BEGIN'):
+        # 外键约束始终生效；psycopg2 在第一条语句前自动开始事务
+        return None, False
+
+    if keyword in ('CREATE', 'ALTER'):
+        for pattern, replacement in DDL_REPLACEMENTS:
+            statement = pattern.sub(replacement, statement)
+    for pattern, replacement in EXPRESSION_REPLACEMENTS:
+        statement = pattern.sub(replacement, statement)
+    statement = _replace_scalar_min_max(statement)
+
+    returns_id = False
+    match = INSERT_RE.match(statement)
+    if match:
+        action, table, columns = match.groups()
+        if action:
+            statement = statement[:match.start()] + re.sub(
+                r'\s+OR\s+(IGNORE|REPLACE)', '', match.group(0), count=1, flags=re.I) + statement[match.end():]
+        if action and action.upper() == 'IGNORE':
+            statement += ' ON CONFLICT DO NOTHING'
+        elif action:
+            keys = UPSERT_KEYS[table]
+            updates = [column.strip() for column in columns.split(',') if column.strip() not in keys]
+            statement += ' ON CONFLICT ({}) DO UPDATE SET {}'.format(
+                ', '.join(keys), ', '.join('{0} = EXCLUDED.{0}'.format(column) for column in updates))
+        if table in SERIAL_TABLES and 'RETURNING' not in statement.upper():
+            statement += ' RETURNING id'
+            returns_id = True
+
+    return _replace_placeholders(statement, has_params), returns_id
+
+
+class SQLiteBackend:
+    """单文件 SQLite 数据库（默认）：每次操作打开独立连接，连接开销很小，无需连接池"""
+
+    dialect = 'sqlite'
+    IntegrityError = sqlite3.IntegrityError
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def connect(self):
+        """打开数据库连接（启用外键约束）"""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA foreign_keys = ON')
+        return conn
+
+    def table_exists(self, cursor, table):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        return cursor.fetchone() is not None
+
+    def column_names(self, cursor, table):
+        cursor.execute('PRAGMA table_info({})'.format(table))
+        return [row[1] for row in cursor.fetchall()]
+
+    def reserve_ids(self, cursor, table, count):
+        """推进表的 AUTOINCREMENT 序列，预留 count 个 id，返回第一个可用 id"""
+        cursor.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,))
+        row = cursor.fetchone()
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM {}'.format(table))
+        current = max(row[0] if row else 0, cursor.fetchone()[0])
+        if row:
+            cursor.execute('UPDATE sqlite_sequence SET seq = ? WHERE name = ?', (current + count, table))
+        else:
+            cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, current + count))
+        return current + 1
+
+    def close(self):
+        pass
+
+
+class PostgresBackend:
+    """PostgreSQL 数据库：线程安全的连接池，连接用完后归还；连接池用尽时等待其他请求归还"""
+
+    dialect = 'postgresql'
+
+    def __init__(self, dsn, pool_size=DATABASE_POOL_SIZE):
+        if psycopg2 is None:
+            raise RuntimeError('PostgreSQL backend requires psycopg2 (pip install psycopg2-binary)')
+        self.dsn = dsn
+        self.IntegrityError = psycopg2.IntegrityError
+        self._pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size, dsn)
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def connect(self):
+        """从连接池取出连接，返回接口与 sqlite3 连接一致的包装对象"""
+        self._slots.acquire()
+        try:
+            conn = self._pool.getconn()
+            psycopg2.extensions.register_type(BYTES, conn)
+        except Exception:
+            self._slots.release()
+            raise
+        return PooledConnection(self, conn)
+
+    def _release(self, conn):
+        """归还连接：未提交的事务（包括出错后中止的事务）先回滚，无法使用的连接直接关闭"""
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        try:
+            self._pool.putconn(conn, close=broken)
+        finally:
+            self._slots.release()
+
+    def table_exists(self, cursor, table):
+        cursor.execute('SELECT to_regclass(?) IS NOT NULL', (table,))
+        return cursor.fetchone()[0]
+
+    def column_names(self, cursor, table):
+        cursor.execute('''
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = ?
+        ''', (table,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def reserve_ids(self, cursor, table, count):
+        """推进表的 id 序列，预留 count 个 id，返回第一个可用 id（事务级锁保证各进程预留的区间不重叠）"""
+        cursor.execute('SELECT pg_advisory_xact_lock(hashtext(?))', (table + '.id',))
+        cursor.execute("SELECT pg_get_serial_sequence(?, 'id')", (table,))
+        sequence = cursor.fetchone()[0]
+        cursor.execute('SELECT last_value, is_called FROM {}'.format(sequence))
+        last_value, is_called = cursor.fetchone()
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM {}'.format(table))
+        current = max(last_value if is_called else last_value - 1, cursor.fetchone()[0])
+        cursor.execute('SELECT setval(?, ?)', (sequence, current + count))
+        return current + 1
+
+    def close(self):
+        self._pool.closeall()
+
+
+class PooledConnection:
+    """连接池中的 PostgreSQL 连接，提供 POSDatabase 使用的 sqlite3 连接接口，close() 时归还连接池"""
+
+    def __init__(self, backend, conn):
+        self._backend = backend
+        self._conn = conn
+
+    def cursor(self):
+        return PostgresCursor(self._conn.cursor())
+
+    def execute(self, sql, params=()):
+        cursor = self.cursor()
+        cursor.execute(sql, params)
+        return cursor
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._backend._release(conn)
+
+
+class PostgresCursor:
+    """执行前转换 SQL 方言的游标；INSERT 返回的新行 id 保存在 lastrowid"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.lastrowid = None
+
+    def execute(self, sql, params=()):
+        statement, returns_id = translate_sql(sql, bool(params))
+        self.lastrowid = None
+        if statement is None:
+            return self
+        self._cursor.execute(statement, tuple(params) if params else None)
+        if returns_id:
+            row = self._cursor.fetchone()
+            self.lastrowid = row[0] if row else None
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        statement, _ = translate_sql(sql, True)
+        if statement is not None:
+            self._cursor.executemany(statement, [tuple(params) for params in seq_of_params])
+        return self
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def close(self):
+        self._cursor.close()
+
+
+def create_backend(database_url):
+    """根据连接地址创建存储后端：postgresql:// 或 postgres:// 使用 PostgreSQL，否则视为 SQLite 文件路径"""
+    if database_url.startswith(('postgresql://', 'postgres://')):
+        return PostgresBackend(database_url)
+    if database_url.startswith('sqlite:///'):
+        database_url = database_url[len('sqlite:///'):]
+    return SQLiteBackend(database_url)
@@ -0,0 +1,78 @@
+// POS系统 Service Worker
+// 缓存页面、静态资源和产品目录，使收银台在服务器缓慢或断网时仍可使用
+
+const CACHE_NAME = 'pos-offline-v1';
+const PRECACHE_URLS = ['/login.html', '/pos.html', '/temp_pos.html'];
+
+// 产品目录请求等待网络的最长时间，超时则使用缓存
+const CATALOG_NETWORK_TIMEOUT = 2000;
+
+self.addEventListener('install', event => {
+    event.waitUntil(
+        caches.open(CACHE_NAME)
+            .then(cache => cache.addAll(PRECACHE_URLS))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(keys => Promise.all(keys.filter(key => key !== CACHE_NAME).map(key => caches.delete(key))))
+            .then(() => self.clients.claim())
+    );
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') {
+        return;
+    }
+
+    const url = new URL(request.url);
+    if (url.pathname === '/api/products' && !url.search) {
+        event.respondWith(networkFirst(request, CATALOG_NETWORK_TIMEOUT));
+        return;
+    }
+    if (url.pathname.startsWith('/api/') || url.origin !== self.location.origin) {
+        return;
+    }
+    // 页面和静态资源：先返回缓存，同时在后台更新
+    event.respondWith(staleWhileRevalidate(request));
+});
+
+async function networkFirst(request, timeout) {
+    const cache = await caches.open(CACHE_NAME);
+    const network = fetch(request).then(response => {
+        if (response.ok) {
+            cache.put(request, response.clone());
+        }
+        return response;
+    });
+
+    const timer = new Promise(resolve => setTimeout(resolve, timeout));
+    const fastest = await Promise.race([network.catch(() => null), timer]);
+    if (fastest) {
+        return fastest;
+    }
+
+    const cached = await cache.match(request);
+    return cached || network;
+}
+
+async function staleWhileRevalidate(request) {
+    const cache = await caches.open(CACHE_NAME);
+    const cached = await cache.match(request, { ignoreVary: true });
+    const network = fetch(request).then(response => {
+        if (response.ok) {
+            cache.put(request, response.clone());
+        }
+        return response;
+    }).catch(() => null);
+
+    if (cached) {
+        return cached;
+    }
+    const response = await network;
+    return response || new Response('Offline', { status: 503, statusText: 'Offline' });
+}
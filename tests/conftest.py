@@ -0,0 +1,50 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# database 模块导入时会在当前目录创建默认数据库，测试在临时目录中运行，不修改仓库中的 pos_system.db
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+TEST_DIR = tempfile.mkdtemp(prefix='pos-tests-')
+os.chdir(TEST_DIR)
+# 测试中不启动后台任务；应用使用临时目录中的数据库（绝对路径：pytest 结束时会切回原目录，退出时的保存操作仍写入该库）
+os.environ.setdefault('SCHEDULER_ENABLED', '0')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(TEST_DIR, 'pos_system.db')
+
+
+@pytest.fixture
+def db(tmp_path):
+    """独立的 SQLite 数据库"""
+    from database import POSDatabase
+    return POSDatabase(str(tmp_path / 'pos.db'))
+
+
+@pytest.fixture
+def add_product(db):
+    def add(barcode, quantity=100, cost_price=1.0, selling_price=2.0, category='Test'):
+        assert db.add_product(barcode, 'Product ' + barcode, category, quantity, cost_price, selling_price)
+        return db.get_product_by_barcode(barcode)
+    return add
+
+
+@pytest.fixture(scope='session')
+def pos_app():
+    """Flask 应用模块（使用临时目录中的默认数据库）"""
+    import app
+    return app
+
+
+@pytest.fixture
+def client(pos_app):
+    return pos_app.app.test_client()
+
+
+@pytest.fixture
+def login(client):
+    def login_as(username='root', password='root'):
+        response = client.post('/api/login', json={'username': username, 'password': password})
+        assert response.status_code == 200
+        return {'Authorization': 'Bearer ' + response.json['token']}
+    return login_as
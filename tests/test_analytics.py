@@ -0,0 +1,75 @@
+import pytest
+
+from analytics import SalesAnalytics, window_start_date
+
+
+@pytest.fixture
+def workers(db, add_product):
+    """同一数据库上的两个工作进程：本进程的计数器只通过监听得知本进程的销售"""
+    from database import POSDatabase
+    add_product('P001', quantity=100)
+    other = POSDatabase(db.db_path)
+    analytics = SalesAnalytics()
+    db.add_sale_listener(analytics.apply)
+    catch_up(db, analytics)
+    return db, other, analytics
+
+
+def catch_up(db, analytics):
+    start_date = window_start_date()
+    sales, max_sale_id = db.get_sales_after(analytics.last_sale_id, start_date)
+    voids, max_void_id = db.get_sale_voids_after(analytics.last_void_id, start_date)
+    analytics.catch_up(sales, max_sale_id, voids, max_void_id)
+
+
+def sold_today(analytics):
+    return analytics.velocity('P001')['today']['quantity']
+
+
+def last_sale_id(db):
+    return max(sale['id'] for sale in db.get_all_sales())
+
+
+def test_void_in_other_worker_is_caught_up(workers):
+    db, other, analytics = workers
+    assert db.add_sale('P001', 'Product P001', 3, 2.0, 6.0, 1.0)
+    assert other.add_sale('P001', 'Product P001', 2, 2.0, 4.0, 1.0)
+    catch_up(db, analytics)
+    assert sold_today(analytics) == 5
+
+    assert other.delete_sale(last_sale_id(db))
+    catch_up(db, analytics)
+    assert sold_today(analytics) == 3
+    catch_up(db, analytics)
+    assert sold_today(analytics) == 3
+
+
+def test_local_void_is_not_subtracted_twice(workers):
+    db, other, analytics = workers
+    assert db.add_sale('P001', 'Product P001', 3, 2.0, 6.0, 1.0)
+    assert db.delete_sale(last_sale_id(db))
+    assert sold_today(analytics) == 0
+    catch_up(db, analytics)
+    assert sold_today(analytics) == 0
+
+
+def test_uncounted_sale_voided_before_catch_up(workers):
+    db, other, analytics = workers
+    assert db.add_sale('P001', 'Product P001', 3, 2.0, 6.0, 1.0)
+    assert other.add_sale('P001', 'Product P001', 2, 2.0, 4.0, 1.0)
+    assert other.delete_sale(last_sale_id(db))
+    catch_up(db, analytics)
+    assert sold_today(analytics) == 3
+
+
+def test_saved_void_position_survives_restart(workers):
+    db, other, analytics = workers
+    assert db.add_sale('P001', 'Product P001', 3, 2.0, 6.0, 1.0)
+    assert db.add_sale('P001', 'Product P001', 2, 2.0, 4.0, 1.0)
+    db.save_sales_analytics(*analytics.snapshot())
+    assert other.delete_sale(last_sale_id(db))
+
+    restarted = SalesAnalytics()
+    restarted.restore(*db.load_sales_analytics())
+    catch_up(db, restarted)
+    assert sold_today(restarted) == 3
@@ -0,0 +1,46 @@
+def old_sale(client_ref, quantity=1, day='2020-01-15'):
+    return dict(client_ref=client_ref, barcode='A001', name='Product A001', quantity=quantity, price=2.0,
+                total_price=2.0 * quantity, cost_price=1.0, date=day + ' 10:00:00', update_stock=False)
+
+
+def hot_count(db, table):
+    conn = db._connect()
+    try:
+        return conn.execute('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_archive_period_moves_rows_out_of_main_database(db, add_product):
+    add_product('A001')
+    db.sync_sales([old_sale('a1'), old_sale('a2', 2), old_sale('b1', day='2020-02-03')])
+    transaction_id = next(transaction['id'] for transaction in db.get_transactions()
+                          if transaction['date'].startswith('2020-01') and transaction['item_count'] == 2)
+
+    assert db.archive_period('2020-01') == {'period': '2020-01', 'sales': 2, 'transactions': 2}
+    assert hot_count(db, 'sales') == 1
+    assert hot_count(db, 'transactions') == 1
+    periods = db.get_archive_periods()
+    assert [(period['period'], period['sales_count']) for period in periods] == [('2020-01', 2)]
+    assert periods[0]['total_price'] == 6.0
+
+    # 归档后的销售和交易仍可通过分区读取
+    assert sorted(sale['quantity'] for sale in db.get_all_sales()) == [1, 1, 2]
+    assert db.get_transaction(transaction_id)['total_price'] == 4.0
+
+
+def test_archive_merges_late_sales_into_existing_period(db, add_product):
+    add_product('A001')
+    db.sync_sales([old_sale('a1')])
+    db.archive_period('2020-01')
+    db.sync_sales([old_sale('a2', 3)])
+
+    assert db.archive_period('2020-01') == {'period': '2020-01', 'sales': 1, 'transactions': 1}
+    assert hot_count(db, 'sales') == 0
+    assert db.get_archive_periods()[0]['sales_count'] == 2
+    assert sorted(sale['quantity'] for sale in db.get_all_sales()) == [1, 3]
+
+
+def test_nothing_to_archive(db):
+    assert db.archive_period('2020-01') == {'period': '2020-01', 'sales': 0, 'transactions': 0}
+    assert db.get_archive_periods() == []
@@ -0,0 +1,63 @@
+import asyncio
+
+
+def run_request(pos_app, path, headers, on_body=None):
+    """通过 ASGI 入口发送 GET 请求，返回收到的消息；on_body 在每次收到响应体时调用，返回 True 表示客户端断开"""
+    import asgi
+    application = asgi.ASGIApplication(pos_app.app, workers=2, bulk_workers=1, stream_workers=1)
+    sent = []
+
+    async def main():
+        disconnect = asyncio.Event()
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+            if message['type'] == 'http.response.body' and on_body and on_body(message):
+                disconnect.set()
+
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'http_version': '1.1',
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()],
+        }
+        await asyncio.wait_for(application(scope, receive, send), timeout=10)
+
+    try:
+        asyncio.run(main())
+    finally:
+        application.executor.shutdown()
+        application.bulk_executor.shutdown()
+        application.stream_executor.shutdown()
+    return sent
+
+
+def test_buffered_response(pos_app, login):
+    sent = run_request(pos_app, '/api/products', login())
+    assert sent[0]['status'] == 200
+    assert b'"success"' in sent[1]['body']
+
+
+def test_timeline_stream_closes_on_disconnect(pos_app, login, monkeypatch):
+    monkeypatch.setattr(pos_app, 'TIMELINE_STREAM_HEARTBEAT', 0.2)
+    free_slots = pos_app.timeline_streams._value
+    sent = run_request(pos_app, '/api/analytics/timeline/stream', login(),
+                       on_body=lambda message: message['body'].startswith(b'event: snapshot'))
+    assert sent[0]['status'] == 200
+    assert sent[-1]['body'].startswith(b'event: snapshot')
+    # 断开后关闭了响应，推送连接名额已归还
+    assert pos_app.timeline_streams._value == free_slots
+
+
+def test_stream_routes_use_stream_pool():
+    import asgi
+    assert asgi.is_stream_request('GET', '/api/analytics/timeline/stream')
+    assert not asgi.is_stream_request('GET', '/api/analytics/timeline')
+    assert asgi.is_bulk_request('GET', '/api/sales', b'')
@@ -0,0 +1,69 @@
+import os
+import zipfile
+from array import array
+
+
+def exported_ids(export_dir):
+    """读取 .npz 导出文件中 id 列的全部值（不依赖 numpy）"""
+    ids = []
+    for relpath in load(export_dir)['files']['sales']:
+        with zipfile.ZipFile(os.path.join(export_dir, *relpath.split('/'))) as archive:
+            raw = archive.read('id.npy')
+        header_length = int.from_bytes(raw[8:10], 'little')
+        ids.extend(array('q', raw[10 + header_length:]))
+    return sorted(ids)
+
+
+def load(export_dir):
+    from export import load_manifest
+    return load_manifest(export_dir)
+
+
+def sale_ids(db):
+    return sorted(sale['id'] for sale in db.get_all_sales())
+
+
+def test_export_appends_new_sales(db, add_product, tmp_path):
+    export_dir = str(tmp_path / 'exports')
+    add_product('P001')
+    assert db.add_sale('P001', 'Product P001', 1, 2.0, 2.0, 1.0)
+    result = db.export_columnar(export_dir, 'npz')
+    assert result['sales'] == 1
+    assert db.add_sale('P001', 'Product P001', 2, 2.0, 4.0, 1.0)
+    result = db.export_columnar(export_dir, 'npz')
+    assert result['sales'] == 1
+    assert result['rewritten_months'] == []
+    assert exported_ids(export_dir) == sale_ids(db)
+    assert load(export_dir)['last_sale_id'] == max(sale_ids(db))
+
+
+def test_export_rewrites_months_with_voided_sales(db, add_product, tmp_path):
+    export_dir = str(tmp_path / 'exports')
+    add_product('P001')
+    for quantity in (1, 2, 3):
+        assert db.add_sale('P001', 'Product P001', quantity, 2.0, 2.0 * quantity, 1.0)
+    db.export_columnar(export_dir, 'npz')
+    voided = sale_ids(db)[1]
+    assert db.delete_sale(voided)
+    assert db.add_sale('P001', 'Product P001', 4, 2.0, 8.0, 1.0)
+
+    result = db.export_columnar(export_dir, 'npz')
+    assert result['sales'] == 1
+    assert result['rewritten_sales'] == 2
+    assert len(result['rewritten_months']) == 1
+    assert voided not in exported_ids(export_dir)
+    assert exported_ids(export_dir) == sale_ids(db)
+    # 已处理的作废不再触发重写
+    assert db.export_columnar(export_dir, 'npz')['rewritten_months'] == []
+
+
+def test_void_of_unexported_sale_needs_no_rewrite(db, add_product, tmp_path):
+    export_dir = str(tmp_path / 'exports')
+    add_product('P001')
+    assert db.add_sale('P001', 'Product P001', 1, 2.0, 2.0, 1.0)
+    db.export_columnar(export_dir, 'npz')
+    assert db.add_sale('P001', 'Product P001', 2, 2.0, 4.0, 1.0)
+    assert db.delete_sale(max(sale_ids(db)))
+    result = db.export_columnar(export_dir, 'npz')
+    assert result['rewritten_months'] == []
+    assert exported_ids(export_dir) == sale_ids(db)
@@ -0,0 +1,81 @@
+from datetime import date, timedelta
+
+import pytest
+
+from forecasting import DemandState, reorder_suggestion, service_level_z
+
+
+def test_constant_demand_has_no_variance():
+    state = DemandState()
+    for day in range(1, 201):
+        state.advance(day, 4)
+    assert state.mean() == pytest.approx(4)
+    assert state.std() == pytest.approx(0, abs=1e-6)
+
+
+def test_skipped_days_decay_like_zero_sales():
+    skipped, daily = DemandState(), DemandState()
+    skipped.advance(1, 5)
+    skipped.advance(10, 3)
+    daily.advance(1, 5)
+    for day in range(2, 10):
+        daily.advance(day, 0)
+    daily.advance(10, 3)
+    assert skipped.level == pytest.approx(daily.level)
+    assert skipped.square == pytest.approx(daily.square)
+    assert skipped.mean() == pytest.approx(daily.mean())
+
+
+def test_reorder_suggestion():
+    z = service_level_z(0.95)
+    assert z == pytest.approx(1.645, abs=1e-3)
+    suggestion = reorder_suggestion(available=10, mean=2, std=0, lead_time=7, z=z, review_days=7)
+    assert suggestion['reorder_point'] == 14
+    assert suggestion['suggested_quantity'] == 18
+    assert suggestion['days_of_cover'] == 5.0
+    with pytest.raises(ValueError):
+        service_level_z(1.2)
+
+
+def sync_daily_sales(db, days, quantity):
+    today = date.today()
+    db.sync_sales([dict(client_ref='f{}'.format(offset), barcode='F001', name='Product F001', quantity=quantity,
+                        price=2.0, total_price=2.0 * quantity, cost_price=1.0, update_stock=False,
+                        date=(today - timedelta(days=offset)).isoformat() + ' 12:00:00')
+                   for offset in range(1, days + 1)])
+
+
+def forecast(db):
+    conn = db._connect()
+    try:
+        return conn.execute('SELECT level, square, first_day, through_day FROM demand_forecasts').fetchall()
+    finally:
+        conn.close()
+
+
+def test_incremental_update_matches_rebuild(db, add_product):
+    add_product('F001', quantity=5)
+    sync_daily_sales(db, 30, 3)
+    yesterday = date.today() - timedelta(days=1)
+    db.update_demand_forecasts(through=yesterday - timedelta(days=5))
+    result = db.update_demand_forecasts(through=yesterday)
+    assert result['days'] == 5
+    incremental = forecast(db)
+    db.update_demand_forecasts(through=yesterday, rebuild=True)
+    assert forecast(db)[0][:2] == pytest.approx(incremental[0][:2])
+    assert forecast(db)[0][2:] == incremental[0][2:]
+    # 已更新到 through 时不再读取销售
+    assert db.update_demand_forecasts(through=yesterday)['days'] == 0
+
+
+def test_reorder_suggestions_list_low_stock_products(db, add_product):
+    add_product('F001', quantity=5)
+    add_product('F002', quantity=1000)
+    sync_daily_sales(db, 30, 3)
+    db.update_demand_forecasts()
+    suggestions = db.get_reorder_suggestions(lead_time=7, service_level=0.95, review_days=7)
+    assert [item['barcode'] for item in suggestions['items']] == ['F001']
+    item = suggestions['items'][0]
+    assert item['daily_demand'] == pytest.approx(3, abs=0.01)
+    assert item['suggested_quantity'] > 0
+    assert item['moving_average'] == pytest.approx(3)
@@ -0,0 +1,53 @@
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def barcode(pos_app):
+    barcode = 'I' + uuid.uuid4().hex[:12]
+    assert pos_app.db.add_product(barcode, 'Product ' + barcode, 'Test', 10, 1.0, 2.0)
+    return barcode
+
+
+def sale_count(pos_app, barcode):
+    return sum(1 for sale in pos_app.db.get_all_sales() if sale['barcode'] == barcode)
+
+
+def sale_body(barcode, quantity=1):
+    return {'barcode': barcode, 'name': 'Product ' + barcode, 'quantity': quantity, 'price': 2.0,
+            'total_price': 2.0 * quantity, 'cost_price': 1.0}
+
+
+def test_retry_with_same_key_is_replayed(pos_app, client, login, barcode):
+    headers = dict(login(), **{'Idempotency-Key': uuid.uuid4().hex})
+    first = client.post('/api/sales', json=sale_body(barcode), headers=headers)
+    second = client.post('/api/sales', json=sale_body(barcode), headers=headers)
+    assert first.status_code == second.status_code == 200
+    assert 'Idempotent-Replayed' not in first.headers
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.get_data() == first.get_data()
+    assert sale_count(pos_app, barcode) == 1
+
+
+def test_same_key_with_different_body_is_rejected(pos_app, client, login, barcode):
+    headers = dict(login(), **{'Idempotency-Key': uuid.uuid4().hex})
+    assert client.post('/api/sales', json=sale_body(barcode), headers=headers).status_code == 200
+    assert client.post('/api/sales', json=sale_body(barcode, 2), headers=headers).status_code == 422
+    assert sale_count(pos_app, barcode) == 1
+
+
+def test_requests_without_key_are_not_deduplicated(pos_app, client, login, barcode):
+    headers = login()
+    for _ in range(2):
+        assert client.post('/api/sales', json=sale_body(barcode), headers=headers).status_code == 200
+    assert sale_count(pos_app, barcode) == 2
+
+
+def test_keys_are_scoped_to_the_user(pos_app, client, login, barcode):
+    key = uuid.uuid4().hex
+    assert client.post('/api/sales', json=sale_body(barcode),
+                       headers=dict(login(), **{'Idempotency-Key': key})).status_code == 200
+    assert client.post('/api/sales', json=sale_body(barcode),
+                       headers=dict(login('admin', 'admin'), **{'Idempotency-Key': key})).status_code == 200
+    assert sale_count(pos_app, barcode) == 2
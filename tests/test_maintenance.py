@@ -0,0 +1,43 @@
+import sqlite3
+
+from database import POSDatabase
+
+
+def pragma(path, name):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('PRAGMA {}'.format(name)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_new_database_uses_incremental_auto_vacuum(db):
+    assert pragma(db.db_path, 'auto_vacuum') == 2
+
+
+def test_legacy_database_is_not_vacuumed_at_startup(tmp_path):
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE legacy (id INTEGER PRIMARY KEY)')
+    conn.close()
+
+    db = POSDatabase(path)
+    assert pragma(path, 'auto_vacuum') == 0
+    assert db.migrate_auto_vacuum(max_size=1) is False
+
+    assert db.migrate_auto_vacuum() is True
+    assert pragma(path, 'auto_vacuum') == 2
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT name FROM schema_migrations WHERE name = 'auto_vacuum_incremental'").fetchone()
+    conn.close()
+    assert db.migrate_auto_vacuum() is False
+
+
+def test_schema_migration_runs_once(db):
+    calls = []
+    conn = db._connect()
+    cursor = conn.cursor()
+    assert db._run_migration(cursor, 'test_once', calls.append) is True
+    assert db._run_migration(cursor, 'test_once', calls.append) is False
+    conn.close()
+    assert len(calls) == 1
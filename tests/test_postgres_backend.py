@@ -0,0 +1,140 @@
+"""
+PostgreSQL 存储后端测试
+需要本地 PostgreSQL：设置 POS_TEST_PG_DSN（如 postgresql://postgres@localhost/postgres）后运行
+    POS_TEST_PG_DSN=... python -m pytest tests
+每次运行在该数据库中新建一个临时 schema，结束后删除；未设置时只运行不需要数据库的检查
+"""
+
+import os
+import sqlite3
+import uuid
+
+import pytest
+
+from database import POSDatabase, VersionConflictError
+from storage import SERIAL_TABLES, PostgresBackend, psycopg2
+
+PG_DSN = os.environ.get('POS_TEST_PG_DSN')
+
+# 只在 SQLite 上创建的表：FTS5 全文索引、触发器维护的统计累计表
+SQLITE_ONLY_TABLES = ('products_fts', 'product_stats', 'sqlite_')
+
+requires_postgres = pytest.mark.skipif(
+    not PG_DSN or psycopg2 is None, reason='set POS_TEST_PG_DSN and install psycopg2 to run PostgreSQL tests'
+)
+
+
+def autoincrement_tables(tmp_path):
+    """按 SQLite 建表语句找出所有自增 id 的表"""
+    POSDatabase(str(tmp_path / 'schema.db'))
+    conn = sqlite3.connect(str(tmp_path / 'schema.db'))
+    try:
+        rows = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table' AND sql IS NOT NULL").fetchall()
+    finally:
+        conn.close()
+    return {name for name, sql in rows if 'AUTOINCREMENT' in sql.upper()}, {name for name, sql in rows}
+
+
+def test_serial_tables_cover_autoincrement_tables(tmp_path):
+    # 漏掉的表在 PostgreSQL 上插入后 lastrowid 为 None
+    serial, _ = autoincrement_tables(tmp_path)
+    assert serial - SERIAL_TABLES == set()
+
+
+@pytest.fixture(scope='module')
+def pg_db():
+    schema = 'pos_test_{}'.format(uuid.uuid4().hex[:12])
+    admin = psycopg2.connect(PG_DSN)
+    admin.autocommit = True
+    admin.cursor().execute('CREATE SCHEMA {}'.format(schema))
+    backend = PostgresBackend(psycopg2.extensions.make_dsn(PG_DSN, options='-c search_path={}'.format(schema)))
+    try:
+        yield POSDatabase(backend=backend)
+    finally:
+        backend.close()
+        admin.cursor().execute('DROP SCHEMA {} CASCADE'.format(schema))
+        admin.close()
+
+
+def count_rows(db, table):
+    conn = db._connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM {}'.format(table))
+        return cursor.fetchone()[0]
+    finally:
+        conn.close()
+
+
+@requires_postgres
+def test_schema_creation(pg_db, tmp_path):
+    _, tables = autoincrement_tables(tmp_path)
+    tables = {table for table in tables if not table.startswith(SQLITE_ONLY_TABLES)}
+    conn = pg_db._connect()
+    try:
+        missing = [table for table in sorted(tables) if not pg_db.backend.table_exists(conn.cursor(), table)]
+    finally:
+        conn.close()
+    assert missing == []
+    # 再次初始化（已有表时的迁移路径）不应出错
+    POSDatabase(backend=pg_db.backend)
+
+
+@requires_postgres
+def test_insert_returns_lastrowid(pg_db):
+    conn = pg_db._connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO transactions (cashier, date) VALUES (?, '2024-01-01 00:00:00')", ('lastrowid',))
+        transaction_id = cursor.lastrowid
+        assert isinstance(transaction_id, int)
+        cursor.execute('SELECT cashier FROM transactions WHERE id = ?', (transaction_id,))
+        assert cursor.fetchone()[0] == 'lastrowid'
+    finally:
+        conn.close()
+
+
+@requires_postgres
+def test_checkout_and_close_day(pg_db):
+    assert pg_db.add_user('pg_cashier', 'secret123', 'user')
+    assert pg_db.add_product('PG001', 'Test product', 'Test', 12, 1.0, 2.5)
+    product = pg_db.get_product_by_barcode('PG001')
+
+    # 购物车：预留库存后结算
+    temp_sale_id = pg_db.reserve_temp_sale_ids(1)
+    item = {'id': temp_sale_id, 'barcode': 'PG001', 'name': product['name'], 'quantity': 5, 'price': 2.5,
+            'total_price': 12.5, 'date': '2024-01-01 10:00:00', 'terminal_id': 'till-1'}
+    pg_db.save_temp_sale_changes([item], [])
+    assert pg_db.reserve_stock(temp_sale_id, 'till-1', 'PG001', 5)
+    assert pg_db.get_product_by_barcode('PG001')['available_quantity'] == 7
+    transaction_id = pg_db.checkout_cart([item], cashier='pg_cashier', terminal_id='till-1', received_amount=20)
+    assert transaction_id is not None
+
+    product = pg_db.get_product_by_barcode('PG001')
+    assert (product['quantity'], product['reserved_quantity']) == (7, 0)
+    transaction = pg_db.get_transaction(transaction_id)
+    assert transaction['total_price'] == 12.5
+    assert [line['quantity'] for line in transaction['items']] == [5]
+    # 库存从阈值以上降到阈值以下
+    assert pg_db.get_low_stock_alerts()[0]['barcode'] == 'PG001'
+    assert pg_db.get_product_stats()['total_quantity'] == 7
+
+    # 带版本号的修改：过期版本返回冲突，库存增减不覆盖
+    with pytest.raises(VersionConflictError):
+        pg_db.patch_product(product['id'], {'selling_price': 3.0}, version=product['version'] - 1)
+    patched = pg_db.patch_product(product['id'], {'selling_price': 3.0}, version=product['version'],
+                                  quantity_change=-1)
+    assert (patched['quantity'], patched['version']) == (6, product['version'] + 1)
+
+    # 作废一条单行销售，再日结
+    assert pg_db.add_sale('PG001', product['name'], 1, 3.0, 3.0, 1.0, cashier='pg_cashier')
+    sale_id = max(sale['id'] for sale in pg_db.get_all_sales())
+    assert pg_db.delete_sale(sale_id, voided_by='pg_cashier')
+
+    report = pg_db.close_day()
+    assert report['closed'] and report['transaction_count'] >= 1
+    assert [entry['cashier'] for entry in report['cashiers']] == ['pg_cashier']
+    assert report['products'][0]['barcode'] == 'PG001'
+
+    # 每个自增表都通过 lastrowid 写入过关联数据
+    assert {table: count_rows(pg_db, table) > 0 for table in SERIAL_TABLES} == {table: True for table in SERIAL_TABLES}
@@ -0,0 +1,63 @@
+import threading
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def product(pos_app):
+    barcode = 'C' + uuid.uuid4().hex[:12]
+    assert pos_app.db.add_product(barcode, 'Product ' + barcode, 'Test', 10, 1.0, 2.0)
+    return pos_app.db.get_product_by_barcode(barcode)
+
+
+def concurrently(pos_app, headers, path, bodies):
+    """多个线程同时提交 PATCH，返回 (状态码, 响应) 列表"""
+    barrier = threading.Barrier(len(bodies))
+    results = [None] * len(bodies)
+
+    def patch(index, body):
+        client = pos_app.app.test_client()
+        barrier.wait()
+        response = client.patch(path, json=body, headers=headers)
+        results[index] = (response.status_code, response.json)
+
+    threads = [threading.Thread(target=patch, args=(index, body)) for index, body in enumerate(bodies)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_patch_with_same_version(pos_app, login, product):
+    headers = login()
+    path = '/api/products/{}'.format(product['id'])
+    results = concurrently(pos_app, headers, path, [
+        {'version': product['version'], 'quantity': 7},
+        {'version': product['version'], 'quantity': 9},
+    ])
+    assert sorted(status for status, body in results) == [200, 409]
+    winner = next(body['data'] for status, body in results if status == 200)
+    conflict = next(body['data'] for status, body in results if status == 409)
+    assert winner['version'] == product['version'] + 1
+    assert conflict['version'] == winner['version']
+    assert pos_app.db.get_product_by_barcode(product['barcode'])['quantity'] == winner['quantity']
+
+
+def test_concurrent_quantity_changes_add_up(pos_app, login, product):
+    results = concurrently(pos_app, login(), '/api/products/{}'.format(product['id']), [
+        {'quantity_change': 5},
+        {'quantity_change': 3},
+    ])
+    assert [status for status, body in results] == [200, 200]
+    assert pos_app.db.get_product_by_barcode(product['barcode'])['quantity'] == 18
+
+
+def test_put_requires_version(client, login, product):
+    path = '/api/products/{}'.format(product['id'])
+    body = {'barcode': product['barcode'], 'name': product['name'], 'category': 'Test', 'quantity': 1,
+            'cost_price': 1.0, 'selling_price': 2.0}
+    assert client.put(path, json=body, headers=login()).status_code == 428
+    assert client.put(path, json=dict(body, version=product['version'] + 1), headers=login()).status_code == 409
+    assert client.put(path, json=dict(body, version=product['version']), headers=login()).status_code == 200
@@ -0,0 +1,10 @@
+def test_report_snapshot_is_copied_only_after_changes(db, add_product):
+    add_product('P001', quantity=10)
+    assert db.refresh_report_snapshot()['refreshed'] is True
+    assert db.refresh_report_snapshot()['refreshed'] is False
+
+    assert db.add_sale('P001', 'Product P001', 2, 2.0, 4.0, 1.0)
+    assert db.refresh_report_snapshot()['refreshed'] is True
+    assert db.get_sales_summary(group_by='product')['total']['quantity'] == 2
+    assert db.refresh_report_snapshot()['refreshed'] is False
+    assert db.refresh_report_snapshot(force=True)['refreshed'] is True
@@ -0,0 +1,47 @@
+import time
+
+from cart_store import CartStore
+
+
+def test_reserve_stock_limits_available_quantity(db, add_product):
+    add_product('R001', quantity=5)
+    assert db.reserve_stock(1, 'till-1', 'R001', 3)
+    assert not db.reserve_stock(2, 'till-2', 'R001', 3)
+    product = db.get_product_by_barcode('R001')
+    assert (product['reserved_quantity'], product['available_quantity']) == (3, 2)
+    assert db.release_reservations([1]) == 1
+    assert db.get_product_by_barcode('R001')['available_quantity'] == 5
+
+
+def test_expired_reservations_are_released(db, add_product):
+    add_product('R001', quantity=5)
+    assert db.reserve_stock(1, 'till-1', 'R001', 2, ttl_seconds=60)
+    assert db.expire_reservations(now=time.time() + 30) == []
+    assert db.expire_reservations(now=time.time() + 61) == [(1, 'till-1')]
+    assert db.get_product_by_barcode('R001')['reserved_quantity'] == 0
+
+
+def test_orphan_release_skips_recent_reservations(db, add_product):
+    add_product('R001', quantity=10)
+    # 另一个工作进程刚加入购物车、尚未写回 temp_sales 的记录
+    assert db.reserve_stock(1, 'till-1', 'R001', 2)
+    assert db.release_orphan_reservations() == 0
+    assert db.get_product_by_barcode('R001')['reserved_quantity'] == 2
+    # 长时间没有续期的无主预留被释放
+    assert db.reserve_stock(2, 'till-2', 'R001', 3, ttl_seconds=60)
+    assert db.release_orphan_reservations(ttl_seconds=60, idle_seconds=0) == 1
+    assert db.get_product_by_barcode('R001')['reserved_quantity'] == 2
+
+
+def test_second_cart_store_keeps_unflushed_reservations(db, add_product):
+    add_product('R001', quantity=10)
+    store = CartStore(db, flush_interval=1.0)
+    try:
+        item = store.add_item('till-1', 'R001', 'Product R001', 4, 2.0, 8.0)
+        assert item is not None
+        assert store.add_item('till-1', 'R001', 'Product R001', 7, 2.0, 14.0) is None
+        # 第二个进程启动时不释放第一个进程的预留
+        CartStore(db).close()
+        assert db.get_product_by_barcode('R001')['reserved_quantity'] == 4
+    finally:
+        store.close()
@@ -0,0 +1,46 @@
+import sqlite3
+
+import pytest
+
+
+def sale(client_ref, barcode='S001', quantity=1, **extra):
+    return dict(client_ref=client_ref, barcode=barcode, name='Product ' + barcode, quantity=quantity,
+                price=2.0, total_price=2.0 * quantity, cost_price=1.0, **extra)
+
+
+def test_sync_sales_deduplicates_by_client_ref(db, add_product):
+    add_product('S001', quantity=10)
+    first = db.sync_sales([sale('r1'), sale('r2', quantity=2)])
+    assert first == {'accepted': ['r1', 'r2'], 'duplicates': [], 'rejected': []}
+    again = db.sync_sales([sale('r1'), sale('r3')])
+    assert again == {'accepted': ['r3'], 'duplicates': ['r1'], 'rejected': []}
+    assert db.get_product_by_barcode('S001')['quantity'] == 6
+    assert len(db.get_all_sales()) == 3
+
+
+def test_sync_groups_transaction_ref(db, add_product):
+    add_product('S001')
+    db.sync_sales([sale('a', transaction_ref='t1'), sale('b', transaction_ref='t1')])
+    transactions = db.get_transactions()
+    assert [transaction['line_count'] for transaction in transactions] == [2]
+    assert db.sync_sales([sale('a', transaction_ref='t1')])['duplicates'] == ['a']
+
+
+def test_record_transaction_raises_on_other_constraint_errors(db, add_product):
+    add_product('S001')
+    # 只忽略 client_ref 重复；缺少必填字段时报错，不会生成没有明细的交易
+    with pytest.raises(sqlite3.IntegrityError):
+        db.sync_sales([dict(sale('bad'), name=None)])
+    assert db.get_all_sales() == []
+
+
+def test_sync_route_reports_rejected_sales(client, login, pos_app):
+    headers = login()
+    pos_app.db.add_product('SYNC01', 'Sync product', 'Test', 10, 1.0, 2.0)
+    response = client.post('/api/sync', headers=headers, json={'sales': [
+        sale('route-ok', barcode='SYNC01'), sale('route-bad', barcode='SYNC01', date='yesterday')
+    ]})
+    assert response.status_code == 200
+    data = response.json['data']
+    assert data['accepted'] == ['route-ok']
+    assert [entry['client_ref'] for entry in data['failed']] == ['route-bad']
@@ -0,0 +1,70 @@
+import sqlite3
+from datetime import date, timedelta
+
+import pytest
+
+from database import DayClosedError
+
+YESTERDAY = (date.today() - timedelta(days=1)).isoformat()
+
+
+def sale(client_ref, quantity, day):
+    return dict(client_ref=client_ref, barcode='Z001', name='Product Z001', quantity=quantity, price=2.0,
+                total_price=2.0 * quantity, cost_price=1.0, date=day + ' 12:00:00')
+
+
+def test_close_day_twice(db, add_product):
+    add_product('Z001', quantity=10)
+    assert db.sync_sales([sale('y1', 2, YESTERDAY)])['accepted'] == ['y1']
+    report = db.close_day(YESTERDAY, closed_by='root')
+    assert report['closed'] is True
+    assert report['revenue'] == 4.0
+    with pytest.raises(DayClosedError):
+        db.close_day(YESTERDAY)
+    assert db.get_z_reports()['total'] == 1
+
+
+@pytest.mark.parametrize('table', ['z_reports', 'z_report_cashiers', 'z_report_products'])
+def test_z_reports_are_immutable(db, add_product, table):
+    add_product('Z001', quantity=10)
+    db.sync_sales([sale('y1', 2, YESTERDAY)])
+    db.close_day(YESTERDAY)
+    conn = db._connect()
+    try:
+        with pytest.raises(sqlite3.IntegrityError, match='immutable'):
+            conn.execute('UPDATE {} SET revenue = 0'.format(table))
+        with pytest.raises(sqlite3.IntegrityError, match='immutable'):
+            conn.execute('DELETE FROM {}'.format(table))
+    finally:
+        conn.close()
+    assert db.get_z_report(YESTERDAY)['revenue'] == 4.0
+
+
+def test_closing_stock_excludes_sales_after_the_day(db, add_product):
+    add_product('Z001', quantity=10, cost_price=1.0, selling_price=2.0)
+    db.sync_sales([sale('y1', 2, YESTERDAY), sale('t1', 3, date.today().isoformat())])
+    assert db.get_product_by_barcode('Z001')['quantity'] == 5
+
+    report = db.close_day(YESTERDAY)
+    assert report['products'][0]['closing_quantity'] == 8
+    assert report['stock_quantity'] == 8
+    assert report['stock_cost_value'] == 8.0
+    assert report['stock_selling_value'] == 16.0
+
+
+def test_writes_into_closed_day_are_rejected(db, add_product):
+    add_product('Z001', quantity=10)
+    db.sync_sales([sale('y1', 2, YESTERDAY)])
+    db.close_day(YESTERDAY)
+
+    result = db.sync_sales([sale('y2', 1, YESTERDAY), sale('t1', 1, date.today().isoformat())])
+    assert result['accepted'] == ['t1']
+    assert [entry['client_ref'] for entry in result['rejected']] == ['y2']
+    assert db.get_z_report(YESTERDAY)['item_count'] == 2
+
+    db.close_day()
+    assert not db.add_sale('Z001', 'Product Z001', 1, 2.0, 2.0, 1.0)
+    assert not db.delete_sale(db.get_all_sales()[0]['id'])
+    with pytest.raises(DayClosedError):
+        db.checkout_cart([{'id': 1, 'barcode': 'Z001', 'name': 'Product Z001', 'quantity': 1, 'price': 2.0,
+                           'total_price': 2.0}])